@@ -0,0 +1,3 @@
+"""
+    Benchmarks for openvpn-client-disconnect.  See bench.py.
+"""
@@ -0,0 +1,352 @@
+"""
+    Micro-benchmarks for each stage of handling a disconnect.
+
+        python -m benchmarks.bench [--stage NAME ...] [--output results.json]
+                                   [--baseline benchmarks/baseline.json]
+                                   [--tolerance 0.25] [--write-baseline]
+
+    Every stage is timed over realistic environments (see
+    openvpn_client_disconnect.synthetic) in several rounds; the median
+    round is what's reported and compared.  Results are printed as a
+    table and can be written as JSON.  With --baseline, any stage that's
+    more than --tolerance slower than the baseline is flagged, and the
+    exit status is 1.  Baselines are only comparable on the machine
+    (and python) they were made on.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+import statistics
+from argparse import ArgumentParser
+import openvpn_client_disconnect
+from openvpn_client_disconnect import configcache, enrich, spool, synthetic, transport
+from openvpn_client_disconnect.standins import SyslogCollector
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_TOLERANCE = 0.25
+# Distinct environments to cycle through, so no stage sees one input only.
+ENVIRONMENTS = 64
+
+
+def _write_conf(workdir, spool_dir, metrics, extra=''):
+    """ A config file like the example one; return its path. """
+    conffile = os.path.join(workdir, 'bench.conf')
+    with open(conffile, 'w', encoding='utf-8') as filepointer:
+        filepointer.write('[client-disconnect]\n'
+                          f'metrics-log-dir = {spool_dir}\n'
+                          f'metrics = {metrics!r}\n'
+                          f'{extra}')
+    return conffile
+
+
+class Bench():
+    """
+        The stages, and somewhere for them to work.
+        Each stage_* method returns (callable, calls per round); the
+        callable is given a different environment on each call.
+    """
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self.spool_dir = os.path.join(workdir, 'spool')
+        os.mkdir(self.spool_dir)
+        self.environs = list(synthetic.environments(ENVIRONMENTS))
+        self.conffile = _write_conf(workdir, self.spool_dir, synthetic.EXAMPLE_METRICS)
+        self._closers = []
+
+    def close(self):
+        """ Undo anything the stages set up. """
+        for closer in self._closers:
+            closer()
+
+    def _empty_spool(self):
+        """ Keep the spool from growing without bound between rounds. """
+        shutil.rmtree(self.spool_dir)
+        os.mkdir(self.spool_dir)
+
+    def stage_config_ingest(self):
+        """ Read and compile the config file, as every hook run does. """
+        def _run(_environ):
+            config = openvpn_client_disconnect.ingest_config_from_file([self.conffile])
+            openvpn_client_disconnect.settings_from_config(config, self.conffile)
+        return _run, 200
+
+    def stage_config_cached(self):
+        """ Load the same settings from a --settings-cache. """
+        cache = os.path.join(self.workdir, 'settings.cache')
+        configcache.load_settings(self.conffile, cache)
+
+        def _run(_environ):
+            configcache.load_settings(self.conffile, cache)
+        return _run, 200
+
+    def stage_filter_names(self):
+        """ Pick the example metrics out of an environment. """
+        selector = openvpn_client_disconnect.MetricSelector(synthetic.EXAMPLE_METRICS)
+        return selector.select, 2000
+
+    def stage_filter_patterns(self):
+        """ The same, with the metrics given mostly as patterns. """
+        selector = openvpn_client_disconnect.MetricSelector(synthetic.EXAMPLE_SELECTORS)
+        return selector.select, 2000
+
+    def stage_serialize_file(self):
+        """ A record as a per-event file holds it. """
+        selector = openvpn_client_disconnect.MetricSelector(synthetic.EXAMPLE_METRICS)
+
+        def _run(environ):
+            json.dumps(selector.select(environ), sort_keys=True, indent=2)
+        return _run, 2000
+
+    def stage_serialize_segment(self):
+        """ A record as a segment line. """
+        selector = openvpn_client_disconnect.MetricSelector(synthetic.EXAMPLE_METRICS)
+
+        def _run(environ):
+            spool.encode_json_record(selector.select(environ))
+        return _run, 2000
+
+    def stage_serialize_binary(self):
+        """ A record as a binary segment record. """
+        selector = openvpn_client_disconnect.MetricSelector(synthetic.EXAMPLE_METRICS)
+        names = sorted(selector.select(self.environs[0]))
+        ids = {name: num for num, name in enumerate(names, 1)}
+
+        def _run(environ):
+            spool.encode_binary_record(selector.select(environ), ids)
+        return _run, 2000
+
+    def stage_parse_segment(self):
+        """ A segment line back into a record, as a reader does. """
+        selector = openvpn_client_disconnect.MetricSelector(synthetic.EXAMPLE_METRICS)
+        lines = {id(x): spool.encode_json_record(selector.select(x)) for x in self.environs}
+
+        def _run(environ):
+            json.loads(lines[id(environ)])
+        return _run, 5000
+
+    def stage_parse_binary(self):
+        """ A binary segment record back into a record, as a reader does. """
+        selector = openvpn_client_disconnect.MetricSelector(synthetic.EXAMPLE_METRICS)
+        names = sorted(selector.select(self.environs[0]))
+        ids = {name: num for num, name in enumerate(names, 1)}
+        bodies = {id(x): spool.encode_binary_record(selector.select(x), ids)[4:]
+                  for x in self.environs}
+
+        def _run(environ):
+            spool.decode_binary_record(bodies[id(environ)], names)
+        return _run, 5000
+
+    def stage_write_files(self):
+        """ log_metrics_to_disk, one file per event. """
+        selector = openvpn_client_disconnect.MetricSelector(synthetic.EXAMPLE_METRICS)
+        self._empty_spool()
+
+        def _run(environ):
+            openvpn_client_disconnect.log_metrics_to_disk(
+                environ['common_name'], self.spool_dir, selector, environ)
+        return _run, 200
+
+    def stage_write_segments(self):
+        """ log_metrics_to_disk, appending to segments. """
+        selector = openvpn_client_disconnect.MetricSelector(synthetic.EXAMPLE_METRICS)
+        options = {'format': 'segments'}
+        self._empty_spool()
+
+        def _run(environ):
+            openvpn_client_disconnect.log_metrics_to_disk(
+                environ['common_name'], self.spool_dir, selector, environ,
+                spool_options=options)
+        return _run, 500
+
+    def stage_write_binary(self):
+        """ log_metrics_to_disk, appending to binary segments. """
+        selector = openvpn_client_disconnect.MetricSelector(synthetic.EXAMPLE_METRICS)
+        options = {'format': 'segments', 'segment_encoding': 'binary'}
+        self._empty_spool()
+
+        def _run(environ):
+            openvpn_client_disconnect.log_metrics_to_disk(
+                environ['common_name'], self.spool_dir, selector, environ,
+                spool_options=options)
+        return _run, 500
+
+    def stage_enrich_lookup(self):
+        """ Find trusted_ip in a compiled table of 20000 nested networks. """
+        csv_path = os.path.join(self.workdir, 'networks.csv')
+        table_path = os.path.join(self.workdir, 'networks.table')
+        with open(csv_path, 'w', encoding='utf-8') as filepointer:
+            filepointer.write('network,site\n')
+            for num in range(10000):
+                filepointer.write(f'{num % 224 + 1}.{num // 224 % 256}.0.0/16,site{num}\n'
+                                  f'{num % 224 + 1}.{num // 224 % 256}.{num % 256}.0/24,'
+                                  f'lab{num}\n')
+        enrich.compile_csv(csv_path, table_path)
+
+        def _run(environ):
+            enrich.lookup_fields(table_path, environ['trusted_ip'])
+        return _run, 2000
+
+    def stage_event_build(self):
+        """ The syslog event, as JSON. """
+        def _run(environ):
+            json.dumps(openvpn_client_disconnect.build_event(
+                environ['common_name'], environ, 'vpn.example.com'))
+        return _run, 2000
+
+    def stage_event_send(self):
+        """ log_event to a local syslog socket, one write per event. """
+        collector = SyslogCollector('unix', os.path.join(self.workdir, 'log'))
+        sender = transport.SocketTransport(collector.target, 0, batch_size=1)
+        self._closers.extend([sender.close, collector.close])
+
+        def _run(environ):
+            openvpn_client_disconnect.log_event(environ['common_name'], 0, environ,
+                                                hostname='vpn.example.com',
+                                                transport=sender)
+        return _run, 500
+
+    def stage_cold_process(self):
+        """ A whole hook run, in a new process, as openvpn does it. """
+        script = shutil.which('openvpn-client-disconnect')
+        if script:
+            command = [script]
+        else:
+            command = [sys.executable, '-c',
+                       'import openvpn_client_disconnect; openvpn_client_disconnect.main()']
+        command += ['--conf', self.conffile]
+        base = {'PATH': os.environ.get('PATH', ''), 'PYTHONPATH': REPO_ROOT}
+        self._empty_spool()
+
+        def _run(environ):
+            subprocess.run(command, env=dict(base, **environ), check=True,
+                           stdout=subprocess.DEVNULL)
+        return _run, 10
+
+STAGES = [name[len('stage_'):] for name in sorted(vars(Bench)) if name.startswith('stage_')]
+
+
+def time_stage(bench, name, rounds=5):
+    """
+        Time one stage.  Return microseconds per call: the median,
+        fastest and slowest of the rounds.
+    """
+    func, number = getattr(bench, f'stage_{name}')()
+    environs = bench.environs
+    count = len(environs)
+    # One untimed round, to warm caches and open files.
+    for num in range(min(number, count)):
+        func(environs[num])
+    per_call = []
+    for _ in range(rounds):
+        start = time.perf_counter_ns()
+        for num in range(number):
+            func(environs[num % count])
+        per_call.append((time.perf_counter_ns() - start) / number / 1000)
+    return {'median_us': round(statistics.median(per_call), 3),
+            'min_us': round(min(per_call), 3),
+            'max_us': round(max(per_call), 3),
+            'calls': number * rounds}
+
+def run(stages=None, rounds=5):
+    """ Time stages (default: all of them); return the results document. """
+    workdir = tempfile.mkdtemp()
+    bench = Bench(workdir)
+    results = {}
+    try:
+        for name in stages or STAGES:
+            results[name] = time_stage(bench, name, rounds)
+    finally:
+        bench.close()
+        shutil.rmtree(workdir)
+    return {
+        'meta': {'python': platform.python_version(),
+                 'implementation': platform.python_implementation(),
+                 'machine': platform.machine(),
+                 'system': platform.system(),
+                 'timestamp': int(time.time())},
+        'results': results,
+    }
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+        Compare results to a baseline, both results documents.
+        Return {stage: ratio} for every stage that's slower than
+        baseline by more than tolerance (0.25 being 25%).
+    """
+    regressions = {}
+    for name, result in results['results'].items():
+        before = baseline.get('results', {}).get(name)
+        if not before or not before.get('median_us'):
+            continue
+        ratio = result['median_us'] / before['median_us']
+        if ratio > 1 + tolerance:
+            regressions[name] = round(ratio, 3)
+    return regressions
+
+def format_table(results, baseline=None):
+    """ The results as a table, for people. """
+    lines = [f'{"stage":<20} {"median us":>12} {"min us":>12} {"baseline":>12} {"change":>8}']
+    for name, result in results['results'].items():
+        before = (baseline or {}).get('results', {}).get(name, {}).get('median_us')
+        change = f'{(result["median_us"] / before - 1) * 100:+.0f}%' if before else ''
+        lines.append(f'{name:<20} {result["median_us"]:>12.3f} {result["min_us"]:>12.3f} '
+                     f'{before if before else "":>12} {change:>8}')
+    return '\n'.join(lines)
+
+def main_work(argv):
+    """
+        Run the benchmarks; return True unless something regressed.
+    """
+    parser = ArgumentParser(description='Benchmark openvpn-client-disconnect')
+    parser.add_argument('--stage', type=str, action='append', choices=STAGES,
+                        help='Only run this stage (may be repeated)',
+                        dest='stages', default=None)
+    parser.add_argument('--rounds', type=int, required=False,
+                        help='Timed rounds per stage',
+                        dest='rounds', default=5)
+    parser.add_argument('--output', type=str, required=False,
+                        help='Write the results here as JSON',
+                        dest='output', default=None)
+    parser.add_argument('--baseline', type=str, required=False,
+                        help='Compare against this baseline',
+                        dest='baseline', default=None)
+    parser.add_argument('--tolerance', type=float, required=False,
+                        help='How much slower than baseline counts as a regression',
+                        dest='tolerance', default=DEFAULT_TOLERANCE)
+    parser.add_argument('--write-baseline', action='store_true',
+                        help=f'Save the results as the new baseline ({BASELINE})',
+                        dest='write_baseline')
+    args = parser.parse_args(argv[1:])
+
+    results = run(args.stages, args.rounds)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as filepointer:
+            baseline = json.load(filepointer)
+    print(format_table(results, baseline))
+    for path in [args.output, BASELINE if args.write_baseline else None]:
+        if path:
+            with open(path, 'w', encoding='utf-8') as filepointer:
+                json.dump(results, filepointer, indent=2, sort_keys=True)
+                filepointer.write('\n')
+    if baseline is None:
+        return True
+    regressions = compare(results, baseline, args.tolerance)
+    for name, ratio in sorted(regressions.items()):
+        print(f'REGRESSION: {name} is {ratio:.2f}x its baseline', file=sys.stderr)
+    return not regressions
+
+def main():
+    """ Interface to the outside """
+    if main_work(sys.argv):
+        sys.exit(0)
+    sys.exit(1)
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
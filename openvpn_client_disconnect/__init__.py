@@ -1,16 +1,16 @@
 """
     Script to report on disconnecting VPN clients
+
+    openvpn forks this once per disconnect, so starting up is most of
+    what it costs.  Only os and sys (and _thread, which the interpreter
+    has loaded already) are imported up front; everything else is
+    imported by whatever needs it, so a run only pays for the outputs
+    it's configured for.  test_startup keeps an eye on that.
 """
 import os
 import sys
-import ast
-import time
-import datetime
-import socket
-import json
-import syslog
-from argparse import ArgumentParser
-import configparser
+# What threading.local is made of; threading itself costs too much to import.
+from _thread import _local
 sys.dont_write_bytecode = True
 
 
@@ -19,62 +19,199 @@ NEVER_SHARE_METRICS = set(['config', 'daemon', 'daemon_log_redirect',
                            'daemon_pid', 'daemon_start_time', 'verb',
                            'script_context', 'auth_control_file',
                            'password'])
+# State handle_disconnect keeps for the functions it calls, one copy per
+# thread: the daemon and management listener handle several events at
+# once.  .recorder is what this thread's event is timing its stages
+# with, if instrumentation is configured; see instrument.py.
+_PER_THREAD = _local()
+
+class _NotTimed():
+    """ Stands in for instrument.StageTimer when nothing is recording. """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NOT_TIMED = _NotTimed()
+
+def _stage(name):
+    """ A context manager timing the stage called name, if we're recording. """
+    recorder = getattr(_PER_THREAD, 'recorder', None)
+    if recorder is None:
+        return _NOT_TIMED
+    return recorder.timer(name)
+
+def shareable_environment(environ):
+    """
+        The environment, minus anything we never want to share.
+        Used whenever an event's environment has to leave this process;
+        the real metrics selection still happens in log_metrics_to_disk.
+    """
+    return {key: value for key, value in environ.items()
+            if key not in NEVER_SHARE_METRICS}
+
+class MetricSelector(frozenset):
+    """
+        The metrics we're asked to log, as a set of names and patterns,
+        compiled for picking them out of an environment in one pass.
 
-def log_metrics_to_disk(usercn, metrics_log_dir, metrics_requested):
+        A name is taken as is.  A name ending in * (e.g. IV_*) takes
+        every variable starting with what's before the *.  Anything
+        else with a wildcard is an fnmatch pattern (e.g. tls_*_0).
+        NEVER_SHARE_METRICS are never taken, whatever matches them;
+        ALWAYS_SHARE_METRICS always are.
+    """
+    def __init__(self, _patterns=()):
+        # frozenset.__new__ has made them our contents already (and
+        # they may have been an iterator), so they're read from self.
+        super().__init__()
+        exact = set()
+        prefixes = set()
+        globs = []
+        for pattern in self:
+            if not any(x in pattern for x in '*?['):
+                exact.add(pattern)
+            elif pattern.endswith('*') and not any(x in pattern[:-1] for x in '*?['):
+                prefixes.add(pattern[:-1])
+            else:
+                globs.append(pattern)
+        regex = None
+        if globs:
+            # Only patterns need these; keep them off the usual path.
+            import fnmatch  # pylint: disable=import-outside-toplevel
+            regex = '|'.join(fnmatch.translate(x) for x in sorted(globs))
+        self._compiled(exact, prefixes, regex)
+
+    def _compiled(self, exact, prefixes, regex):
+        """ Set up the matchers from their compiled parts. """
+        self.exact = frozenset((set(exact) | ALWAYS_SHARE_METRICS) - NEVER_SHARE_METRICS)
+        self.prefixes = tuple(sorted(prefixes))
+        self.regex = regex
+        self._match = None
+        if regex is not None:
+            import re  # pylint: disable=import-outside-toplevel
+            self._match = re.compile(regex).match
+
+    def to_state(self):
+        """ A JSON-able form, for configcache. """
+        return {'patterns': sorted(self), 'exact': sorted(self.exact),
+                'prefixes': list(self.prefixes), 'regex': self.regex}
+
+    @classmethod
+    def from_state(cls, state):
+        """ The reverse of to_state, without compiling anything again. """
+        selector = frozenset.__new__(cls, state['patterns'])
+        selector._compiled(state['exact'], state['prefixes'], state['regex'])
+        return selector
+
+    def select(self, environ):
+        """ The variables in environ that we log, as a dict. """
+        exact = self.exact
+        prefixes = self.prefixes
+        match = self._match
+        # Anything always shared is there even if openvpn didn't set it.
+        selected = dict.fromkeys(ALWAYS_SHARE_METRICS, '')
+        for key, value in environ.items():
+            if key in exact:
+                selected[key] = value
+            elif (prefixes and key.startswith(prefixes) or
+                  match is not None and match(key)) and key not in NEVER_SHARE_METRICS:
+                selected[key] = value
+        return selected
+
+def log_metrics_to_disk(usercn, metrics_log_dir, metrics_requested, environ=None,
+                        spool_options=None, enrichment=None):
     """
         Using the set of metrics that we are requested to log, log
         the wad of variables to discrete files in a spool directory.
+        metrics_requested is a MetricSelector, or any collection of
+        names and patterns to make one from.
+        environ defaults to our own environment, which is what openvpn
+        hands a client-disconnect script.
+        spool_options picks the spool format and layout; see
+        spool.writer_for.
+        enrichment is any fields to add to the record as well; see
+        enrich.py.
     """
-    existing_requested_metrics = set(os.environ.keys()) & set(metrics_requested)
-    safe_requested_metrics = existing_requested_metrics - NEVER_SHARE_METRICS
-    metrics_to_log = safe_requested_metrics | ALWAYS_SHARE_METRICS
+    if environ is None:
+        environ = os.environ
+    if not isinstance(metrics_requested, MetricSelector):
+        metrics_requested = MetricSelector(metrics_requested)
 
-    directory_log = {x:os.environ.get(x, '') for x in metrics_to_log}
+    with _stage('filter'):
+        directory_log = metrics_requested.select(environ)
+    if enrichment:
+        directory_log.update(enrichment)
 
     if metrics_log_dir:
-        epoch_seconds = int(directory_log.get('time_unix'))
-        date = time.strftime('%Y%m%d%H%M%S', time.gmtime(epoch_seconds))
-        filename = f'log.{usercn}.{date}.json'
-        # Future tweak: ability to change the filename structure?
-        outfile = f'{metrics_log_dir}/{filename}'
-        js_dump = json.dumps(directory_log, sort_keys=True, indent=2)
-        buf = f'{js_dump}\n'
-        with open(outfile, 'w', encoding='utf-8') as outhandle:
-            outhandle.write(buf)
-
-def log_event(usercn, log_facility):
+        with _stage('spool_write'):
+            from openvpn_client_disconnect import spool  # pylint: disable=import-outside-toplevel
+            spool.writer_for(metrics_log_dir, spool_options).write(usercn, directory_log)
+
+def build_event(usercn, environ, hostname, enrichment=None):
     '''
-        Use the syslog module to log disconnection events.
+        The syslog event describing one disconnection, as a dict.
+        enrichment is any fields to add to its details.
     '''
+    import datetime  # pylint: disable=import-outside-toplevel
     quick_metrics = {'username': usercn,
-                     'bytesreceived': os.environ.get('bytes_received', ''),
-                     'bytessent': os.environ.get('bytes_sent', ''),
-                     'vpnip': os.environ.get('ifconfig_pool_remote_ip', ''),
-                     'sourceport': os.environ.get('trusted_port', ''),
-                     'connectionduration': os.environ.get('time_duration', ''),
-                     'sourceipaddress': os.environ.get('trusted_ip', ''),
+                     'bytesreceived': environ.get('bytes_received', ''),
+                     'bytessent': environ.get('bytes_sent', ''),
+                     'vpnip': environ.get('ifconfig_pool_remote_ip', ''),
+                     'sourceport': environ.get('trusted_port', ''),
+                     'connectionduration': environ.get('time_duration', ''),
+                     'sourceipaddress': environ.get('trusted_ip', ''),
                      'success': 'true'}
+    if enrichment:
+        quick_metrics.update(enrichment)
 
-    output_json = {
+    return {
         'category': 'authentication',
         'processid': os.getpid(),
         'severity': 'INFO',
         'processname': sys.argv[0],
         'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
         'details': quick_metrics,
-        'hostname': socket.getfqdn(),
+        'hostname': hostname,
         'summary': f'SUCCESS: VPN disconnection for {usercn}',
         'tags': ['vpn', 'disconnect'],
         'source': 'openvpn',
     }
-    syslog_message = json.dumps(output_json)
-    syslog.openlog(facility=log_facility)
-    syslog.syslog(syslog_message)
 
-def _ingest_config_from_file(conf_files):
+def log_event(usercn, log_facility, environ=None, hostname=None, transport=None,
+              enrichment=None):
+    '''
+        Use the syslog module to log disconnection events.
+        hostname is the name to report ourselves as; if not given,
+        it's looked up.
+        transport, if given, is what to send the event with instead
+        of the syslog module; see transport.get_transport.
+        enrichment is any fields to add to the event's details.
+    '''
+    import json  # pylint: disable=import-outside-toplevel
+    if environ is None:
+        environ = os.environ
+    if hostname is None:
+        with _stage('fqdn'):
+            import socket  # pylint: disable=import-outside-toplevel
+            hostname = socket.getfqdn()
+    syslog_message = json.dumps(build_event(usercn, environ, hostname, enrichment))
+    with _stage('syslog_send'):
+        if transport is not None:
+            transport.send(syslog_message)
+            return
+        import syslog  # pylint: disable=import-outside-toplevel
+        # The facility goes with the message, not through openlog, so
+        # threads logging to different facilities can't mix them up.
+        # The syslog handle stays open between events.
+        syslog.syslog(log_facility | syslog.LOG_INFO, syslog_message)
+
+def ingest_config_from_file(conf_files):
     """
         pull in config variables from a system file
     """
+    import configparser  # pylint: disable=import-outside-toplevel
     config = configparser.ConfigParser()
     for filename in conf_files:
         if os.path.isfile(filename):
@@ -89,47 +226,83 @@ def _ingest_config_from_file(conf_files):
         raise IOError('Config file not found')
     return config
 
-def main_work(argv):
+def settings_from_config(config, conffile=None):
     """
-        Print the config that should go to each client into a file.
-        Return True on success, False upon failure.
-        Side effect is that we write to the output_filename.
+        Turn a parsed config into the settings used to handle events.
+        This is split out from main_work so that a long-running daemon
+        can parse the config once and reuse the result.
+        conffile is where config came from, for anything we start
+        that needs to read it again.
     """
-    parser = ArgumentParser(description='Args for client-disconnect')
-    parser.add_argument('--conf', type=str, required=True,
-                        help='Config file',
-                        dest='conffile', default=None)
-    args = parser.parse_args(argv[1:])
+    # pylint: disable=import-outside-toplevel
+    import ast
+    import configparser
+    from openvpn_client_disconnect import spool
+    try:
+        metrics_log_dir = config.get('client-disconnect',
+                                     'metrics-log-dir')
+    except (configparser.NoOptionError, configparser.NoSectionError):
+        metrics_log_dir = ''
+    if not (os.path.isdir(metrics_log_dir) and
+            os.access(metrics_log_dir, os.W_OK)):
+        metrics_log_dir = None
 
-    event_send = False
-    event_facility = syslog.LOG_AUTH
-    if args.conffile is not None:
-        config = _ingest_config_from_file([args.conffile])
+    try:
+        metrics_requested = MetricSelector(ast.literal_eval(
+            config.get('client-disconnect', 'metrics')))
+    except:  # pragma: no cover  pylint: disable=bare-except
+        # This bare-except is due to 2.7 limitations in configparser.
+        metrics_requested = MetricSelector()
 
+    try:
+        spool_format = config.get('client-disconnect',
+                                  'metrics-spool-format')
+    except (configparser.NoOptionError, configparser.NoSectionError):
+        spool_format = 'files'
+    try:
+        spool_layout = config.get('client-disconnect',
+                                  'metrics-log-layout')
+    except (configparser.NoOptionError, configparser.NoSectionError):
+        spool_layout = 'flat'
+    spool_options = None
+    if spool_format == 'files' and spool_layout in spool.LAYOUTS and spool_layout != 'flat':
+        spool_options = {'format': spool_format, 'layout': spool_layout}
+    elif spool_format == 'segments':
+        spool_options = {'format': spool_format}
         try:
-            metrics_log_dir = config.get('client-disconnect',
-                                         'metrics-log-dir')
-        except (configparser.NoOptionError, configparser.NoSectionError):
-            metrics_log_dir = ''
-        if not (os.path.isdir(metrics_log_dir) and
-                os.access(metrics_log_dir, os.W_OK)):
-            metrics_log_dir = None
-
+            spool_options['segment_max_bytes'] = config.getint(
+                'client-disconnect', 'metrics-segment-max-bytes')
+        except (configparser.NoOptionError, configparser.NoSectionError, ValueError):
+            pass
         try:
-            metrics_requested = set(ast.literal_eval(
-                config.get('client-disconnect', 'metrics')))
-        except:  # pragma: no cover  pylint: disable=bare-except
-            # This bare-except is due to 2.7 limitations in configparser.
-            metrics_requested = set()
-        if not isinstance(metrics_requested, set):  # pragma: no cover
-            metrics_requested = set()
-
+            spool_options['segment_max_age'] = config.getint(
+                'client-disconnect', 'metrics-segment-max-age')
+        except (configparser.NoOptionError, configparser.NoSectionError, ValueError):
+            pass
         try:
-            event_send = config.getboolean('client-disconnect',
-                                           'syslog-events-send')
+            if config.get('client-disconnect', 'metrics-segment-encoding') == 'binary':
+                spool_options['segment_encoding'] = 'binary'
         except (configparser.NoOptionError, configparser.NoSectionError):
             pass
 
+    event_send = False
+    try:
+        event_send = config.getboolean('client-disconnect',
+                                       'syslog-events-send')
+    except (configparser.NoOptionError, configparser.NoSectionError):
+        pass
+
+    try:
+        event_transport = config.get('client-disconnect',
+                                     'syslog-events-transport')
+    except (configparser.NoOptionError, configparser.NoSectionError):
+        event_transport = None
+
+    # Only look up a facility (and import syslog) if there are events to send.
+    event_facility = None
+    if event_send:
+        import syslog
+        event_facility = syslog.LOG_AUTH
         try:
             _base_facility = config.get('client-disconnect',
                                         'syslog-events-facility').upper()
@@ -140,28 +313,287 @@ def main_work(argv):
         except (AttributeError):
             pass
 
+    try:
+        detach_queue_dir = config.get('client-disconnect',
+                                      'detach-queue-dir')
+    except (configparser.NoOptionError, configparser.NoSectionError):
+        detach_queue_dir = ''
+    if not (conffile and os.path.isdir(detach_queue_dir) and
+            os.access(detach_queue_dir, os.W_OK)):
+        detach_queue_dir = None
+
+    try:
+        hostname_cache_file = config.get('client-disconnect',
+                                         'hostname-cache-file')
+    except (configparser.NoOptionError, configparser.NoSectionError):
+        hostname_cache_file = None
+    try:
+        hostname_cache_ttl = config.getint('client-disconnect',
+                                           'hostname-cache-ttl')
+    except (configparser.NoOptionError, configparser.NoSectionError, ValueError):
+        hostname_cache_ttl = 3600
+    try:
+        hostname_lookup_timeout = config.getfloat('client-disconnect',
+                                                  'hostname-lookup-timeout')
+    except (configparser.NoOptionError, configparser.NoSectionError, ValueError):
+        hostname_lookup_timeout = 2.0
+
+    try:
+        instrument_file = config.get('client-disconnect',
+                                     'instrument-file')
+    except (configparser.NoOptionError, configparser.NoSectionError):
+        instrument_file = None
+    try:
+        instrument_textfile = config.get('client-disconnect',
+                                         'instrument-textfile')
+    except (configparser.NoOptionError, configparser.NoSectionError):
+        instrument_textfile = None
+    try:
+        instrument_render_interval = config.getint('client-disconnect',
+                                                   'instrument-render-interval')
+    except (configparser.NoOptionError, configparser.NoSectionError, ValueError):
+        instrument_render_interval = 60
+
+    try:
+        profile_dir = config.get('client-disconnect',
+                                 'profile-dir')
+    except (configparser.NoOptionError, configparser.NoSectionError):
+        profile_dir = ''
+    if not (os.path.isdir(profile_dir) and
+            os.access(profile_dir, os.W_OK)):
+        profile_dir = None
+    try:
+        profile_sample_rate = config.getint('client-disconnect',
+                                            'profile-sample-rate')
+    except (configparser.NoOptionError, configparser.NoSectionError, ValueError):
+        profile_sample_rate = 1000
+
+    try:
+        enrich_table = config.get('client-disconnect',
+                                  'enrich-table')
+    except (configparser.NoOptionError, configparser.NoSectionError):
+        enrich_table = None
+
+    return {
+        'conffile': conffile,
+        'detach_queue_dir': detach_queue_dir,
+        'metrics_log_dir': metrics_log_dir,
+        'metrics_requested': metrics_requested,
+        'spool_options': spool_options,
+        'event_send': event_send,
+        'event_facility': event_facility,
+        'event_transport': event_transport,
+        'hostname_cache_file': hostname_cache_file,
+        'hostname_cache_ttl': hostname_cache_ttl,
+        'hostname_lookup_timeout': hostname_lookup_timeout,
+        'instrument_file': instrument_file,
+        'instrument_textfile': instrument_textfile,
+        'instrument_render_interval': instrument_render_interval,
+        'profile_dir': profile_dir,
+        'profile_sample_rate': profile_sample_rate,
+        'enrich_table': enrich_table,
+    }
+
+def _event_hostname(settings):
+    """
+        The hostname to put in syslog events: whatever a long-running
+        caller already looked up, or from the cache if one is configured,
+        otherwise None so log_event looks it up (and times it) itself.
+    """
+    if settings.get('event_hostname'):
+        return settings['event_hostname']
+    if not settings.get('hostname_cache_file'):
+        return None
+    with _stage('fqdn'):
+        # Imported here so the in-process path doesn't pay for it.
+        from openvpn_client_disconnect import hostname  # pylint: disable=import-outside-toplevel
+        return hostname.cached_fqdn(settings['hostname_cache_file'],
+                                    settings['hostname_cache_ttl'],
+                                    settings['hostname_lookup_timeout'])
+
+def _event_transport(settings):
+    """
+        The transport to send syslog events with, or None to use the
+        syslog module directly.
+    """
+    if not settings.get('event_transport'):
+        return None
+    # Imported here so the in-process path doesn't pay for it.
+    from openvpn_client_disconnect import transport  # pylint: disable=import-outside-toplevel
+    return transport.get_transport(settings['event_transport'], settings['event_facility'])
+
+def _enrichment(settings, address):
+    """
+        What the enrich-table says about address, as fields to add to
+        the record and event; None if there's no table, or it can't say.
+    """
+    if not settings.get('enrich_table'):
+        return None
+    # Imported here so runs without a table don't pay for it.
+    from openvpn_client_disconnect import enrich  # pylint: disable=import-outside-toplevel
+    try:
+        with _stage('enrich'):
+            return enrich.lookup_fields(settings['enrich_table'], address)
+    except (OSError, ValueError):
+        # A missing table or an odd address is no reason to lose the event.
+        return None
+
+def _recorder(settings):
+    """ The instrument.Recorder that settings ask for, or None. """
+    if not settings.get('instrument_file'):
+        return None
+    # Imported here so uninstrumented runs don't pay for it.
+    from openvpn_client_disconnect import instrument  # pylint: disable=import-outside-toplevel
+    return instrument.recorder_for(settings)
+
+def handle_disconnect(settings, environ, detach=True):
+    """
+        Do the actual reporting of one disconnect, described by the
+        environment that openvpn handed to us.
+        If the settings ask for it (and detach is True), only queue the
+        event for a detached worker, rather than reporting it now.
+        Return a (success, message) tuple.  The message is whatever
+        should be shown to a human when we fail.
+        If instrumentation is configured, each stage is timed.
+    """
+    recorder = _PER_THREAD.recorder = _recorder(settings)
+    if recorder is None:
+        return _handle_disconnect(settings, environ, detach)
+    try:
+        with recorder.timer('total'):
+            success, message = _handle_disconnect(settings, environ, detach)
+        if not success:
+            recorder.error('total')
+    finally:
+        recorder.flush()
+    return success, message
+
+def _handle_disconnect(settings, environ, detach):
+    """ handle_disconnect, less the instrumentation. """
     # common_name is an environmental variable passed in:
     # "The X509 common name of an authenticated client."
     # https://openvpn.net/index.php/open-source/documentation/manuals/65-openvpn-20x-manpage.html
-    usercn = os.environ.get('common_name')
-    trusted_ip = os.environ.get('trusted_ip')
+    usercn = environ.get('common_name')
+    trusted_ip = environ.get('trusted_ip')
 
     if not usercn:
         # alternately, "The username provided by a connecting client."
-        usercn = os.environ.get('username')
+        usercn = environ.get('username')
 
     # Super failure in openvpn, or hacking, or an improper test from a human.
     if not usercn:
-        print('No common_name or username environment variable provided.')
-        return False
+        return False, 'No common_name or username environment variable provided.'
     if not trusted_ip:
-        print('No trusted_ip environment variable provided.')
-        return False
+        return False, 'No trusted_ip environment variable provided.'
 
-    log_metrics_to_disk(usercn, metrics_log_dir, metrics_requested)
-    if event_send:
-        log_event(usercn, event_facility)
-    return True
+    if detach and settings.get('detach_queue_dir'):
+        # Imported here so the in-process path doesn't pay for it.
+        from openvpn_client_disconnect import eventqueue  # pylint: disable=import-outside-toplevel
+        eventqueue.submit(settings['detach_queue_dir'], settings['conffile'], environ)
+        return True, ''
+
+    enrichment = _enrichment(settings, trusted_ip)
+    log_metrics_to_disk(usercn, settings['metrics_log_dir'],
+                        settings['metrics_requested'], environ,
+                        spool_options=settings['spool_options'],
+                        enrichment=enrichment)
+    if settings['event_send']:
+        hostname = _event_hostname(settings)
+        log_event(usercn, settings['event_facility'], environ,
+                  hostname=hostname, transport=_event_transport(settings),
+                  enrichment=enrichment)
+    return True, ''
+
+# The options main_work takes, and where they go.
+_OPTIONS = {'--conf': 'conffile', '--daemon-socket': 'daemon_socket',
+            '--settings-cache': 'settings_cache'}
+
+def _quick_parse_args(args):
+    """
+        openvpn runs us the same way every time, with --option value
+        (or --option=value) pairs.  Parse that by hand, so as not to
+        import argparse.  Return None for anything else, and let
+        argparse deal with it and say what's wrong.
+    """
+    parsed = dict.fromkeys(_OPTIONS.values())
+    args = list(args)
+    while args:
+        option, equals, value = args.pop(0).partition('=')
+        if option not in _OPTIONS:
+            return None
+        if not equals:
+            if not args:
+                return None
+            value = args.pop(0)
+        if value.startswith('-'):
+            return None
+        parsed[_OPTIONS[option]] = value
+    if parsed['conffile'] is None:
+        return None
+    return parsed
+
+def _parse_args(args):
+    """ main_work's arguments, as a dict. """
+    parsed = _quick_parse_args(args)
+    if parsed is not None:
+        return parsed
+    from argparse import ArgumentParser  # pylint: disable=import-outside-toplevel
+    parser = ArgumentParser(description='Args for client-disconnect')
+    parser.add_argument('--conf', type=str, required=True,
+                        help='Config file',
+                        dest='conffile', default=None)
+    parser.add_argument('--daemon-socket', type=str, required=False,
+                        help='Hand the event to a running daemon on this unix socket',
+                        dest='daemon_socket', default=None)
+    parser.add_argument('--settings-cache', type=str, required=False,
+                        help='Keep the compiled config in this file between runs',
+                        dest='settings_cache', default=None)
+    return vars(parser.parse_args(args))
+
+def main_work(argv):
+    """
+        Print the config that should go to each client into a file.
+        Return True on success, False upon failure.
+        Side effect is that we write to the output_filename.
+    """
+    # pylint: disable=import-outside-toplevel
+    import time
+    args = _parse_args(argv[1:])
+
+    if args['daemon_socket']:
+        # Imported here so the in-process path doesn't pay for it.
+        from openvpn_client_disconnect import daemon
+        forwarded = daemon.forward_event(args['daemon_socket'], os.environ)
+        if forwarded is not None:
+            success, message = forwarded
+            if message:
+                print(message)
+            return success
+        # The daemon is not there.  Fall through and do it ourselves.
+
+    started = time.perf_counter()
+    if args['settings_cache']:
+        # Imported here so runs without a cache don't pay for it.
+        from openvpn_client_disconnect import configcache
+        settings = configcache.load_settings(args['conffile'], args['settings_cache'])
+    else:
+        config = ingest_config_from_file([args['conffile']])
+        settings = settings_from_config(config, args['conffile'])
+    recorder = _recorder(settings)
+    if recorder is not None:
+        # Flushed along with the rest, at the end of handle_disconnect.
+        recorder.observe('config', time.perf_counter() - started)
+
+    if settings.get('profile_dir'):
+        # Imported here so unprofiled runs don't pay for it.
+        from openvpn_client_disconnect import profiling
+        success, message = profiling.run_sampled(settings, time.perf_counter() - started,
+                                                 handle_disconnect, settings, os.environ)
+    else:
+        success, message = handle_disconnect(settings, os.environ)
+    if message:
+        print(message)
+    return success
 
 def main():
     """ Interface to the outside """
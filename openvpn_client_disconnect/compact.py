@@ -0,0 +1,358 @@
+"""
+    Compact the metrics spool into gzip'ed archives.
+
+    Finished spool records are merged, one compact JSON line each, into
+
+        <archive-dir>/metrics.<period>.jsonl.gz
+
+    where <period> is the hour (YYYYmmddHH) or day (YYYYmmdd) of the
+    record's time_unix.  Next to each archive is an index,
+
+        <archive-dir>/metrics.<period>.idx
+
+    with one tab-separated line per record: time_unix, common_name, and
+    the offset and length of the record in the uncompressed archive.
+    Each batch is appended as a new gzip member, so the archives are
+    ordinary gzip files that `zcat` reads from end to end.
+
+    Work goes in batches, with a journal so that an interrupted run
+    neither loses nor duplicates records:
+      1. the journal notes every archive's size before the batch;
+      2. the batch is appended to the archives and synced;
+      3. the journal is marked committed;
+      4. the sources the batch used up are removed, and the checkpoint
+         remembers how far into a half-used source we got.
+    A run that finds a journal from an earlier one finishes step 4 if
+    the batch was committed, and truncates the archives back if not.
+
+    A source that yields no records, but isn't empty either (a file that
+    isn't JSON, a binary segment whose header can't be read), is left
+    where it is and reported, rather than removed with whatever is in it.
+"""
+import os
+import sys
+import json
+import time
+import gzip
+import fcntl
+from argparse import ArgumentParser
+import configparser
+import openvpn_client_disconnect
+from openvpn_client_disconnect import spool
+
+PERIODS = {'hour': '%Y%m%d%H', 'day': '%Y%m%d'}
+ARCHIVE_PREFIX = 'metrics.'
+ARCHIVE_SUFFIX = '.jsonl.gz'
+INDEX_SUFFIX = '.idx'
+JOURNAL = 'compact.journal'
+CHECKPOINT = 'compact.checkpoint'
+LOCK = 'compact.lock'
+DEFAULT_BATCH_SIZE = 10000
+
+
+def _write_json_atomically(path, data):
+    """ Replace path with data, durably. """
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as filepointer:
+        json.dump(data, filepointer)
+        filepointer.flush()
+        os.fsync(filepointer.fileno())
+    os.replace(tmp_path, path)
+
+def _read_json(path):
+    """ The JSON in path, or None if there isn't any. """
+    try:
+        with open(path, 'r', encoding='utf-8') as filepointer:
+            return json.load(filepointer)
+    except (OSError, ValueError):
+        return None
+
+def _file_size(path):
+    """ The size of path, or None if it doesn't exist. """
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return None
+
+def index_entries(index_path):
+    """
+        Yield (time_unix, common_name, offset, length) for each line of
+        an archive index.
+    """
+    with open(index_path, 'r', encoding='utf-8') as filepointer:
+        for line in filepointer:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) != 4:
+                continue
+            yield int(parts[0]), parts[1], int(parts[2]), int(parts[3])
+
+def _nothing_to_lose(path, start):
+    """
+        Is there nothing in path past start, besides a binary segment's
+        header?  For a source that read_records found no records in.
+    """
+    try:
+        size = os.path.getsize(path)
+        if path.endswith(spool.SEGMENT_BINARY_SUFFIX) and size:
+            with open(path, 'rb') as filepointer:
+                try:
+                    spool.read_binary_header(filepointer)
+                except ValueError:
+                    return False
+                start = max(start, filepointer.tell())
+    except FileNotFoundError:
+        return True
+    return size <= start
+
+def record_time(record):
+    """ A record's time_unix as an int; 0 if it's missing or junk. """
+    try:
+        return int(record.get('time_unix'))
+    except (TypeError, ValueError):
+        return 0
+
+def _index_cn(record):
+    """ A record's common_name, made safe for a tab-separated line. """
+    return str(record.get('common_name', '')).replace('\t', ' ').replace('\n', ' ')
+
+def uncompressed_size(index_path):
+    """
+        How long the uncompressed archive is, going by its index.
+        Only the tail of the index is read.
+    """
+    try:
+        with open(index_path, 'rb') as filepointer:
+            filepointer.seek(0, os.SEEK_END)
+            size = filepointer.tell()
+            filepointer.seek(max(0, size - 4096))
+            lines = filepointer.read().splitlines()
+    except FileNotFoundError:
+        return 0
+    if not lines:
+        return 0
+    parts = lines[-1].split(b'\t')
+    return int(parts[2]) + int(parts[3])
+
+
+class Compactor():
+    """
+        Move finished spool records into archives, in batches.
+    """
+    def __init__(self, spool_dir, archive_dir, period='hour',
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 segment_max_age=spool.DEFAULT_SEGMENT_MAX_AGE):
+        if period not in PERIODS:
+            raise ValueError(f'Unknown archive period {period!r}')
+        self.spool_dir = spool_dir
+        self._spool_root = os.path.join(os.path.abspath(spool_dir), '')
+        self.archive_dir = archive_dir
+        self.period = period
+        self.batch_size = batch_size
+        self.segment_max_age = segment_max_age
+        self.journal_path = os.path.join(archive_dir, JOURNAL)
+        self.checkpoint_path = os.path.join(archive_dir, CHECKPOINT)
+        # archive path -> uncompressed length, for archives we've touched.
+        self._lengths = {}
+        self.records = 0
+        self.sources = 0
+        # Sources we couldn't read anything from, and so left alone.
+        self.unreadable = []
+
+    def archive_path(self, epoch_seconds):
+        """ The archive that a record from epoch_seconds belongs in. """
+        period = time.strftime(PERIODS[self.period], time.gmtime(epoch_seconds))
+        return os.path.join(self.archive_dir, f'{ARCHIVE_PREFIX}{period}{ARCHIVE_SUFFIX}')
+
+    @staticmethod
+    def index_path(archive_path):
+        """ The index that goes with an archive. """
+        return archive_path[:-len(ARCHIVE_SUFFIX)] + INDEX_SUFFIX
+
+    def recover(self):
+        """
+            Finish or undo whatever batch an earlier run was in the middle of.
+        """
+        journal = _read_json(self.journal_path)
+        if journal is None:
+            return
+        if journal['state'] == 'committed':
+            self._finish(journal)
+            return
+        for path, size in journal['sizes'].items():
+            if size is None:
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            else:
+                with open(path, 'r+b') as filepointer:
+                    filepointer.truncate(size)
+        os.unlink(self.journal_path)
+
+    def _finish(self, journal):
+        """
+            Step 4: the batch is safely archived, so drop its sources.
+        """
+        for path in journal['done']:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                continue
+            # Tidy up emptied shard directories, stopping at the first
+            # one that isn't empty.
+            parent = os.path.dirname(os.path.abspath(path))
+            while parent.startswith(self._spool_root):
+                try:
+                    os.rmdir(parent)
+                except OSError:
+                    break
+                parent = os.path.dirname(parent)
+        _write_json_atomically(self.checkpoint_path, {'partial': journal['partial']})
+        os.unlink(self.journal_path)
+
+    def _commit(self, batch, done, partial):
+        """
+            Append a batch of records to the archives, then drop the
+            sources that the batch used up.
+            batch maps archive path to a list of (time_unix, cn, line).
+        """
+        sizes = {}
+        for archive_path in batch:
+            index_path = self.index_path(archive_path)
+            sizes[archive_path] = _file_size(archive_path)
+            sizes[index_path] = _file_size(index_path)
+            if archive_path not in self._lengths:
+                self._lengths[archive_path] = uncompressed_size(index_path)
+        journal = {'state': 'pending', 'sizes': sizes, 'done': done, 'partial': partial}
+        _write_json_atomically(self.journal_path, journal)
+
+        for archive_path, entries in batch.items():
+            offset = self._lengths[archive_path]
+            index_lines = []
+            with open(archive_path, 'ab') as rawfile:
+                with gzip.GzipFile(fileobj=rawfile, mode='wb') as archive:
+                    for epoch_seconds, usercn, line in entries:
+                        archive.write(line)
+                        index_lines.append(f'{epoch_seconds}\t{usercn}\t{offset}\t{len(line)}\n')
+                        offset += len(line)
+                rawfile.flush()
+                os.fsync(rawfile.fileno())
+            with open(self.index_path(archive_path), 'a', encoding='utf-8') as indexfile:
+                indexfile.write(''.join(index_lines))
+                indexfile.flush()
+                os.fsync(indexfile.fileno())
+            self._lengths[archive_path] = offset
+
+        journal['state'] = 'committed'
+        _write_json_atomically(self.journal_path, journal)
+        self._finish(journal)
+
+    def _sources(self):
+        """
+            (path, offset) of every source to read, starting with the one
+            the last run was part-way through.
+        """
+        checkpoint = _read_json(self.checkpoint_path) or {}
+        partial = checkpoint.get('partial')
+        skip = None
+        if partial and os.path.exists(partial[0]):
+            skip = partial[0]
+            yield partial[0], partial[1]
+        for path in spool.iter_spool_sources(self.spool_dir, self.segment_max_age,
+                                             exclude=[self.archive_dir]):
+            if path != skip:
+                yield path, 0
+
+    def run(self):
+        """
+            Compact everything that's ready.  Return the number of records moved.
+        """
+        lock_fd = os.open(os.path.join(self.archive_dir, LOCK), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            self.recover()
+            batch = {}
+            done = []
+            pending = 0
+            for path, start in self._sources():
+                used = False
+                for _offset, end, record in spool.read_records(path, start):
+                    used = True
+                    epoch_seconds = record_time(record)
+                    batch.setdefault(self.archive_path(epoch_seconds), []).append(
+                        (epoch_seconds, _index_cn(record), spool.encode_json_record(record)))
+                    pending += 1
+                    if pending >= self.batch_size:
+                        self._commit(batch, done, [path, end])
+                        self.records += pending
+                        batch, done, pending = {}, [], 0
+                if used or _nothing_to_lose(path, start):
+                    done.append(path)
+                    self.sources += 1
+                else:
+                    # It may be the only copy of something; someone
+                    # should look at it before it goes.
+                    self.unreadable.append(path)
+            if batch or done:
+                self._commit(batch, done, None)
+                self.records += pending
+        finally:
+            os.close(lock_fd)
+        return self.records
+
+
+def main_work(argv):
+    """
+        Compact the spool named in the config file.
+    """
+    parser = ArgumentParser(description='Compact the client-disconnect metrics spool')
+    parser.add_argument('--conf', type=str, required=True,
+                        help='Config file',
+                        dest='conffile', default=None)
+    parser.add_argument('--archive-dir', type=str, required=False,
+                        help='Where to put archives (overrides metrics-archive-dir)',
+                        dest='archive_dir', default=None)
+    parser.add_argument('--period', type=str, required=False,
+                        choices=sorted(PERIODS),
+                        help='How much time each archive covers',
+                        dest='period', default='hour')
+    parser.add_argument('--batch-size', type=int, required=False,
+                        help='Records per batch',
+                        dest='batch_size', default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args(argv[1:])
+
+    config = openvpn_client_disconnect.ingest_config_from_file([args.conffile])
+    settings = openvpn_client_disconnect.settings_from_config(config, args.conffile)
+    archive_dir = args.archive_dir
+    if archive_dir is None:
+        try:
+            archive_dir = config.get('client-disconnect', 'metrics-archive-dir')
+        except (configparser.NoOptionError,
+                configparser.NoSectionError):
+            pass
+    if not settings['metrics_log_dir']:
+        print('No usable metrics-log-dir configured.')
+        return False
+    if not archive_dir:
+        print('No archive directory given.')
+        return False
+    os.makedirs(archive_dir, exist_ok=True)
+
+    spool_options = settings['spool_options'] or {}
+    compactor = Compactor(settings['metrics_log_dir'], archive_dir, args.period,
+                          args.batch_size,
+                          spool_options.get('segment_max_age', spool.DEFAULT_SEGMENT_MAX_AGE))
+    compactor.run()
+    print(f'Compacted {compactor.records} records from {compactor.sources} spool files.')
+    for path in compactor.unreadable:
+        print(f'Left {path} in place: no records could be read from it.', file=sys.stderr)
+    return True
+
+def main():
+    """ Interface to the outside """
+    if main_work(sys.argv):
+        sys.exit(0)
+    sys.exit(1)
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
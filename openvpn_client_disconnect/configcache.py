@@ -0,0 +1,112 @@
+"""
+    Settings compiled from the config file, cached between hook runs.
+
+    Every hook run would otherwise parse the INI file, literal_eval the
+    metrics list and compile the metric selectors, to arrive at the same
+    settings as last time.  Instead the settings are kept, compiled, as
+    JSON in a cache file, along with the config file's path, inode,
+    size and mtime.  While those still match, a run only has to load
+    that JSON; when they don't, the config is compiled again and the
+    cache rewritten.
+
+    The cache is only trusted if it's owned by us and nobody else can
+    write to it, since it decides what gets logged.
+"""
+import os
+import json
+import openvpn_client_disconnect
+
+CACHE_VERSION = 4
+
+
+def _source_key(conffile):
+    """ What has to match for a cache of conffile to still be good. """
+    stat = os.stat(conffile)
+    return [CACHE_VERSION, os.path.abspath(conffile), stat.st_ino, stat.st_size,
+            stat.st_mtime_ns]
+
+def _writable_dir(path):
+    """ path if it's a directory we can write to, else None. """
+    if path and os.path.isdir(path) and os.access(path, os.W_OK):
+        return path
+    return None
+
+def to_state(settings, config):
+    """ settings, compiled from config, in a form that can be cached. """
+    state = dict(settings)
+    state['metrics_requested'] = settings['metrics_requested'].to_state()
+    # Whether these are usable can change without the config changing,
+    # so keep what was asked for and check again on every load.
+    for key, option in (('metrics_log_dir', 'metrics-log-dir'),
+                        ('detach_queue_dir', 'detach-queue-dir'),
+                        ('profile_dir', 'profile-dir')):
+        state[key] = config.get('client-disconnect', option, fallback=None)
+    return state
+
+def from_state(state):
+    """ The reverse of to_state. """
+    settings = dict(state)
+    settings['metrics_requested'] = openvpn_client_disconnect.MetricSelector.from_state(
+        state['metrics_requested'])
+    settings['metrics_log_dir'] = _writable_dir(state['metrics_log_dir'])
+    settings['profile_dir'] = _writable_dir(state['profile_dir'])
+    # As in settings_from_config, the worker needs a config file to read.
+    settings['detach_queue_dir'] = None
+    if state['conffile']:
+        settings['detach_queue_dir'] = _writable_dir(state['detach_queue_dir'])
+    return settings
+
+def _read_cache(cache_path):
+    """ The cached state in cache_path, or None if there's none we trust. """
+    try:
+        fdesc = os.open(cache_path, os.O_RDONLY | os.O_NOFOLLOW)
+    except OSError:
+        return None
+    try:
+        stat = os.fstat(fdesc)
+        if stat.st_uid != os.geteuid() or stat.st_mode & 0o022:
+            return None
+        with os.fdopen(fdesc, 'r', encoding='utf-8') as filepointer:
+            fdesc = None
+            return json.load(filepointer)
+    except (OSError, ValueError):
+        return None
+    finally:
+        if fdesc is not None:
+            os.close(fdesc)
+
+def _write_cache(cache_path, cached):
+    """ Atomically replace the cache.  Failing to is not an error. """
+    tmp_path = f'{cache_path}.{os.getpid()}'
+    try:
+        fdesc = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600)
+        with os.fdopen(fdesc, 'w', encoding='utf-8') as filepointer:
+            json.dump(cached, filepointer, separators=(',', ':'))
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+def load_settings(conffile, cache_path):
+    """
+        The settings for conffile: from cache_path if it's up to date,
+        otherwise compiled from conffile (and cached for next time).
+    """
+    try:
+        key = _source_key(conffile)
+    except OSError:
+        key = None
+    if key is not None:
+        cached = _read_cache(cache_path)
+        if cached is not None and cached.get('key') == key:
+            try:
+                return from_state(cached['settings'])
+            except (KeyError, TypeError, ValueError):
+                pass
+    config = openvpn_client_disconnect.ingest_config_from_file([conffile])
+    settings = openvpn_client_disconnect.settings_from_config(config, conffile)
+    if key is not None:
+        _write_cache(cache_path, {'key': key, 'settings': to_state(settings, config)})
+    return settings
@@ -0,0 +1,114 @@
+"""
+    Long-running daemon that handles disconnect events on behalf of
+    the client-disconnect hook.
+
+    The hook is forked once per disconnecting client.  When a lot of
+    clients go at once, the cost of starting python, parsing the config
+    and opening syslog for every one of them adds up.  The daemon does
+    that work once and then listens on a unix socket; the hook just
+    forwards its environment and waits for the answer.
+"""
+import sys
+import json
+import socket
+import openvpn_client_disconnect
+
+# How long the hook waits for the daemon to answer before giving up.
+CLIENT_TIMEOUT = 10.0
+
+
+def forward_event(socket_path, environ, timeout=CLIENT_TIMEOUT):
+    """
+        Send the environment to a daemon listening on socket_path.
+        Return the daemon's (success, message) tuple, or None when the
+        daemon could not be reached and the caller should do the work
+        itself.
+    """
+    payload = json.dumps(
+        openvpn_client_disconnect.shareable_environment(environ)).encode('utf-8')
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(socket_path)
+            sock.sendall(payload)
+            sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            # Nobody home (or they hung up on us before reading).
+            # The event was not delivered, so it's safe to redo it locally.
+            return None
+        chunks = []
+        try:
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except OSError:
+            # The event was handed over, but we never heard how it went.
+            # Redoing it locally could double-report, so call it a failure.
+            return False, 'No reply from client-disconnect daemon.'
+    finally:
+        sock.close()
+    try:
+        reply = json.loads(b''.join(chunks).decode('utf-8'))
+        return bool(reply['success']), str(reply.get('message', ''))
+    except (ValueError, KeyError, TypeError):
+        return False, 'Unparseable reply from client-disconnect daemon.'
+
+
+def main_work(argv):
+    """
+        Run the daemon until we are told to stop.
+    """
+    # The hook imports this module to forward events; the server and the
+    # command line are only for the daemon itself.
+    # pylint: disable=import-outside-toplevel
+    import signal
+    from argparse import ArgumentParser
+    from openvpn_client_disconnect import server as daemon_server
+    parser = ArgumentParser(description='Daemon for client-disconnect')
+    parser.add_argument('--conf', type=str, required=True,
+                        help='Config file',
+                        dest='conffile', default=None)
+    parser.add_argument('--socket', type=str, required=True,
+                        help='Unix socket to listen on',
+                        dest='socket_path', default=None)
+    args = parser.parse_args(argv[1:])
+
+    try:
+        server = daemon_server.DisconnectServer(args.socket_path, args.conffile)
+    except OSError as err:
+        print(err, file=sys.stderr)
+        return False
+    # Events sent over a socket transport are queued; don't let them
+    # sit there through a quiet spell.
+    from openvpn_client_disconnect import transport
+    transport.start_flusher()
+
+    def _reload(_signum, _frame):
+        server.reload()
+
+    def _stop(_signum, _frame):
+        # shutdown() blocks until serve_forever returns, so it can't be
+        # called from the thread that's running serve_forever.
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGHUP, _reload)
+    signal.signal(signal.SIGTERM, _stop)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return True
+
+def main():
+    """ Interface to the outside """
+    if main_work(sys.argv):
+        sys.exit(0)
+    sys.exit(1)
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
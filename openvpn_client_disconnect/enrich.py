@@ -0,0 +1,337 @@
+"""
+    Where a client connected from, from a local table of networks.
+
+    A CSV of CIDRs, with whatever else is known about each (site, office,
+    ASN...), is compiled by openvpn-client-disconnect-enrich into a
+    binary table of sorted, non-overlapping address ranges (where
+    networks nest, the most specific one wins).  With enrich-table set,
+    each disconnect mmaps that table and binary-searches it for its
+    trusted_ip, and adds what it finds to both the spool record and the
+    syslog event's details: source_network (the CIDR that matched),
+    and source_<column> for every other column.  That's a few
+    microseconds, and nothing ever leaves the machine.
+
+    IPv4 addresses are kept as IPv4-mapped IPv6 ones, so both live in
+    one table.  The table is replaced atomically when it's recompiled,
+    so a running daemon picks the new one up on its next lookup, and a
+    hook run never sees half of one.
+
+    Table layout (all integers big-endian):
+        magic                   8 bytes
+        ranges, labels          u32 each
+        column names            u32 length, then names joined by '\\n'
+        range starts            16 bytes per range, ascending
+        range ends              16 bytes per range, inclusive
+        range labels            u32 label number per range
+        label offsets           u32 per label, plus one for the end
+        labels                  each network's values, joined by '\\x1f'
+"""
+import os
+import sys
+import mmap
+import bisect
+
+MAGIC = b'OCDCIDR\x01'
+FIELD_PREFIX = 'source_'
+# What the matching CIDR itself is reported as.
+NETWORK_COLUMN = 'network'
+_SEPARATOR = '\x1f'
+_V4_MAPPED = b'\x00' * 10 + b'\xff\xff'
+_V4_MAPPED_INT = 0xffff << 32
+_KEY = 16
+_U32 = 4
+
+
+def address_key(address):
+    """
+        address (a string, IPv4 or IPv6) as 16 bytes that sort the way
+        the addresses do.  Raises ValueError if it isn't an address.
+    """
+    if ':' not in address:
+        parts = address.split('.')
+        if len(parts) == 4 and all(x.isdigit() for x in parts):
+            # bytes() raises ValueError past 255.
+            return _V4_MAPPED + bytes(int(x) for x in parts)
+        raise ValueError(f'Not an IP address: {address!r}')
+    # Only IPv6 pays for importing ipaddress.
+    import ipaddress  # pylint: disable=import-outside-toplevel
+    return ipaddress.IPv6Address(address.split('%', 1)[0]).packed
+
+
+class _Keys():
+    """ One column of 16-byte keys in a table, as a sequence for bisect. """
+    __slots__ = ('_map', '_base', '_count')
+
+    def __init__(self, mapped, base, count):
+        self._map = mapped
+        self._base = base
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        offset = self._base + index * _KEY
+        return self._map[offset:offset + _KEY]
+
+
+class RangeTable():
+    """
+        A compiled table, mmap'ed from path.  Raises OSError if it can't
+        be read and ValueError if it isn't a table.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as filepointer:
+            # An empty file raises ValueError.
+            self._map = mmap.mmap(filepointer.fileno(), 0, access=mmap.ACCESS_READ)
+        mapped = self._map
+        if mapped[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f'{path} is not a compiled network table')
+        pos = len(MAGIC)
+        ranges = int.from_bytes(mapped[pos:pos + _U32], 'big')
+        labels = int.from_bytes(mapped[pos + _U32:pos + 2 * _U32], 'big')
+        names_length = int.from_bytes(mapped[pos + 2 * _U32:pos + 3 * _U32], 'big')
+        pos += 3 * _U32
+        columns = mapped[pos:pos + names_length].decode('utf-8').split('\n')
+        self.fields = tuple(FIELD_PREFIX + x for x in columns)
+        pos += names_length
+        self.starts = _Keys(mapped, pos, ranges)
+        self.ends = _Keys(mapped, pos + ranges * _KEY, ranges)
+        self._range_labels = pos + 2 * ranges * _KEY
+        self._label_offsets = self._range_labels + ranges * _U32
+        self._labels = self._label_offsets + (labels + 1) * _U32
+        self.ranges = ranges
+        self.labels = labels
+        end = self._label_offsets + labels * _U32
+        if len(mapped) < self._labels or \
+                len(mapped) != self._labels + int.from_bytes(mapped[end:end + _U32], 'big'):
+            self.close()
+            raise ValueError(f'{path} is truncated')
+
+    def _u32(self, offset):
+        """ The u32 at offset. """
+        return int.from_bytes(self._map[offset:offset + _U32], 'big')
+
+    def lookup(self, address):
+        """
+            The values for the most specific network containing address
+            (a string), network first, as a tuple; or None.
+        """
+        key = address_key(address)
+        num = bisect.bisect_right(self.starts, key) - 1
+        if num < 0 or self.ends[num] < key:
+            return None
+        label = self._u32(self._range_labels + num * _U32)
+        offset = self._label_offsets + label * _U32
+        start = self._labels + self._u32(offset)
+        end = self._labels + self._u32(offset + _U32)
+        return tuple(self._map[start:end].decode('utf-8').split(_SEPARATOR))
+
+    def fields_for(self, address):
+        """ {source_network: ..., source_<column>: ...} for address; {} if none. """
+        values = self.lookup(address)
+        if values is None:
+            return {}
+        return {name: value for name, value in zip(self.fields, values) if value}
+
+    def close(self):
+        """ Unmap the table. """
+        self._map.close()
+
+
+# The table at each path, as (what os.stat said about it, RangeTable).
+_TABLES = {}
+
+def table_for(path):
+    """ The RangeTable at path, reopened if it's been replaced since. """
+    stat = os.stat(path)
+    key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    cached = _TABLES.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    # The old one is left to be unmapped once nothing is using it.
+    table = RangeTable(path)
+    _TABLES[path] = (key, table)
+    return table
+
+def lookup_fields(path, address):
+    """ The fields to add for a client from address, per the table at path. """
+    return table_for(path).fields_for(address)
+
+
+def read_csv(path):
+    """
+        The networks in a CSV file, as (column names, [(network, values)]).
+
+        The first row names the columns; the first column holds CIDRs
+        and the rest become source_<name> fields, so their names must be
+        lowercase identifiers.  Blank lines and lines starting with #
+        are skipped.  Raises ValueError, with the line, for anything
+        that doesn't parse.
+    """
+    # pylint: disable=import-outside-toplevel
+    import csv
+    import ipaddress
+    with open(path, 'r', encoding='utf-8', newline='') as filepointer:
+        rows = [(num, row) for num, row in enumerate(csv.reader(filepointer), 1)
+                if row and any(row) and not row[0].lstrip().startswith('#')]
+    if not rows:
+        raise ValueError(f'{path}: no header row')
+    columns = [NETWORK_COLUMN] + [x.strip() for x in rows[0][1][1:]]
+    for name in columns[1:]:
+        if not (name.isidentifier() and name.isascii() and name == name.lower()) or \
+                name == NETWORK_COLUMN:
+            raise ValueError(f'{path}: {name!r} is not a usable column name')
+    networks = []
+    for num, row in rows[1:]:
+        if len(row) > len(columns):
+            raise ValueError(f'{path}:{num}: more values than columns')
+        try:
+            network = ipaddress.ip_network(row[0].strip())
+        except ValueError as err:
+            raise ValueError(f'{path}:{num}: {err}') from err
+        values = tuple(x.strip() for x in row[1:])
+        values += ('',) * (len(columns) - 1 - len(values))
+        if any(_SEPARATOR in x or '\n' in x for x in values):
+            raise ValueError(f'{path}:{num}: control characters in a value')
+        networks.append((network, values))
+    return columns, networks
+
+def _address_range(network):
+    """ The first and last addresses of network, as 128-bit integers. """
+    first = int(network.network_address)
+    if network.version == 4:
+        first += _V4_MAPPED_INT
+    return first, first + network.num_addresses - 1
+
+def compile_ranges(networks):
+    """
+        networks ([(ipaddress network, values)]) as sorted, non-overlapping
+        [(first, last, number of the network)], the most specific network
+        winning wherever they nest.  For the same network twice, the later
+        one wins.
+    """
+    spans = sorted(((*_address_range(network), num) for num, (network, _values)
+                    in enumerate(networks)), key=lambda x: (x[0], -x[1], x[2]))
+    ranges = []
+    # The networks containing where we are, innermost last.
+    stack = []
+    cursor = 0
+
+    def _emit(first, last, num):
+        if first <= last:
+            ranges.append((first, last, num))
+
+    for first, last, num in spans:
+        while stack and stack[-1][1] < first:
+            _start, top_last, top_num = stack.pop()
+            _emit(cursor, top_last, top_num)
+            cursor = max(cursor, top_last + 1)
+        if stack:
+            _emit(cursor, first - 1, stack[-1][2])
+        cursor = first
+        stack.append((first, last, num))
+    while stack:
+        _start, top_last, top_num = stack.pop()
+        _emit(cursor, top_last, top_num)
+        cursor = max(cursor, top_last + 1)
+    return ranges
+
+def encode_table(columns, networks):
+    """ The compiled table for read_csv's columns and networks, as bytes. """
+    ranges = compile_ranges(networks)
+    used = sorted(set(x[2] for x in ranges))
+    label_number = {num: pos for pos, num in enumerate(used)}
+    labels = []
+    offsets = [0]
+    for num in used:
+        network, values = networks[num]
+        label = _SEPARATOR.join((str(network),) + values).encode('utf-8')
+        labels.append(label)
+        offsets.append(offsets[-1] + len(label))
+    names = '\n'.join(columns).encode('utf-8')
+    return b''.join([
+        MAGIC,
+        len(ranges).to_bytes(_U32, 'big'),
+        len(used).to_bytes(_U32, 'big'),
+        len(names).to_bytes(_U32, 'big'),
+        names,
+        b''.join(x[0].to_bytes(_KEY, 'big') for x in ranges),
+        b''.join(x[1].to_bytes(_KEY, 'big') for x in ranges),
+        b''.join(label_number[x[2]].to_bytes(_U32, 'big') for x in ranges),
+        b''.join(x.to_bytes(_U32, 'big') for x in offsets),
+    ] + labels)
+
+def compile_csv(csv_path, table_path):
+    """
+        Compile the CSV at csv_path into a table at table_path, replacing
+        any table there atomically.  Return (networks, ranges).
+    """
+    columns, networks = read_csv(csv_path)
+    data = encode_table(columns, networks)
+    tmp_path = f'{table_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as filepointer:
+            filepointer.write(data)
+        os.replace(tmp_path, table_path)
+    except OSError:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    return len(networks), int.from_bytes(data[len(MAGIC):len(MAGIC) + _U32], 'big')
+
+def main_work(argv):
+    """
+        Compile the enrich-table from a CSV, and/or look addresses up in it.
+    """
+    # pylint: disable=import-outside-toplevel
+    import json
+    from argparse import ArgumentParser
+    import openvpn_client_disconnect
+    parser = ArgumentParser(description='Compile the client-disconnect network table')
+    parser.add_argument('--conf', type=str, required=False,
+                        help='Config file, for its enrich-table',
+                        dest='conffile', default=None)
+    parser.add_argument('--table', type=str, required=False,
+                        help='Use this table instead',
+                        dest='table', default=None)
+    parser.add_argument('--csv', type=str, required=False,
+                        help='Compile the table from this CSV of CIDRs',
+                        dest='csv', default=None)
+    parser.add_argument('--lookup', type=str, action='append', required=False,
+                        help='Print what the table says about this address',
+                        dest='lookup', default=[])
+    args = parser.parse_args(argv[1:])
+
+    table = args.table
+    if table is None and args.conffile:
+        config = openvpn_client_disconnect.ingest_config_from_file([args.conffile])
+        table = openvpn_client_disconnect.settings_from_config(
+            config, args.conffile)['enrich_table']
+    if not table:
+        parser.error('Need --table, or a --conf with an enrich-table')
+    if not (args.csv or args.lookup):
+        parser.error('Nothing to do: give --csv and/or --lookup')
+
+    try:
+        if args.csv:
+            networks, ranges = compile_csv(args.csv, table)
+            print(f'{networks} networks compiled into {ranges} ranges in {table}.')
+        for address in args.lookup:
+            print(json.dumps({address: lookup_fields(table, address)}, sort_keys=True))
+    except (OSError, ValueError) as err:
+        print(err, file=sys.stderr)
+        return False
+    return True
+
+def main():
+    """ Interface to the outside """
+    if main_work(sys.argv):
+        sys.exit(0)
+    sys.exit(1)
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,307 @@
+"""
+    A small on-disk write-ahead queue for detached event handling.
+
+    openvpn waits for client-disconnect scripts to finish, and while it
+    waits, no other tunnel on that server gets any attention.  In detach
+    mode the hook only appends the event to a journal file here and
+    returns; a detached worker process does the slow parts later.
+
+    Layout of the queue directory:
+        journal             events are appended here, one JSON per line
+        claimed.<ns>        a journal a worker has taken ownership of
+        claimed.<ns>.offset how far into that claimed journal we've got
+        worker.lock         held by whichever worker is draining
+        spawning            a worker has been started, and hasn't yet
+                            got as far as looking at the journal
+        failed              events the worker couldn't report, in the
+                            journal's format; see below
+
+    Events are handled at least once.  A worker that dies part-way
+    through leaves its claimed journal and offset behind, and the next
+    worker picks up from there; the event that was in flight when it
+    died may be reported twice.
+
+    An event the worker fails to report is appended to 'failed' and
+    logged to syslog (the worker's own output goes nowhere), and the
+    worker carries on with the next one, so one bad event can't hold up
+    the rest.  Once the problem is fixed, appending 'failed' to
+    'journal' queues them again.  If even that append fails, the worker
+    stops where it is, and the event stays in the journal.
+"""
+import os
+import sys
+import json
+import time
+import fcntl
+import openvpn_client_disconnect
+
+JOURNAL = 'journal'
+CLAIMED_PREFIX = 'claimed.'
+OFFSET_SUFFIX = '.offset'
+WORKER_LOCK = 'worker.lock'
+SPAWNING = 'spawning'
+FAILED = 'failed'
+# A spawning marker older than this belongs to a worker that never started.
+STALE_SPAWN_SECONDS = 60
+
+
+def enqueue(queue_dir, environ, fsync=True):
+    """
+        Durably append one event to the journal.
+    """
+    line = json.dumps(openvpn_client_disconnect.shareable_environment(environ),
+                      sort_keys=True, separators=(',', ':')) + '\n'
+    data = line.encode('utf-8')
+    path = os.path.join(queue_dir, JOURNAL)
+    while True:
+        fdesc = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            # A worker may have claimed (renamed) the journal between our
+            # open and our lock.  The shared lock keeps it from reading
+            # until we're done; the inode check makes sure we didn't
+            # write into a journal that's already been drained.
+            fcntl.flock(fdesc, fcntl.LOCK_SH)
+            try:
+                current = os.stat(path)
+            except FileNotFoundError:
+                current = None
+            opened = os.fstat(fdesc)
+            if current is None or (current.st_dev, current.st_ino) != \
+                    (opened.st_dev, opened.st_ino):
+                continue
+            os.write(fdesc, data)
+            if fsync:
+                os.fsync(fdesc)
+            return
+        finally:
+            os.close(fdesc)
+
+def _claim_journal(queue_dir):
+    """
+        Take ownership of the current journal, if there is one.
+        Return the claimed path, or None if there was nothing queued.
+    """
+    path = os.path.join(queue_dir, JOURNAL)
+    claimed = os.path.join(queue_dir, f'{CLAIMED_PREFIX}{time.time_ns()}')
+    try:
+        os.rename(path, claimed)
+    except FileNotFoundError:
+        return None
+    return claimed
+
+def _claimed_journals(queue_dir):
+    """
+        Every claimed journal in the directory, oldest first.
+        These are ours to drain because we hold the worker lock.
+    """
+    names = [name for name in os.listdir(queue_dir)
+             if name.startswith(CLAIMED_PREFIX) and not name.endswith(OFFSET_SUFFIX)]
+    names.sort(key=lambda name: int(name[len(CLAIMED_PREFIX):]))
+    return [os.path.join(queue_dir, name) for name in names]
+
+def _read_offset(offset_path):
+    """ How much of a claimed journal was already handled. """
+    try:
+        with open(offset_path, 'r', encoding='utf-8') as filepointer:
+            return int(filepointer.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+def _write_offset(offset_path, offset):
+    """ Record progress through a claimed journal. """
+    tmp_path = f'{offset_path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as filepointer:
+        filepointer.write(f'{offset}\n')
+    os.replace(tmp_path, offset_path)
+
+def drain_journal(claimed_path, handler):
+    """
+        Feed every event in a claimed journal to handler, then remove it.
+        Return the number of events handed to handler.
+    """
+    offset_path = f'{claimed_path}{OFFSET_SUFFIX}'
+    offset = _read_offset(offset_path)
+    handled = 0
+    with open(claimed_path, 'rb') as filepointer:
+        # Wait out any enqueuer that opened this file before we claimed it.
+        fcntl.flock(filepointer.fileno(), fcntl.LOCK_EX)
+        filepointer.seek(offset)
+        for raw in filepointer:
+            offset += len(raw)
+            if raw.endswith(b'\n'):
+                try:
+                    environ = json.loads(raw.decode('utf-8'))
+                except ValueError:
+                    environ = None
+                if isinstance(environ, dict):
+                    handler(environ)
+                    handled += 1
+            # else: a line torn by a crash mid-append.  It was never
+            # acknowledged to openvpn as queued, so there's nothing to redo.
+            _write_offset(offset_path, offset)
+        os.unlink(claimed_path)
+    try:
+        os.unlink(offset_path)
+    except FileNotFoundError:
+        pass
+    return handled
+
+def _keep_failed(queue_dir, environ, message):
+    """
+        Durably set aside an event we couldn't report, and say so
+        where a human will see it.
+    """
+    path = os.path.join(queue_dir, FAILED)
+    line = json.dumps(environ, sort_keys=True, separators=(',', ':')) + '\n'
+    fdesc = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    try:
+        os.write(fdesc, line.encode('utf-8'))
+        os.fsync(fdesc)
+    finally:
+        os.close(fdesc)
+    import syslog  # pylint: disable=import-outside-toplevel
+    syslog.syslog(syslog.LOG_ERR, f'Could not report the disconnect of '
+                  f'{environ.get("common_name")!r}: {message}; it was added to {path}')
+
+def _try_lock(queue_dir):
+    """
+        Try to become the worker for this queue.
+        Return an open fd holding the lock, or None if someone else has it.
+    """
+    fdesc = os.open(os.path.join(queue_dir, WORKER_LOCK), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(fdesc, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fdesc)
+        return None
+    return fdesc
+
+def worker_running(queue_dir):
+    """ Is some worker currently draining this queue? """
+    fdesc = _try_lock(queue_dir)
+    if fdesc is None:
+        return True
+    os.close(fdesc)
+    return False
+
+def drain(queue_dir, handler):
+    """
+        Drain the queue until it's empty, if nobody else is doing so.
+        Return the number of events handled.
+    """
+    handled = 0
+    while True:
+        lock_fd = _try_lock(queue_dir)
+        if lock_fd is None:
+            # Another worker has it; it will see anything we would have.
+            return handled
+        try:
+            _claim_journal(queue_dir)
+            for claimed in _claimed_journals(queue_dir):
+                handled += drain_journal(claimed, handler)
+        finally:
+            os.close(lock_fd)
+        # An event may have landed after our last claim but while we still
+        # held the lock, in which case its enqueuer didn't start a worker.
+        if not os.path.exists(os.path.join(queue_dir, JOURNAL)):
+            return handled
+
+def spawn_worker(conffile):
+    """
+        Start a worker in its own session, so that it outlives us and
+        openvpn doesn't wait for it.
+    """
+    # Only here: most hook runs find a worker already running.
+    # pylint: disable=import-outside-toplevel
+    import subprocess  # nosec import_subprocess
+    # The arguments are ours, not user-provided.  Not a with block:
+    # that would wait for the worker, which is meant to outlive us.
+    # pylint: disable=consider-using-with
+    subprocess.Popen([sys.executable, '-m', 'openvpn_client_disconnect.eventqueue',  # nosec
+                      '--conf', conffile],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, close_fds=True,
+                     start_new_session=True)
+
+def _claim_spawn(queue_dir):
+    """
+        Mark a worker as being started.  Return False if one already is:
+        until it clears the mark, it's sure to see anything queued now.
+    """
+    marker = os.path.join(queue_dir, SPAWNING)
+    for _ in range(2):
+        try:
+            os.close(os.open(marker, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+            return True
+        except FileExistsError:
+            try:
+                if time.time() - os.stat(marker).st_mtime < STALE_SPAWN_SECONDS:
+                    return False
+                os.unlink(marker)
+            except OSError:
+                # Cleared as we looked; go round again.
+                pass
+    return False
+
+def _clear_spawn(queue_dir):
+    """ We're the worker that was being started; say so. """
+    try:
+        os.unlink(os.path.join(queue_dir, SPAWNING))
+    except OSError:
+        pass
+
+def submit(queue_dir, conffile, environ):
+    """
+        Queue an event, and make sure a worker will get to it.
+    """
+    enqueue(queue_dir, environ)
+    # Until the worker we start holds the lock, every hook run behind us
+    # would start another; the spawning mark stops them.
+    if not worker_running(queue_dir) and _claim_spawn(queue_dir):
+        try:
+            spawn_worker(conffile)
+        except OSError:
+            _clear_spawn(queue_dir)
+            raise
+
+def main_work(argv):
+    """
+        Drain the queue named in the config file.
+    """
+    from argparse import ArgumentParser  # pylint: disable=import-outside-toplevel
+    parser = ArgumentParser(description='Queue worker for client-disconnect')
+    parser.add_argument('--conf', type=str, required=True,
+                        help='Config file',
+                        dest='conffile', default=None)
+    args = parser.parse_args(argv[1:])
+
+    config = openvpn_client_disconnect.ingest_config_from_file([args.conffile])
+    settings = openvpn_client_disconnect.settings_from_config(config, args.conffile)
+    if not settings['detach_queue_dir']:
+        return False
+
+    def _handle(environ):
+        try:
+            success, message = openvpn_client_disconnect.handle_disconnect(
+                settings, environ, detach=False)
+        except Exception as err:  # pylint: disable=broad-except
+            success, message = False, f'{type(err).__name__}: {err}'
+        if not success:
+            # Set it aside rather than wedge the queue for every later
+            # event.  If we can't, this raises, and it stays queued.
+            _keep_failed(settings['detach_queue_dir'], environ, message)
+
+    # Before draining: anything queued before this is in the journal,
+    # and anything queued after it will start a worker if it needs one.
+    _clear_spawn(settings['detach_queue_dir'])
+    drain(settings['detach_queue_dir'], _handle)
+    return True
+
+def main():
+    """ Interface to the outside """
+    if main_work(sys.argv):
+        sys.exit(0)
+    sys.exit(1)
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,143 @@
+"""
+    Cached lookup of this host's FQDN for syslog events.
+
+    socket.getfqdn() can mean a trip to the resolver, and when DNS is
+    slow that's seconds added to every disconnect.  Our FQDN hardly ever
+    changes, so we resolve it once, keep it in a small file shared by
+    every invocation, and refresh it in the background once it's older
+    than the TTL.  A lookup that takes longer than the timeout falls
+    back to socket.gethostname().
+"""
+import os
+import sys
+import json
+import time
+import socket
+
+DEFAULT_TTL = 3600
+DEFAULT_TIMEOUT = 2.0
+# A refresh marker older than this belongs to a refresher that died.
+STALE_REFRESH_SECONDS = 300
+
+
+def resolve_fqdn(timeout=DEFAULT_TIMEOUT):
+    """
+        socket.getfqdn(), but give up after timeout seconds and use
+        socket.gethostname() instead.
+    """
+    import threading  # pylint: disable=import-outside-toplevel
+    result = []
+    # getfqdn can't be interrupted, so it runs in a daemon thread that
+    # we're willing to abandon.
+    worker = threading.Thread(target=lambda: result.append(socket.getfqdn()),
+                              daemon=True)
+    worker.start()
+    worker.join(timeout)
+    if result and result[0]:
+        return result[0]
+    return socket.gethostname()
+
+def _read_cache(cache_file):
+    """
+        Return (fqdn, resolved_at) from the cache, or (None, 0) if there's
+        no usable cache.
+    """
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as filepointer:
+            cached = json.load(filepointer)
+        return str(cached['fqdn']), float(cached['resolved_at'])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None, 0
+
+def _write_cache(cache_file, fqdn):
+    """ Atomically replace the cache contents. """
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as filepointer:
+        json.dump({'fqdn': fqdn, 'resolved_at': time.time()}, filepointer)
+    os.replace(tmp_file, cache_file)
+
+def refresh(cache_file, timeout=DEFAULT_TIMEOUT):
+    """
+        Resolve our name and store it in the cache.  Return the name.
+    """
+    fqdn = resolve_fqdn(timeout)
+    try:
+        _write_cache(cache_file, fqdn)
+    except OSError:
+        # We still have an answer; we just can't share it.
+        pass
+    return fqdn
+
+def _start_background_refresh(cache_file, timeout):
+    """
+        Kick off a detached refresh, unless one is already under way.
+    """
+    marker = f'{cache_file}.refreshing'
+    try:
+        fdesc = os.open(marker, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        try:
+            if time.time() - os.stat(marker).st_mtime < STALE_REFRESH_SECONDS:
+                return
+            os.unlink(marker)
+        except OSError:
+            pass
+        return
+    except OSError:
+        return
+    os.close(fdesc)
+    # pylint: disable=import-outside-toplevel
+    import subprocess  # nosec import_subprocess
+    # The arguments are ours, not user-provided.  Not a with block:
+    # that would wait for the refresh, which is the point of not waiting.
+    # pylint: disable=consider-using-with
+    subprocess.Popen([sys.executable, '-m', 'openvpn_client_disconnect.hostname',  # nosec
+                      '--cache-file', cache_file, '--timeout', str(timeout)],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                     stderr=subprocess.DEVNULL, close_fds=True,
+                     start_new_session=True)
+
+def cached_fqdn(cache_file, ttl=DEFAULT_TTL, timeout=DEFAULT_TIMEOUT):
+    """
+        Our FQDN, from the cache if at all possible.
+        A fresh cache entry is used as-is.  A stale one is still used,
+        and a refresh is started in the background.  Only with no cache
+        at all do we resolve while the caller waits.
+    """
+    fqdn, resolved_at = _read_cache(cache_file)
+    if fqdn is None:
+        return refresh(cache_file, timeout)
+    if time.time() - resolved_at > ttl:
+        _start_background_refresh(cache_file, timeout)
+    return fqdn
+
+def main_work(argv):
+    """
+        Refresh the cache file.  This is what the background refresh runs.
+    """
+    from argparse import ArgumentParser  # pylint: disable=import-outside-toplevel
+    parser = ArgumentParser(description='Refresh the cached FQDN for client-disconnect')
+    parser.add_argument('--cache-file', type=str, required=True,
+                        help='Cache file to refresh',
+                        dest='cache_file', default=None)
+    parser.add_argument('--timeout', type=float, required=False,
+                        help='Seconds to wait for a resolver answer',
+                        dest='timeout', default=DEFAULT_TIMEOUT)
+    args = parser.parse_args(argv[1:])
+    try:
+        refresh(args.cache_file, args.timeout)
+    finally:
+        try:
+            os.unlink(f'{args.cache_file}.refreshing')
+        except OSError:
+            pass
+    return True
+
+def main():
+    """ Interface to the outside """
+    if main_work(sys.argv):
+        sys.exit(0)
+    sys.exit(1)  # pragma: no cover
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
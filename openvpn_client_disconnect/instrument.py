@@ -0,0 +1,280 @@
+"""
+    Timings of each stage of handling a disconnect, for node_exporter.
+
+    Every hook run is its own short-lived process, so the numbers have
+    to be gathered somewhere they all share: a small file of 64-bit
+    counters, mmap'ed by each run.  For each stage (config load, the
+    network lookup, metric filtering, the spool write, the FQDN lookup,
+    the syslog send, and the whole disconnect) there's a count, a sum,
+    an error count and a latency histogram.  A run keeps its
+    observations in memory and adds them to the file in one go at the
+    end, under a flock, so it costs a few microseconds whatever else is
+    running.
+
+    Every instrument-render-interval seconds, whichever run next
+    updates the file also renders it, in the Prometheus text format, to
+    instrument-textfile (for node_exporter's textfile collector).
+    openvpn-client-disconnect-instrument renders it on demand, e.g. from
+    cron on a quiet server.
+"""
+import os
+import sys
+import time
+import mmap
+import fcntl
+import bisect
+# Not threading: it costs the hook several milliseconds to import.
+import _thread
+
+STAGES = ('config', 'enrich', 'filter', 'spool_write', 'fqdn', 'syslog_send', 'total')
+# Upper bounds of the histogram buckets, in seconds; there's a +Inf too.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+METRIC_PREFIX = 'openvpn_client_disconnect'
+
+_MAGIC = 0x4f4344494e535452  # 'OCDINSTR'
+# Bump this whenever STAGES, BUCKETS or the layout change; a file with
+# any other version is started again from zero.
+LAYOUT_VERSION = 2
+# Header slots: magic, layout version, when we last rendered.
+_HEADER = 3
+# Per stage: count, sum of nanoseconds, errors, then the buckets.
+_COUNT, _SUM, _ERRORS, _FIRST_BUCKET = 0, 1, 2, 3
+_STAGE_SLOTS = _FIRST_BUCKET + len(BUCKETS) + 1
+_SLOTS = _HEADER + len(STAGES) * _STAGE_SLOTS
+_SIZE = _SLOTS * 8
+_BOUNDS_NS = [int(x * 1e9) for x in BUCKETS]
+_STAGE_INDEX = {stage: _HEADER + num * _STAGE_SLOTS for num, stage in enumerate(STAGES)}
+
+
+class StageTimer():
+    """
+        Times one stage, as a context manager.  The stage counts as an
+        error if it raises.
+    """
+    __slots__ = ('recorder', 'stage', 'started')
+
+    def __init__(self, recorder, stage):
+        self.recorder = recorder
+        self.stage = stage
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.recorder.observe_ns(self.stage, time.perf_counter_ns() - self.started,
+                                 exc_type is not None)
+        return False
+
+
+class Recorder():
+    """
+        Stage timings for one counter file, and where to render them.
+    """
+    def __init__(self, path, textfile=None, render_interval=60):
+        self.path = path
+        self.textfile = textfile
+        self.render_interval = render_interval
+        # (first slot of the stage, nanoseconds or None, error)
+        self._pending = []
+        self._lock = _thread.allocate_lock()
+
+    def timer(self, stage):
+        """ A context manager that times stage. """
+        return StageTimer(self, stage)
+
+    def observe(self, stage, seconds, error=False):
+        """ Record that stage took seconds. """
+        self.observe_ns(stage, int(seconds * 1e9), error)
+
+    def observe_ns(self, stage, nanoseconds, error=False):
+        """ Record that stage took nanoseconds. """
+        self._pending.append((_STAGE_INDEX[stage], nanoseconds, error))
+
+    def error(self, stage):
+        """ Record that stage failed, without timing it again. """
+        self._pending.append((_STAGE_INDEX[stage], None, True))
+
+    def _open(self):
+        """
+            The counter file, flocked, with a known layout: as (fd, mmap).
+            It's (re)initialised if it's new or not what we expect.
+        """
+        fdesc = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o644)
+        try:
+            fcntl.flock(fdesc, fcntl.LOCK_EX)
+            if os.fstat(fdesc).st_size != _SIZE:
+                os.ftruncate(fdesc, 0)
+                os.ftruncate(fdesc, _SIZE)
+            mapped = mmap.mmap(fdesc, _SIZE)
+        except (OSError, ValueError):
+            os.close(fdesc)
+            raise
+        slots = memoryview(mapped).cast('Q')
+        if slots[0] != _MAGIC or slots[1] != LAYOUT_VERSION:
+            mapped[:] = bytes(_SIZE)
+            slots[0] = _MAGIC
+            slots[1] = LAYOUT_VERSION
+        slots.release()
+        return fdesc, mapped
+
+    def flush(self, now=None):
+        """
+            Add what's been observed to the counter file, and render it
+            if it's due.  Instrumentation failing is not an error: what
+            couldn't be written is dropped.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if not pending:
+                return
+            if now is None:
+                now = int(time.time())
+            snapshot = None
+            try:
+                fdesc, mapped = self._open()
+            except (OSError, ValueError):
+                return
+            try:
+                slots = memoryview(mapped).cast('Q')
+                for base, nanoseconds, error in pending:
+                    if error:
+                        slots[base + _ERRORS] += 1
+                    if nanoseconds is None:
+                        continue
+                    slots[base + _COUNT] += 1
+                    slots[base + _SUM] += max(0, nanoseconds)
+                    slots[base + _FIRST_BUCKET + bisect.bisect_left(_BOUNDS_NS, nanoseconds)] += 1
+                if self.textfile and now - slots[2] >= self.render_interval:
+                    slots[2] = now
+                    snapshot = slots.tolist()
+                slots.release()
+            finally:
+                mapped.close()
+                os.close(fdesc)
+        if snapshot is not None:
+            self._write_textfile(snapshot)
+
+    def snapshot(self):
+        """ The counters as they stand, as a list of slots. """
+        with self._lock:
+            fdesc, mapped = self._open()
+            try:
+                slots = memoryview(mapped).cast('Q')
+                snapshot = slots.tolist()
+                slots.release()
+            finally:
+                mapped.close()
+                os.close(fdesc)
+        return snapshot
+
+    def stats(self):
+        """ The counters as they stand, as a dict per stage. """
+        return stats_from_slots(self.snapshot())
+
+    def render(self, textfile=None):
+        """ Render the counters to textfile (or ours) now. """
+        self._write_textfile(self.snapshot(), textfile)
+
+    def _write_textfile(self, snapshot, textfile=None):
+        """ Atomically replace the textfile; failing to is not an error. """
+        textfile = textfile or self.textfile
+        tmp_path = f'{textfile}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as filepointer:
+                filepointer.write(render_text(stats_from_slots(snapshot)))
+            os.replace(tmp_path, textfile)
+        except OSError:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+
+def stats_from_slots(slots):
+    """
+        {stage: {'count', 'sum' (seconds), 'errors', 'buckets'}} from a
+        snapshot, buckets being per-bucket (not cumulative) counts with
+        the +Inf one last.
+    """
+    stats = {}
+    for stage, base in _STAGE_INDEX.items():
+        stats[stage] = {
+            'count': slots[base + _COUNT],
+            'sum': slots[base + _SUM] / 1e9,
+            'errors': slots[base + _ERRORS],
+            'buckets': slots[base + _FIRST_BUCKET:base + _STAGE_SLOTS],
+        }
+    return stats
+
+def render_text(stats):
+    """ stats, in the Prometheus text exposition format. """
+    name = f'{METRIC_PREFIX}_stage_seconds'
+    lines = [f'# HELP {name} Time spent in each stage of handling a disconnect.',
+             f'# TYPE {name} histogram']
+    for stage, stage_stats in stats.items():
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), stage_stats['buckets']):
+            cumulative += count
+            lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_sum{{stage="{stage}"}} {stage_stats["sum"]:.9f}')
+        lines.append(f'{name}_count{{stage="{stage}"}} {stage_stats["count"]}')
+    name = f'{METRIC_PREFIX}_stage_errors_total'
+    lines += [f'# HELP {name} Stages of handling a disconnect that failed.',
+              f'# TYPE {name} counter']
+    for stage, stage_stats in stats.items():
+        lines.append(f'{name}{{stage="{stage}"}} {stage_stats["errors"]}')
+    return '\n'.join(lines) + '\n'
+
+# One recorder per counter file, for processes that handle many events.
+_RECORDERS = {}
+
+def recorder_for(settings):
+    """ The Recorder that settings ask for, or None. """
+    if not settings.get('instrument_file'):
+        return None
+    key = (settings['instrument_file'], settings.get('instrument_textfile'),
+           settings.get('instrument_render_interval', 60))
+    recorder = _RECORDERS.get(key)
+    if recorder is None:
+        recorder = _RECORDERS[key] = Recorder(*key)
+    return recorder
+
+def main_work(argv):
+    """
+        Render the counters named in the config file, now.
+    """
+    # pylint: disable=import-outside-toplevel
+    from argparse import ArgumentParser
+    import openvpn_client_disconnect
+    parser = ArgumentParser(description='Render client-disconnect stage timings '
+                                        'for node_exporter')
+    parser.add_argument('--conf', type=str, required=True,
+                        help='Config file',
+                        dest='conffile', default=None)
+    parser.add_argument('--output', type=str, required=False,
+                        help='Write here instead of the configured instrument-textfile',
+                        dest='output', default=None)
+    args = parser.parse_args(argv[1:])
+
+    config = openvpn_client_disconnect.ingest_config_from_file([args.conffile])
+    settings = openvpn_client_disconnect.settings_from_config(config, args.conffile)
+    recorder = recorder_for(settings)
+    textfile = args.output or settings['instrument_textfile']
+    if recorder is None or not textfile:
+        print('instrument-file and instrument-textfile (or --output) must be set.',
+              file=sys.stderr)
+        return False
+    recorder.render(textfile)
+    return True
+
+def main():
+    """ Interface to the outside """
+    if main_work(sys.argv):
+        sys.exit(0)
+    sys.exit(1)
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,269 @@
+"""
+    Simulate a disconnect storm against the hook.
+
+    When an openvpn server restarts, or the network blips, every client
+    disconnects at once and openvpn runs the client-disconnect hook for
+    each of them, one after another, blocked until each finishes.  This
+    replays N synthetic disconnects (see synthetic.py) against the hook
+    command, at a chosen concurrency (roughly, how many openvpn
+    instances share the box) and arrival rate, and reports:
+
+      - how long each invocation kept openvpn waiting (the hook's wall
+        time), as a distribution, and in total;
+      - throughput;
+      - how many files ended up in the metrics spool;
+      - how many syslog events had reached a local stand-in collector by
+        the time the last hook exited, and how many were still on their
+        way (e.g. queued for a detached worker).
+
+    Unless --conf is given, a config is made up that spools to a scratch
+    directory and sends syslog events to the stand-in.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+from argparse import ArgumentParser
+from openvpn_client_disconnect import synthetic
+from openvpn_client_disconnect.standins import SyslogCollector
+
+
+def percentile(ordered, fraction):
+    """ The value fraction (0-1) of the way through a sorted list. """
+    if not ordered:
+        return None
+    position = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[position]
+
+def hook_command():
+    """ The installed hook, or failing that, this python running it. """
+    script = shutil.which('openvpn-client-disconnect')
+    if script:
+        return [script]
+    return [sys.executable, '-c',
+            'import openvpn_client_disconnect; openvpn_client_disconnect.main()']
+
+def count_spool_files(spool_dir):
+    """ Files in the spool, in any layout, not counting hidden ones. """
+    count = 0
+    for _dirpath, dirnames, filenames in os.walk(spool_dir):
+        dirnames[:] = [x for x in dirnames if not x.startswith('.')]
+        count += len([x for x in filenames if not x.startswith('.')])
+    return count
+
+def write_config(workdir, spool_dir, syslog_target, spool_format='files', detach=False):
+    """ A config for a storm; return its path. """
+    lines = ['[client-disconnect]',
+             f'metrics-log-dir = {spool_dir}',
+             f'metrics = {synthetic.EXAMPLE_METRICS!r}',
+             f'metrics-spool-format = {spool_format}',
+             # Don't let a slow resolver be what gets measured.
+             f'hostname-cache-file = {os.path.join(workdir, "fqdn.cache")}']
+    if syslog_target:
+        lines += ['syslog-events-send = true',
+                  f'syslog-events-transport = {syslog_target}']
+    if detach:
+        queue_dir = os.path.join(workdir, 'queue')
+        os.makedirs(queue_dir, exist_ok=True)
+        lines.append(f'detach-queue-dir = {queue_dir}')
+    conffile = os.path.join(workdir, 'storm.conf')
+    with open(conffile, 'w', encoding='utf-8') as filepointer:
+        filepointer.write('\n'.join(lines) + '\n')
+    return conffile
+
+
+class Storm():
+    """
+        One storm: count disconnects, run by concurrency workers, with
+        the i'th arriving at i / rate seconds (all at once if rate is 0).
+    """
+    def __init__(self, command, count, concurrency=1, rate=0.0, seed=0, base_env=None):
+        self.command = command
+        self.count = count
+        self.concurrency = max(1, concurrency)
+        self.rate = rate
+        self.seed = seed
+        if base_env is None:
+            base_env = {key: os.environ[key] for key in ('PATH', 'PYTHONPATH', 'HOME')
+                        if key in os.environ}
+        self.base_env = base_env
+        # (index, worker, latency seconds, lateness seconds, exit status)
+        self.results = []
+        self.wall = 0.0
+        self._lock = threading.Lock()
+
+    def _worker(self, worker, environs, next_index, start):
+        """ Run hooks until there are none left. """
+        while True:
+            with self._lock:
+                index = next_index[0]
+                next_index[0] += 1
+            if index >= self.count:
+                return
+            due = start + (index / self.rate if self.rate else 0)
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            began = time.monotonic()
+            status = subprocess.run(self.command, env=dict(self.base_env, **environs[index]),
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                    check=False).returncode
+            latency = time.monotonic() - began
+            with self._lock:
+                self.results.append((index, worker, latency, max(0.0, began - due), status))
+
+    def run(self):
+        """ Run the storm; return self. """
+        environs = list(synthetic.environments(self.count, self.seed))
+        next_index = [0]
+        start = time.monotonic()
+        workers = [threading.Thread(target=self._worker,
+                                    args=(worker, environs, next_index, start))
+                   for worker in range(self.concurrency)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.wall = time.monotonic() - start
+        return self
+
+    def report(self):
+        """ The latency distribution, throughput and failures, as a dict. """
+        latencies = sorted(x[2] for x in self.results)
+        lateness = sorted(x[3] for x in self.results)
+        total = sum(latencies)
+        per_worker = [0.0] * self.concurrency
+        for _index, worker, latency, _late, _status in self.results:
+            per_worker[worker] += latency
+
+        def _ms(value):
+            return None if value is None else round(value * 1000, 3)
+
+        return {
+            'invocations': len(self.results),
+            'failures': len([x for x in self.results if x[4] != 0]),
+            'concurrency': self.concurrency,
+            'rate': self.rate,
+            'wall_seconds': round(self.wall, 3),
+            'throughput_per_second': (round(len(self.results) / self.wall, 1)
+                                      if self.wall else None),
+            'stall_seconds_total': round(total, 3),
+            # Each worker stands for one openvpn; this is the longest any
+            # of them would have been blocked.
+            'stall_seconds_per_instance': round(max(per_worker), 3),
+            'latency_ms': {
+                'mean': _ms(total / len(latencies)) if latencies else None,
+                'p50': _ms(percentile(latencies, 0.5)),
+                'p90': _ms(percentile(latencies, 0.9)),
+                'p99': _ms(percentile(latencies, 0.99)),
+                'max': _ms(latencies[-1] if latencies else None),
+            },
+            # How far behind the arrival schedule the workers fell.
+            'lateness_ms_p99': _ms(percentile(lateness, 0.99)),
+        }
+
+
+def main_work(argv):
+    """
+        Run a storm, print the report; False if it missed --target-stall.
+    """
+    parser = ArgumentParser(description='Simulate a disconnect storm against the hook')
+    parser.add_argument('--count', type=int, required=False,
+                        help='How many clients disconnect',
+                        dest='count', default=1000)
+    parser.add_argument('--concurrency', type=int, required=False,
+                        help='How many hooks run at once (openvpn instances)',
+                        dest='concurrency', default=1)
+    parser.add_argument('--rate', type=float, required=False,
+                        help='Disconnects per second (0: all at once)',
+                        dest='rate', default=0.0)
+    parser.add_argument('--seed', type=int, required=False,
+                        help='Seed for the synthetic environments',
+                        dest='seed', default=0)
+    parser.add_argument('--conf', type=str, required=False,
+                        help='Use this config instead of a made-up one',
+                        dest='conffile', default=None)
+    parser.add_argument('--spool-dir', type=str, required=False,
+                        help='With --conf, the spool to count files in',
+                        dest='spool_dir', default=None)
+    parser.add_argument('--spool-format', type=str, required=False,
+                        choices=['files', 'segments'],
+                        help='Spool format for the made-up config',
+                        dest='spool_format', default='files')
+    parser.add_argument('--detach', action='store_true',
+                        help='Have the made-up config queue events for a detached worker',
+                        dest='detach')
+    parser.add_argument('--syslog', type=str, required=False,
+                        choices=['udp', 'tcp', 'unix', 'none'],
+                        help='How the stand-in collector listens',
+                        dest='syslog', default='udp')
+    parser.add_argument('--hook-arg', type=str, action='append',
+                        help='Extra argument for the hook (may be repeated)',
+                        dest='hook_args', default=[])
+    parser.add_argument('--settle', type=float, required=False,
+                        help='Seconds to wait for stragglers after the last hook exits',
+                        dest='settle', default=5.0)
+    parser.add_argument('--target-stall', type=float, required=False,
+                        help='Fail if any instance was blocked longer than this many seconds',
+                        dest='target_stall', default=None)
+    parser.add_argument('--output', type=str, required=False,
+                        help='Write the report here as JSON',
+                        dest='output', default=None)
+    args = parser.parse_args(argv[1:])
+
+    workdir = tempfile.mkdtemp(prefix='ocd-storm.')
+    collector = None
+    try:
+        conffile = args.conffile
+        spool_dir = args.spool_dir
+        if conffile is None:
+            spool_dir = os.path.join(workdir, 'spool')
+            os.mkdir(spool_dir)
+            if args.syslog != 'none':
+                collector = SyslogCollector(
+                    args.syslog, os.path.join(workdir, 'log') if args.syslog == 'unix' else None)
+            conffile = write_config(workdir, spool_dir, collector and collector.target,
+                                    args.spool_format, args.detach)
+        command = hook_command() + ['--conf', conffile] + args.hook_args
+        storm = Storm(command, args.count, args.concurrency, args.rate, args.seed).run()
+        report = storm.report()
+        if spool_dir:
+            report['spool_files'] = count_spool_files(spool_dir)
+        if collector is not None:
+            report['syslog_received'] = len(collector.messages)
+            report['syslog_backlog'] = args.count - report['syslog_received']
+            collector.wait_for(args.count, args.settle)
+            report['syslog_received_after_settle'] = len(collector.messages)
+        elif args.detach:
+            time.sleep(args.settle)
+        if spool_dir:
+            # Detached workers may still have been writing.
+            report['spool_files_after_settle'] = count_spool_files(spool_dir)
+    finally:
+        if collector is not None:
+            collector.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(report, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as filepointer:
+            json.dump(report, filepointer, indent=2, sort_keys=True)
+    if args.target_stall is not None and \
+            report['stall_seconds_per_instance'] > args.target_stall:
+        print(f'Stall of {report["stall_seconds_per_instance"]}s per instance is over the '
+              f'{args.target_stall}s target.', file=sys.stderr)
+        return False
+    return report['failures'] == 0
+
+def main():
+    """ Interface to the outside """
+    if main_work(sys.argv):
+        sys.exit(0)
+    sys.exit(1)
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
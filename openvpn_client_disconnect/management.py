@@ -0,0 +1,280 @@
+"""
+    Report disconnects from openvpn's management interface, instead of
+    from a client-disconnect script.
+
+    The script hook costs a fork and a python startup per disconnect.
+    This connects to the management interface of one or more openvpn
+    instances (TCP or unix socket) and watches for
+
+        >CLIENT:DISCONNECT,{CID}
+        >CLIENT:ENV,name=value
+        ...
+        >CLIENT:ENV,END
+
+    notifications.  The environment in them is the same one the script
+    would have been given, so each one goes through handle_disconnect,
+    with the same metrics filtering and syslog event as the hook.  That
+    happens on a worker thread per interface, in the order they came
+    in, so a slow spool or syslog never holds up reading (or answering)
+    the interface.  Our hostname is looked up once, at startup, unless
+    hostname-cache-file says otherwise.
+
+    openvpn only sends >CLIENT notifications when it runs with
+    --management-client-auth, and then it waits for the management
+    client to allow each connecting client.  If nothing else is doing
+    that, --approve-connections answers every CONNECT/REAUTH with
+    client-auth-nt.  Only do that where authentication is already
+    handled elsewhere (e.g. by an auth-user-pass-verify plugin).
+"""
+import sys
+import signal
+import asyncio
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import openvpn_client_disconnect
+from openvpn_client_disconnect import hostname, transport
+
+# >CLIENT notifications that are followed by a >CLIENT:ENV block.
+ENV_NOTIFICATIONS = ('CONNECT', 'REAUTH', 'ESTABLISHED', 'DISCONNECT')
+READ_SIZE = 65536
+MAX_RECONNECT_DELAY = 30.0
+
+
+def parse_address(target):
+    """
+        Split a management address into (kind, address): 'unix' and a
+        path for unix:/path (or a bare /path), 'tcp' and (host, port)
+        for host:port.
+    """
+    if target.startswith('unix:'):
+        return 'unix', target[len('unix:'):]
+    if target.startswith('/'):
+        return 'unix', target
+    host, _, port = target.rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError(f'Unparseable management address {target!r}')
+    return 'tcp', (host.strip('[]'), int(port))
+
+
+class NotificationParser():
+    """
+        Assemble management interface lines into client notifications.
+    """
+    def __init__(self):
+        # (kind, args, environ) of a notification whose ENV block
+        # hasn't ended yet.
+        self._pending = None
+
+    def feed(self, line):
+        """
+            Take one line (without its line ending).  Return
+            (kind, args, environ) when that completes a >CLIENT
+            notification, otherwise None.
+        """
+        if not line.startswith('>CLIENT:'):
+            return None
+        kind, _, rest = line[len('>CLIENT:'):].partition(',')
+        if kind == 'ENV':
+            if self._pending is None:
+                return None
+            if rest == 'END':
+                notification, self._pending = self._pending, None
+                return notification
+            name, _, value = rest.partition('=')
+            self._pending[2][name] = value
+            return None
+        args = rest.split(',') if rest else []
+        if kind in ENV_NOTIFICATIONS:
+            self._pending = (kind, args, {})
+            return None
+        return kind, args, {}
+
+
+class ManagementListener():
+    """
+        Watch one openvpn management interface, reconnecting whenever
+        the connection goes away.
+    """
+    def __init__(self, target, settings, password=None, approve=False,
+                 reconnect_delay=1.0):
+        self.target = target
+        self.kind, self.address = parse_address(target)
+        self.settings = settings
+        self.password = password
+        self.approve = approve
+        self.reconnect_delay = reconnect_delay
+        self.events = 0
+        self.failures = 0
+        self.sessions = 0
+        # One thread, so disconnects are reported in order.
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix=f'disconnect {target}')
+
+    async def _open(self):
+        """ Connect; return (reader, writer). """
+        if self.kind == 'unix':
+            return await asyncio.open_unix_connection(self.address)
+        return await asyncio.open_connection(*self.address)
+
+    def process_disconnect(self, environ):
+        """ Report one disconnect.  This runs on the worker thread. """
+        try:
+            success, message = openvpn_client_disconnect.handle_disconnect(
+                self.settings, environ, detach=False)
+        except Exception as err:  # pylint: disable=broad-except
+            # One bad event must not stop us listening for everyone else.
+            success, message = False, f'client-disconnect error: {err}'
+        if success:
+            self.events += 1
+        else:
+            self.failures += 1
+            print(f'{self.target}: {message}', file=sys.stderr)
+
+    def handle(self, kind, args, environ):
+        """
+            Deal with one notification.  Return the command to send
+            back, or None.
+        """
+        if kind == 'DISCONNECT':
+            asyncio.get_running_loop().run_in_executor(self._executor,
+                                                       self.process_disconnect, environ)
+        elif kind in ('CONNECT', 'REAUTH') and self.approve and len(args) >= 2:
+            return f'client-auth-nt {args[0]} {args[1]}'
+        return None
+
+    async def session(self):
+        """
+            One connection to the management interface, until it closes.
+        """
+        reader, writer = await self._open()
+        self.sessions += 1
+        parser = NotificationParser()
+        buf = b''
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    return
+                *lines, buf = (buf + data).split(b'\n')
+                commands = []
+                for raw in lines:
+                    notification = parser.feed(raw.decode('utf-8', 'replace').rstrip('\r'))
+                    if notification is not None:
+                        command = self.handle(*notification)
+                        if command is not None:
+                            commands.append(f'{command}\r\n')
+                if buf.startswith(b'ENTER PASSWORD:'):
+                    # The password prompt has no line ending.
+                    commands.append(f'{self.password or ""}\r\n')
+                    buf = b''
+                if commands:
+                    writer.write(''.join(commands).encode('utf-8'))
+                    await writer.drain()
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def run(self):
+        """
+            Listen until cancelled.  Connection failures are retried,
+            backing off to MAX_RECONNECT_DELAY.
+        """
+        delay = self.reconnect_delay
+        while True:
+            sessions = self.sessions
+            try:
+                await self.session()
+            except OSError as err:
+                print(f'{self.target}: {err}', file=sys.stderr)
+            if self.sessions != sessions:
+                # We did get connected; start the backoff over.
+                delay = self.reconnect_delay
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def close(self):
+        """ Wait for every disconnect we've been told about to be reported. """
+        self._executor.shutdown(wait=True)
+
+
+def settings_for_listening(settings):
+    """
+        settings, with our hostname looked up now for every event to use,
+        unless there's a hostname cache to keep it fresh.
+    """
+    if not settings.get('event_send') or settings.get('hostname_cache_file'):
+        return settings
+    return dict(settings, event_hostname=hostname.resolve_fqdn(
+        settings.get('hostname_lookup_timeout', hostname.DEFAULT_TIMEOUT)))
+
+
+async def serve(listeners, conffile):
+    """
+        Run listeners until SIGTERM/SIGINT.  SIGHUP rereads conffile.
+    """
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+
+    def _reload():
+        config = openvpn_client_disconnect.ingest_config_from_file([conffile])
+        settings = settings_for_listening(
+            openvpn_client_disconnect.settings_from_config(config, conffile))
+        for listener in listeners:
+            listener.settings = settings
+
+    loop.add_signal_handler(signal.SIGHUP, _reload)
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    loop.add_signal_handler(signal.SIGINT, stopping.set)
+    tasks = [asyncio.create_task(listener.run()) for listener in listeners]
+    await stopping.wait()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for listener in listeners:
+        await loop.run_in_executor(None, listener.close)
+
+def main_work(argv):
+    """
+        Listen to the management interfaces named on the command line.
+    """
+    parser = ArgumentParser(description='Report disconnects from openvpn management interfaces')
+    parser.add_argument('--conf', type=str, required=True,
+                        help='Config file',
+                        dest='conffile', default=None)
+    parser.add_argument('--management', type=str, required=True, action='append',
+                        help='Management interface, as host:port or unix:/path; '
+                             'give more than once for several openvpn instances',
+                        dest='targets', default=None)
+    parser.add_argument('--password-file', type=str, required=False,
+                        help='File whose first line is the management password',
+                        dest='password_file', default=None)
+    parser.add_argument('--approve-connections', action='store_true',
+                        help='Answer client CONNECT/REAUTH with client-auth-nt',
+                        dest='approve')
+    args = parser.parse_args(argv[1:])
+
+    password = None
+    if args.password_file:
+        with open(args.password_file, 'r', encoding='utf-8') as filepointer:
+            password = filepointer.readline().rstrip('\r\n')
+    config = openvpn_client_disconnect.ingest_config_from_file([args.conffile])
+    settings = settings_for_listening(
+        openvpn_client_disconnect.settings_from_config(config, args.conffile))
+    listeners = [ManagementListener(target, settings, password, args.approve)
+                 for target in args.targets]
+    # Events sent over a socket transport are queued; don't let them
+    # sit there through a quiet spell.
+    transport.start_flusher()
+    asyncio.run(serve(listeners, args.conffile))
+    return True
+
+def main():
+    """ Interface to the outside """
+    if main_work(sys.argv):
+        sys.exit(0)
+    sys.exit(1)  # pragma: no cover
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,226 @@
+"""
+    Sampled profiles of hook runs, and merging them into one report.
+
+    Each hook run lives for a few milliseconds, so no profiler that's
+    pointed at a running process ever sees one, let alone a slow one.
+    Instead, with profile-dir set, one run in profile-sample-rate handles
+    its disconnect under cProfile and leaves the stats in profile-dir.
+    openvpn-client-disconnect-profile merges however many have piled up
+    into one ranked report, and a collapsed-stack file for flamegraph.pl
+    (or speedscope, etc).
+
+    Whether to profile can't be known until the config has been read,
+    so the config load itself isn't profiled; its wall time goes into
+    each profile as a '<load settings>' entry of its own.  Everything
+    the run imports from then on (spool, json, socket, syslog...) is
+    in the profile, under importlib.
+"""
+import os
+import sys
+import time
+import marshal
+
+# How the config load shows up in profiles.
+SETTINGS_LOAD = ('~', 0, '<load settings>')
+PROFILE_SUFFIX = '.prof'
+
+
+def sampled(rate):
+    """ Whether this is the 1 run in rate to profile (never, if rate < 1). """
+    if rate < 1:
+        return False
+    # Not random: it costs the hook milliseconds to import.
+    return int.from_bytes(os.urandom(4), 'big') % rate == 0
+
+def save(profiler, profile_dir, settings_seconds=None):
+    """
+        Write profiler's stats to a new file in profile_dir; return its
+        path, or None if it couldn't be written.
+    """
+    profiler.create_stats()
+    stats = profiler.stats
+    if settings_seconds is not None:
+        stats[SETTINGS_LOAD] = (1, 1, settings_seconds, settings_seconds, {})
+    name = f'{time.time_ns()}.{os.getpid()}{PROFILE_SUFFIX}'
+    # Hidden until it's complete, so a merge never reads half of it.
+    tmp_path = os.path.join(profile_dir, f'.{name}')
+    path = os.path.join(profile_dir, name)
+    try:
+        with open(tmp_path, 'wb') as filepointer:
+            marshal.dump(stats, filepointer)
+        os.rename(tmp_path, path)
+    except OSError:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        return None
+    return path
+
+def run_sampled(settings, settings_seconds, func, *args):
+    """
+        func(*args), under cProfile if this run is sampled, saving the
+        profile into settings['profile_dir'].  settings_seconds is how
+        long loading settings took.
+    """
+    if not sampled(settings['profile_sample_rate']):
+        return func(*args)
+    import cProfile  # pylint: disable=import-outside-toplevel
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        save(profiler, settings['profile_dir'], settings_seconds)
+
+def profile_paths(profile_dir):
+    """ The finished profiles in profile_dir, oldest first. """
+    return sorted(os.path.join(profile_dir, x) for x in os.listdir(profile_dir)
+                  if x.endswith(PROFILE_SUFFIX) and not x.startswith('.'))
+
+def merge(paths):
+    """
+        The profiles in paths, added together, as (pstats.Stats or None,
+        paths merged, paths that couldn't be read).
+    """
+    import pstats  # pylint: disable=import-outside-toplevel
+    merged = None
+    used = []
+    bad = []
+    for path in paths:
+        try:
+            if merged is None:
+                merged = pstats.Stats(path, stream=sys.stdout)
+            else:
+                merged.add(path)
+            used.append(path)
+        except (OSError, EOFError, ValueError, TypeError):
+            bad.append(path)
+    return merged, used, bad
+
+def _frame_name(func):
+    """ A function, as a frame in a collapsed stack. """
+    filename, line, name = func
+    if filename == '~':
+        label = name
+    else:
+        label = f'{name} ({os.path.basename(filename)}:{line})'
+    # Only the last space on a line is special, so spaces can stay.
+    return label.replace(';', ',')
+
+def collapsed_stacks(stats, min_microseconds=1):
+    """
+        {stack: microseconds} for a flamegraph, from pstats-style stats.
+
+        cProfile only keeps who called whom, not whole stacks, so they
+        are rebuilt: a function's time is split between its callers in
+        proportion to the time each spent calling it.  Stacks are
+        followed down from the functions nothing called; recursion is
+        cut off where a function reappears, and anything under
+        min_microseconds is left out.
+    """
+    callees = {}
+    for func, (_cc, _nc, _tt, _ct, callers) in stats.items():
+        for caller, edge in callers.items():
+            if isinstance(edge, tuple):
+                callees.setdefault(caller, []).append((func, edge[3]))
+    stacks = {}
+
+    def _walk(func, path, names, fraction):
+        own = stats[func][2]
+        names = names + [_frame_name(func)]
+        own = own * fraction * 1e6
+        if own >= min_microseconds:
+            key = ';'.join(names)
+            stacks[key] = stacks.get(key, 0) + own
+        for callee, edge_time in callees.get(func, []):
+            callee_time = stats[callee][3]
+            if callee in path or callee_time <= 0 or \
+                    edge_time * fraction * 1e6 < min_microseconds:
+                continue
+            _walk(callee, path | {callee}, names, fraction * edge_time / callee_time)
+
+    for func, value in stats.items():
+        if not value[4]:
+            _walk(func, frozenset([func]), [], 1.0)
+    return stacks
+
+def write_collapsed(stats, path):
+    """ Write collapsed_stacks(stats) to path, one 'a;b;c microseconds' a line. """
+    stacks = collapsed_stacks(stats)
+    with open(path, 'w', encoding='utf-8') as filepointer:
+        for stack in sorted(stacks):
+            filepointer.write(f'{stack} {int(round(stacks[stack]))}\n')
+
+def main_work(argv):
+    """
+        Merge the sampled profiles into a report.
+    """
+    # pylint: disable=import-outside-toplevel
+    from argparse import ArgumentParser
+    import openvpn_client_disconnect
+    parser = ArgumentParser(description='Merge sampled client-disconnect profiles')
+    parser.add_argument('--conf', type=str, required=False,
+                        help='Config file, for its profile-dir',
+                        dest='conffile', default=None)
+    parser.add_argument('--profile-dir', type=str, required=False,
+                        help='Merge the profiles here instead',
+                        dest='profile_dir', default=None)
+    parser.add_argument('--sort', type=str, required=False,
+                        choices=['cumulative', 'tottime', 'ncalls'],
+                        help='What to rank functions by',
+                        dest='sort', default='cumulative')
+    parser.add_argument('--limit', type=int, required=False,
+                        help='How many functions to list',
+                        dest='limit', default=40)
+    parser.add_argument('--output', type=str, required=False,
+                        help='Write the report here rather than to stdout',
+                        dest='output', default=None)
+    parser.add_argument('--collapsed', type=str, required=False,
+                        help='Also write collapsed stacks, for flamegraph.pl, here',
+                        dest='collapsed', default=None)
+    parser.add_argument('--clean', action='store_true',
+                        help='Delete the profiles once merged',
+                        dest='clean')
+    args = parser.parse_args(argv[1:])
+
+    profile_dir = args.profile_dir
+    if profile_dir is None and args.conffile:
+        config = openvpn_client_disconnect.ingest_config_from_file([args.conffile])
+        profile_dir = openvpn_client_disconnect.settings_from_config(
+            config, args.conffile)['profile_dir']
+    if not profile_dir:
+        parser.error('Need --profile-dir, or a --conf with a usable profile-dir')
+
+    merged, used, bad = merge(profile_paths(profile_dir))
+    if merged is None:
+        print(f'No profiles in {profile_dir}.', file=sys.stderr)
+        return False
+    output = sys.stdout
+    if args.output:
+        output = open(args.output, 'w', encoding='utf-8')  # pylint: disable=consider-using-with
+    try:
+        output.write(f'{len(used)} profiles merged from {profile_dir}'
+                     f'{f", {len(bad)} unreadable" if bad else ""}.\n')
+        merged.stream = output
+        merged.sort_stats(args.sort).print_stats(args.limit)
+    finally:
+        if args.output:
+            output.close()
+    if args.collapsed:
+        write_collapsed(merged.stats, args.collapsed)
+    if args.clean:
+        for path in used + bad:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+    return True
+
+def main():
+    """ Interface to the outside """
+    if main_work(sys.argv):
+        sys.exit(0)
+    sys.exit(1)
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
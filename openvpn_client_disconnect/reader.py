@@ -0,0 +1,452 @@
+"""
+    Query the metrics spool (and its archives) through an index.
+
+    Answering "every disconnect for this CN last week" by globbing and
+    parsing every spool file gets slower every day.  Instead, we keep a
+    sqlite index of where each record lives, with its CN, its time_unix
+    (and the hour that falls in), and the values of a few fields that
+    are commonly asked about (INDEXED_FIELDS).  The index is brought up
+    to date incrementally: only files it hasn't seen, and the new tails
+    of files that have grown, are read.
+
+    A record keeps its index id when compaction moves it from the spool
+    into an archive, since records are identified by a digest of their
+    contents.  So ids only ever go up as new records arrive, which makes
+    them usable as a resume point by anything consuming records.  The
+    flip side is that two records with identical contents are only
+    indexed once.
+
+    A refresh holds compaction's lock (shared), so it never sees a batch
+    half-written, and only indexes as much of an archive as its .idx
+    covers: compaction writes that once the archive is synced, so an
+    archive's tail that a dead compaction will roll back is left alone.
+"""
+import os
+import sys
+import ast
+import json
+import gzip
+import zlib
+import fcntl
+import sqlite3
+import hashlib
+import datetime
+from argparse import ArgumentParser
+import configparser
+import openvpn_client_disconnect
+from openvpn_client_disconnect import spool
+from openvpn_client_disconnect import compact
+
+INDEXED_FIELDS = ('IV_VER', 'IV_GUI_VER', 'IV_PLAT')
+BUCKET_SECONDS = 3600
+# What refreshing or querying the index can fail with: the index itself,
+# or the spool and archives under it.  Worth trying again later.
+INDEX_ERRORS = (sqlite3.Error, OSError, EOFError, zlib.error)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT PRIMARY KEY,
+    indexed_to INTEGER NOT NULL,
+    compressed_to INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    digest BLOB NOT NULL UNIQUE,
+    path TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    cn TEXT NOT NULL,
+    time_unix INTEGER NOT NULL,
+    bucket INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_cn ON records (cn, time_unix);
+CREATE INDEX IF NOT EXISTS records_bucket ON records (bucket, time_unix);
+CREATE INDEX IF NOT EXISTS records_path ON records (path, offset);
+CREATE TABLE IF NOT EXISTS fields (
+    record_id INTEGER NOT NULL REFERENCES records (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fields_value ON fields (name, value);
+CREATE INDEX IF NOT EXISTS fields_record ON fields (record_id);
+'''
+
+
+def _digest(record):
+    """ What identifies a record, wherever it's stored. """
+    return hashlib.sha1(spool.encode_json_record(record)).digest()  # nosec not for security
+
+def _is_glob(value):
+    """ Does a field filter value need pattern matching? """
+    return any(char in value for char in '*?[')
+
+def parse_time(value):
+    """
+        A time given on the command line, as epoch seconds.
+        Either epoch seconds already, or an ISO 8601 date/time (UTC
+        unless it says otherwise).
+    """
+    if value.isdigit():
+        return int(value)
+    when = datetime.datetime.fromisoformat(value)
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return int(when.timestamp())
+
+
+def read_archive(archive_path, compressed_offset=0, uncompressed_offset=0):
+    """
+        Yield (offset, end, record) for each record in an archive.
+        Compaction appends whole gzip members, so reading can start at
+        any earlier end-of-file (compressed_offset), as long as we're
+        told how much uncompressed data came before it.
+    """
+    with open(archive_path, 'rb') as rawfile:
+        rawfile.seek(compressed_offset)
+        with gzip.GzipFile(fileobj=rawfile, mode='rb') as archive:
+            offset = uncompressed_offset
+            for raw in archive:
+                start = offset
+                offset += len(raw)
+                try:
+                    record = json.loads(raw.decode('utf-8'))
+                except ValueError:
+                    continue
+                if isinstance(record, dict):
+                    yield start, offset, record
+
+
+class SpoolIndex():
+    """
+        A persistent index over a spool directory and its archives.
+    """
+    def __init__(self, index_path, spool_dir, archive_dir=None,
+                 segment_max_age=spool.DEFAULT_SEGMENT_MAX_AGE,
+                 indexed_fields=INDEXED_FIELDS):
+        self.spool_dir = spool_dir
+        self.archive_dir = archive_dir
+        self.segment_max_age = segment_max_age
+        self.indexed_fields = tuple(indexed_fields)
+        self.conn = sqlite3.connect(index_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA foreign_keys=ON')
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        """ Done with the index. """
+        self.conn.close()
+
+    def _compacting(self):
+        """
+            Is a compaction batch in flight?  If so, it might yet be rolled
+            back, and records may be between the spool and an archive.
+        """
+        return bool(self.archive_dir) and \
+            os.path.exists(os.path.join(self.archive_dir, compact.JOURNAL))
+
+    def _sources(self, compacting=False):
+        """
+            (path, is_archive, pending) for everything there is to index.
+            A pending source is there, but mustn't be read yet: while
+            compacting, that's every archive.
+        """
+        exclude = [self.archive_dir] if self.archive_dir else []
+        for path in spool.iter_spool_sources(self.spool_dir, self.segment_max_age,
+                                             exclude=exclude, finished_only=False):
+            yield path, False, False
+        if not self.archive_dir or not os.path.isdir(self.archive_dir):
+            return
+        for name in sorted(os.listdir(self.archive_dir)):
+            if name.startswith(compact.ARCHIVE_PREFIX) and name.endswith(compact.ARCHIVE_SUFFIX):
+                yield os.path.join(self.archive_dir, name), True, compacting
+
+    def _add(self, path, start, end, record):
+        """ Index one record, or note that it's moved to path. """
+        digest = _digest(record)
+        moved = self.conn.execute('UPDATE records SET path = ?, offset = ?, length = ? '
+                                  'WHERE digest = ?', (path, start, end - start, digest))
+        if moved.rowcount:
+            return
+        epoch_seconds = compact.record_time(record)
+        cursor = self.conn.execute(
+            'INSERT INTO records (digest, path, offset, length, cn, time_unix, bucket) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (digest, path, start, end - start, str(record.get('common_name', '')),
+             epoch_seconds, epoch_seconds // BUCKET_SECONDS))
+        self.conn.executemany('INSERT INTO fields (record_id, name, value) VALUES (?, ?, ?)',
+                              [(cursor.lastrowid, name, str(record[name]))
+                               for name in self.indexed_fields if name in record])
+
+    def _index_source(self, path, is_archive):
+        """ Index whatever part of path we haven't yet. """
+        row = self.conn.execute('SELECT indexed_to, compressed_to FROM sources WHERE path = ?',
+                                (path,)).fetchone()
+        indexed_to, compressed_to = row if row else (0, 0)
+        if is_archive:
+            size = os.stat(path).st_size
+            if size == compressed_to:
+                return
+            covered = compact.uncompressed_size(compact.Compactor.index_path(path))
+            end = indexed_to
+            try:
+                for start, end, record in read_archive(path, compressed_to, indexed_to):
+                    if end > covered:
+                        # Not committed (yet); and until it is, we can't
+                        # tell where to pick up from, so start over then.
+                        # Re-adding what we just read changes nothing.
+                        return
+                    self._add(path, start, end, record)
+            except (EOFError, gzip.BadGzipFile, zlib.error):
+                # A torn member; leave it until it's rolled back or whole.
+                return
+            indexed_to, compressed_to = end, size
+        else:
+            if row and os.path.basename(path).startswith(spool.FILE_PREFIX):
+                # Per-event files never change once they're there.
+                return
+            for start, end, record in spool.read_records(path, indexed_to):
+                self._add(path, start, end, record)
+                indexed_to = end
+        self.conn.execute('INSERT OR REPLACE INTO sources (path, indexed_to, compressed_to) '
+                          'VALUES (?, ?, ?)', (path, indexed_to, compressed_to))
+
+    def _compaction_lock(self):
+        """
+            An fd holding compaction's lock shared, once any running
+            compaction is done; or None if there's no archive to lock.
+        """
+        if not self.archive_dir or not os.path.isdir(self.archive_dir):
+            return None
+        try:
+            lock_fd = os.open(os.path.join(self.archive_dir, compact.LOCK),
+                              os.O_RDONLY | os.O_CREAT, 0o644)
+        except OSError:
+            # Not ours to create; then nobody has compacted here yet.
+            return None
+        fcntl.flock(lock_fd, fcntl.LOCK_SH)
+        return lock_fd
+
+    def refresh(self):
+        """
+            Bring the index up to date.  Return the number of records in it.
+        """
+        lock_fd = self._compaction_lock()
+        try:
+            return self._refresh()
+        finally:
+            if lock_fd is not None:
+                os.close(lock_fd)
+
+    def _refresh(self):
+        """ refresh, with compaction locked out. """
+        seen = set()
+        compacting = self._compacting()
+        with self.conn:
+            for path, is_archive, pending in self._sources(compacting):
+                # Even unread, its records are still where we last saw them.
+                seen.add(path)
+                if pending:
+                    continue
+                try:
+                    self._index_source(path, is_archive)
+                except FileNotFoundError:
+                    # Compacted away from under us; its records will turn
+                    # up in an archive.
+                    seen.discard(path)
+            if compacting:
+                # Files that are gone may have been moved into an archive
+                # we haven't read: forget nothing until we have, or their
+                # records would come back with new ids.
+                return self.conn.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+            # Whatever was in files that are gone, and didn't just turn up
+            # somewhere else, is gone too.
+            known = [row[0] for row in self.conn.execute('SELECT path FROM sources')]
+            for path in known:
+                if path not in seen:
+                    self.conn.execute('DELETE FROM records WHERE path = ?', (path,))
+                    self.conn.execute('DELETE FROM sources WHERE path = ?', (path,))
+        return self.conn.execute('SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def locations(self, cn=None, since=None, until=None, fields=None, after_id=None,
+                  limit=None):
+        """
+            Yield (id, path, offset, length) for records the index says
+            match.  Filters on fields that aren't indexed are not applied
+            here.
+        """
+        clauses = []
+        params = []
+        if cn is not None:
+            clauses.append('cn = ?')
+            params.append(cn)
+        if since is not None:
+            clauses.append('bucket >= ? AND time_unix >= ?')
+            params.extend([since // BUCKET_SECONDS, since])
+        if until is not None:
+            clauses.append('bucket <= ? AND time_unix <= ?')
+            params.extend([until // BUCKET_SECONDS, until])
+        if after_id is not None:
+            clauses.append('id > ?')
+            params.append(after_id)
+        for name, value in (fields or {}).items():
+            if name in self.indexed_fields:
+                operator = 'GLOB' if _is_glob(value) else '='
+                clauses.append('id IN (SELECT record_id FROM fields '
+                               f'WHERE name = ? AND value {operator} ?)')
+                params.extend([name, value])
+        sql = 'SELECT id, path, offset, length FROM records'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY id' if after_id is not None else ' ORDER BY path, offset'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        # Fetch up front: the caller may be slow, and we mustn't hold a
+        # read transaction open over a refresh.
+        yield from self.conn.execute(sql, params).fetchall()
+
+    def query(self, cn=None, since=None, until=None, fields=None, after_id=None,
+              limit=None, with_ids=False):
+        """
+            Yield the records matching every filter given.
+                cn          exact common_name
+                since/until time_unix range, inclusive
+                fields      {name: value}; value may be a glob like '2.4.*'
+                after_id    only records indexed after this id, in id order
+            Results come in storage order (id order with after_id), which
+            keeps reads sequential.  Only records the index matched are
+            ever parsed.  With with_ids, yield (id, record) instead, and
+            (id, None) for a record the index has but that can't be read
+            where it says (usually, it's been moved since the last
+            refresh), so that nothing resuming from ids skips past it.
+        """
+        fields = fields or {}
+        # Local import: fnmatch is only needed for unindexed filters.
+        import fnmatch  # pylint: disable=import-outside-toplevel
+        unindexed = {name: value for name, value in fields.items()
+                     if name not in self.indexed_fields}
+        # The archive we have open, and how far into it we've read.
+        archive_path, archive, archive_offset = None, None, 0
+        try:
+            for record_id, path, offset, length in self.locations(cn, since, until, fields,
+                                                                  after_id, limit):
+                record = None
+                if path.endswith(compact.ARCHIVE_SUFFIX):
+                    if archive is None or archive_path != path or archive_offset > offset:
+                        if archive is not None:
+                            archive.close()
+                        archive_path, archive = path, gzip.open(path, 'rb')
+                    archive.seek(offset)
+                    raw = archive.read(length)
+                    archive_offset = offset + length
+                    try:
+                        record = json.loads(raw.decode('utf-8'))
+                    except ValueError:
+                        pass
+                else:
+                    try:
+                        record = spool.read_record_at(path, offset, length)
+                    except FileNotFoundError:
+                        pass
+                if not isinstance(record, dict):
+                    if with_ids:
+                        yield record_id, None
+                    continue
+                if all(fnmatch.fnmatchcase(str(record.get(name, '')), value)
+                       for name, value in unindexed.items()):
+                    yield (record_id, record) if with_ids else record
+        finally:
+            if archive is not None:
+                archive.close()
+
+
+def index_from_config(config, settings, index_path=None):
+    """
+        Open the index described by a config (and its settings), or
+        None if the spool isn't configured.
+    """
+    def _option(name):
+        try:
+            return config.get('client-disconnect', name)
+        except (configparser.NoOptionError,
+                configparser.NoSectionError):
+            return None
+
+    if not settings['metrics_log_dir']:
+        return None
+    index_path = index_path or _option('metrics-index-file') or \
+        os.path.join(settings['metrics_log_dir'], '.index.sqlite')
+    spool_options = settings['spool_options'] or {}
+    indexed_fields = INDEXED_FIELDS
+    if _option('metrics-index-fields'):
+        try:
+            indexed_fields = tuple(ast.literal_eval(
+                _option('metrics-index-fields')))
+        except (ValueError, SyntaxError):
+            pass
+    return SpoolIndex(index_path, settings['metrics_log_dir'],
+                      _option('metrics-archive-dir'),
+                      spool_options.get('segment_max_age', spool.DEFAULT_SEGMENT_MAX_AGE),
+                      indexed_fields)
+
+def main_work(argv):
+    """
+        Print the matching records, one JSON object per line.
+    """
+    parser = ArgumentParser(description='Query the client-disconnect metrics spool')
+    parser.add_argument('--conf', type=str, required=True,
+                        help='Config file',
+                        dest='conffile', default=None)
+    parser.add_argument('--index', type=str, required=False,
+                        help='Index file (overrides metrics-index-file)',
+                        dest='index_path', default=None)
+    parser.add_argument('--cn', type=str, required=False,
+                        help='Only this common_name',
+                        dest='cn', default=None)
+    parser.add_argument('--since', type=parse_time, required=False,
+                        help='Only at or after this time (epoch or ISO 8601)',
+                        dest='since', default=None)
+    parser.add_argument('--until', type=parse_time, required=False,
+                        help='Only at or before this time (epoch or ISO 8601)',
+                        dest='until', default=None)
+    parser.add_argument('--field', type=str, required=False, action='append',
+                        help='NAME=VALUE to match; VALUE may be a glob.  Repeatable.',
+                        dest='fields', default=[])
+    parser.add_argument('--no-refresh', action='store_false',
+                        help='Use the index as it is, without updating it first',
+                        dest='refresh', default=True)
+    args = parser.parse_args(argv[1:])
+
+    fields = {}
+    for field in args.fields:
+        name, sep, value = field.partition('=')
+        if not sep:
+            parser.error(f'--field {field!r} is not NAME=VALUE')
+        fields[name] = value
+
+    config = openvpn_client_disconnect.ingest_config_from_file([args.conffile])
+    settings = openvpn_client_disconnect.settings_from_config(config, args.conffile)
+    index = index_from_config(config, settings, args.index_path)
+    if index is None:
+        print('No usable metrics-log-dir configured.', file=sys.stderr)
+        return False
+    try:
+        if args.refresh:
+            index.refresh()
+        for record in index.query(args.cn, args.since, args.until, fields):
+            print(json.dumps(record, sort_keys=True))
+    except INDEX_ERRORS as err:
+        print(f'Querying the spool failed: {err}', file=sys.stderr)
+        return False
+    finally:
+        index.close()
+    return True
+
+def main():
+    """ Interface to the outside """
+    if main_work(sys.argv):
+        sys.exit(0)
+    sys.exit(1)
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
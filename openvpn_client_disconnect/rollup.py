@@ -0,0 +1,339 @@
+"""
+    Incremental rollups of the metrics spool.
+
+    The spool exists so we can find clients that need upgrading and
+    clients that are outliers in total usage.  This keeps running totals
+    per CN and per client version/GUI/platform, so those questions can
+    be answered without rereading history: each run picks up from the
+    last index id it saw (see reader.SpoolIndex) and only looks at
+    records that arrived since.
+
+    Per group we keep a count, sums, and a power-of-two histogram of
+    bytes_sent, bytes_received and time_duration, in flat arrays so that
+    tens of thousands of CNs stay cheap.  Percentiles come from the
+    histograms, so they're estimates.  Top talkers come from a
+    Space-Saving sketch, which needs only a fixed number of counters.
+"""
+import os
+import sys
+import json
+import array
+import configparser
+from argparse import ArgumentParser
+import openvpn_client_disconnect
+from openvpn_client_disconnect import reader
+
+MEASURES = ('bytes_sent', 'bytes_received', 'time_duration')
+VERSION_FIELDS = ('IV_VER', 'IV_GUI_VER', 'IV_PLAT')
+# Enough power-of-two buckets for any 64-bit value.
+HISTOGRAM_BUCKETS = 65
+DEFAULT_SKETCH_SIZE = 100
+CHUNK_SIZE = 5000
+
+
+def _number(value):
+    """ A spool value (always a string) as a non-negative int, or None. """
+    try:
+        number = int(value)
+    except (TypeError, ValueError):
+        return None
+    return number if number >= 0 else None
+
+def version_key(version):
+    """
+        Something to sort version strings by: '2.4.10' > '2.4.9'.
+        Non-numeric parts sort as strings, after any number.
+    """
+    key = []
+    for part in str(version).replace('_', '.').replace('-', '.').split('.'):
+        key.append((0, int(part), '') if part.isdigit() else (1, 0, part))
+    return tuple(key)
+
+
+class Aggregate():
+    """
+        Count, sums and histograms of MEASURES for one group of records.
+    """
+    __slots__ = ('count', 'first_seen', 'last_seen', 'sums', 'histograms')
+
+    def __init__(self):
+        self.count = 0
+        self.first_seen = 0
+        self.last_seen = 0
+        self.sums = array.array('d', bytes(8 * len(MEASURES)))
+        self.histograms = array.array('I', bytes(4 * HISTOGRAM_BUCKETS * len(MEASURES)))
+
+    def add(self, record, epoch_seconds):
+        """ Fold one record in. """
+        self.count += 1
+        if not self.first_seen or epoch_seconds < self.first_seen:
+            self.first_seen = epoch_seconds
+        self.last_seen = max(self.last_seen, epoch_seconds)
+        for position, measure in enumerate(MEASURES):
+            value = _number(record.get(measure))
+            if value is None:
+                continue
+            self.sums[position] += value
+            self.histograms[position * HISTOGRAM_BUCKETS + value.bit_length()] += 1
+
+    def percentile(self, measure, fraction):
+        """
+            Estimated value of measure at fraction (0-1) of the way
+            through this group's records, interpolating within buckets.
+        """
+        position = MEASURES.index(measure)
+        base = position * HISTOGRAM_BUCKETS
+        counts = self.histograms[base:base + HISTOGRAM_BUCKETS]
+        total = sum(counts)
+        if not total:
+            return None
+        target = fraction * total
+        running = 0
+        for bucket, count in enumerate(counts):
+            if count and running + count >= target:
+                if bucket == 0:
+                    return 0
+                low = 1 << (bucket - 1)
+                return int(low + (low - 1) * (target - running) / count)
+            running += count
+        return None  # pragma: no cover
+
+    def summary(self):
+        """ A JSON-able description of the group. """
+        result = {'count': self.count, 'first_seen': self.first_seen,
+                  'last_seen': self.last_seen}
+        for position, measure in enumerate(MEASURES):
+            result[measure] = {'sum': int(self.sums[position]),
+                               'p50': self.percentile(measure, 0.5),
+                               'p90': self.percentile(measure, 0.9),
+                               'p99': self.percentile(measure, 0.99)}
+        return result
+
+    def to_state(self):
+        """ For saving. """
+        return [self.count, self.first_seen, self.last_seen, list(self.sums),
+                {str(i): n for i, n in enumerate(self.histograms) if n}]
+
+    @classmethod
+    def from_state(cls, state):
+        """ The reverse of to_state. """
+        aggregate = cls()
+        aggregate.count, aggregate.first_seen, aggregate.last_seen = state[0:3]
+        aggregate.sums = array.array('d', state[3])
+        for index, count in state[4].items():
+            aggregate.histograms[int(index)] = count
+        return aggregate
+
+
+class SpaceSaving():
+    """
+        Space-Saving heavy-hitter sketch: approximately the top keys by
+        weight, using at most size counters.  A reported weight is at
+        most the true weight plus its error.
+    """
+    __slots__ = ('size', 'counters')
+
+    def __init__(self, size=DEFAULT_SKETCH_SIZE):
+        self.size = size
+        # key -> [weight, error]
+        self.counters = {}
+
+    def add(self, key, weight):
+        """ Count weight more for key. """
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += weight
+        elif len(self.counters) < self.size:
+            self.counters[key] = [weight, 0]
+        else:
+            victim = min(self.counters, key=lambda k: self.counters[k][0])
+            floor = self.counters.pop(victim)[0]
+            self.counters[key] = [floor + weight, floor]
+
+    def top(self, count):
+        """ [(key, weight, error)] for the heaviest count keys. """
+        ranked = sorted(self.counters.items(), key=lambda item: -item[1][0])
+        return [(key, weight, error) for key, (weight, error) in ranked[:count]]
+
+
+class Rollup():
+    """
+        All the aggregates, and where in the index they're up to.
+    """
+    def __init__(self, sketch_size=DEFAULT_SKETCH_SIZE):
+        self.last_id = 0
+        self.users = {}
+        # (field, value) -> Aggregate, for each of VERSION_FIELDS
+        self.versions = {}
+        # cn -> {field: value}, as of their most recent record
+        self.user_versions = {}
+        self.talkers = SpaceSaving(sketch_size)
+
+    @staticmethod
+    def _group(groups, key):
+        """ The Aggregate for key in groups, made if need be. """
+        aggregate = groups.get(key)
+        if aggregate is None:
+            aggregate = groups[key] = Aggregate()
+        return aggregate
+
+    def add(self, record_id, record):
+        """ Fold one record in. """
+        epoch_seconds = _number(record.get('time_unix')) or 0
+        usercn = str(record.get('common_name', ''))
+        self._group(self.users, usercn).add(record, epoch_seconds)
+        for field in VERSION_FIELDS:
+            if field in record:
+                self._group(self.versions, (field, str(record[field]))).add(record,
+                                                                           epoch_seconds)
+        if epoch_seconds >= self.users[usercn].last_seen:
+            self.user_versions[usercn] = {field: str(record[field])
+                                          for field in VERSION_FIELDS if field in record}
+        total = (_number(record.get('bytes_sent')) or 0) + \
+            (_number(record.get('bytes_received')) or 0)
+        if total:
+            self.talkers.add(usercn, total)
+        self.last_id = max(self.last_id, record_id)
+
+    def update(self, index, chunk_size=CHUNK_SIZE):
+        """
+            Fold in everything the index has gained since last time.
+            Return the number of records added.
+
+            A record the index can't read where it says has usually been
+            compacted since the index was refreshed, so the index is
+            refreshed and we try again.  If it's still unreadable, we
+            stop short of it, to pick it up next time.
+        """
+        added = 0
+        retried_at = None
+        while True:
+            chunk = list(index.query(after_id=self.last_id, limit=chunk_size, with_ids=True))
+            for record_id, record in chunk:
+                if record is None:
+                    break
+                self.add(record_id, record)
+                added += 1
+            else:
+                if len(chunk) < chunk_size:
+                    return added
+                continue
+            if retried_at == self.last_id:
+                return added
+            retried_at = self.last_id
+            index.refresh()
+
+    def outdated(self, field, minimum):
+        """ {cn: version} for users whose latest field is below minimum. """
+        floor = version_key(minimum)
+        return {usercn: versions[field]
+                for usercn, versions in sorted(self.user_versions.items())
+                if field in versions and version_key(versions[field]) < floor}
+
+    def report(self, top=10, min_version=None, version_field='IV_VER'):
+        """ A JSON-able summary of everything. """
+        result = {
+            'records': sum(x.count for x in self.users.values()),
+            'users': len(self.users),
+            'last_id': self.last_id,
+            'versions': {},
+            'top_talkers': [{'common_name': key, 'bytes': weight, 'error': error}
+                            for key, weight, error in self.talkers.top(top)],
+        }
+        for (field, value), aggregate in sorted(self.versions.items()):
+            result['versions'].setdefault(field, {})[value] = aggregate.summary()
+        if min_version is not None:
+            result['outdated'] = self.outdated(version_field, min_version)
+        return result
+
+    def save(self, path):
+        """ Atomically write our state to path. """
+        state = {
+            'last_id': self.last_id,
+            'users': {key: value.to_state() for key, value in self.users.items()},
+            'versions': [[field, value, aggregate.to_state()]
+                         for (field, value), aggregate in self.versions.items()],
+            'user_versions': self.user_versions,
+            'sketch': [self.talkers.size, self.talkers.counters],
+        }
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as filepointer:
+            json.dump(state, filepointer, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, sketch_size=DEFAULT_SKETCH_SIZE):
+        """ State saved by save(), or a fresh Rollup if there isn't any. """
+        try:
+            with open(path, 'r', encoding='utf-8') as filepointer:
+                state = json.load(filepointer)
+        except FileNotFoundError:
+            return cls(sketch_size)
+        rollup = cls(state['sketch'][0])
+        rollup.last_id = state['last_id']
+        rollup.users = {key: Aggregate.from_state(value)
+                        for key, value in state['users'].items()}
+        rollup.versions = {(field, value): Aggregate.from_state(aggregate)
+                           for field, value, aggregate in state['versions']}
+        rollup.user_versions = state['user_versions']
+        rollup.talkers.counters = state['sketch'][1]
+        return rollup
+
+
+def main_work(argv):
+    """
+        Update the rollup state, and print a report.
+    """
+    parser = ArgumentParser(description='Roll up the client-disconnect metrics spool')
+    parser.add_argument('--conf', type=str, required=True,
+                        help='Config file',
+                        dest='conffile', default=None)
+    parser.add_argument('--state', type=str, required=False,
+                        help='Rollup state file (overrides metrics-rollup-state)',
+                        dest='state_path', default=None)
+    parser.add_argument('--top', type=int, required=False,
+                        help='How many top talkers to report',
+                        dest='top', default=10)
+    parser.add_argument('--min-version', type=str, required=False,
+                        help='Report users whose latest client is older than this',
+                        dest='min_version', default=None)
+    parser.add_argument('--version-field', type=str, required=False,
+                        choices=VERSION_FIELDS,
+                        help='Which version --min-version applies to',
+                        dest='version_field', default='IV_VER')
+    args = parser.parse_args(argv[1:])
+
+    config = openvpn_client_disconnect.ingest_config_from_file([args.conffile])
+    settings = openvpn_client_disconnect.settings_from_config(config, args.conffile)
+    index = reader.index_from_config(config, settings)
+    if index is None:
+        print('No usable metrics-log-dir configured.', file=sys.stderr)
+        return False
+    state_path = args.state_path
+    if state_path is None:
+        try:
+            state_path = config.get('client-disconnect', 'metrics-rollup-state')
+        except (configparser.NoOptionError, configparser.NoSectionError):
+            state_path = os.path.join(settings['metrics_log_dir'], '.rollup.json')
+    try:
+        index.refresh()
+        rollup = Rollup.load(state_path)
+        rollup.update(index)
+        rollup.save(state_path)
+    except reader.INDEX_ERRORS as err:
+        print(f'Rolling up the spool failed: {err}', file=sys.stderr)
+        return False
+    finally:
+        index.close()
+    print(json.dumps(rollup.report(args.top, args.min_version, args.version_field),
+                     sort_keys=True, indent=2))
+    return True
+
+def main():
+    """ Interface to the outside """
+    if main_work(sys.argv):
+        sys.exit(0)
+    sys.exit(1)
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
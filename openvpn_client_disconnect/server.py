@@ -0,0 +1,114 @@
+"""
+    The daemon's side of the unix socket: a threaded server that holds
+    the parsed config, and handles each forwarded event with it.  Kept
+    apart from daemon.py, which the hook imports to forward events and
+    which shouldn't cost it socketserver and threading.
+"""
+import os
+import sys
+import json
+import errno
+import socket
+import socketserver
+import openvpn_client_disconnect
+
+# A disconnect environment is a few KB.  Anything much bigger than
+# this is not something openvpn sent us.
+MAX_REQUEST_BYTES = 1024 * 1024
+# How long to wait for whoever might be listening on our socket already.
+PROBE_TIMEOUT = 1.0
+
+
+def socket_in_use(socket_path):
+    """
+        Is something listening on the unix socket at socket_path?  Only
+        a refused connection (or no socket there at all) says no.
+    """
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.settimeout(PROBE_TIMEOUT)
+        probe.connect(socket_path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        return False
+    except OSError:
+        # Busy, or not ours to talk to: either way, not ours to remove.
+        return True
+    finally:
+        probe.close()
+    return True
+
+
+class DisconnectRequestHandler(socketserver.StreamRequestHandler):
+    """
+        Handle one forwarded event: read the environment until the
+        client closes its side, process it, reply with the result.
+    """
+    def handle(self):
+        raw = self.rfile.read(MAX_REQUEST_BYTES + 1)
+        if len(raw) > MAX_REQUEST_BYTES:
+            reply = {'success': False, 'message': 'Request too large.'}
+        else:
+            try:
+                environ = json.loads(raw.decode('utf-8'))
+                if not isinstance(environ, dict):
+                    raise ValueError('environment must be an object')
+                environ = {str(k): str(v) for k, v in environ.items()}
+            except ValueError:
+                reply = {'success': False, 'message': 'Unparseable request.'}
+            else:
+                reply = self.server.handle_environment(environ)
+        self.wfile.write(json.dumps(reply).encode('utf-8'))
+
+
+class DisconnectServer(socketserver.ThreadingUnixStreamServer):
+    """
+        Unix socket server holding the parsed config between events.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, conffile):
+        self.conffile = conffile
+        self.settings = self._load()
+        if os.path.exists(socket_path):
+            if socket_in_use(socket_path):
+                raise OSError(errno.EADDRINUSE, 'Something is already listening',
+                              socket_path)
+            # A leftover from a previous run.
+            os.unlink(socket_path)
+        super().__init__(socket_path, DisconnectRequestHandler)
+        os.chmod(socket_path, 0o660)
+
+    def _load(self):
+        """ The settings in the config file. """
+        config = openvpn_client_disconnect.ingest_config_from_file([self.conffile])
+        return openvpn_client_disconnect.settings_from_config(config, self.conffile)
+
+    def reload(self):
+        """
+            Reread the config file.  If it's broken, say so and carry on
+            with what we had: return False.
+        """
+        try:
+            self.settings = self._load()
+        except Exception as err:  # pylint: disable=broad-except
+            print(f'Not reloading {self.conffile}: {err}', file=sys.stderr)
+            return False
+        return True
+
+    def handle_environment(self, environ):
+        """ Process one event, return the reply to send back. """
+        try:
+            success, message = openvpn_client_disconnect.handle_disconnect(
+                self.settings, environ)
+        except Exception as err:  # pylint: disable=broad-except
+            # One bad event must not take the daemon down for everyone.
+            success, message = False, f'client-disconnect daemon error: {err}'
+        return {'success': success, 'message': message}
+
+    def server_close(self):
+        path = self.server_address
+        super().server_close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
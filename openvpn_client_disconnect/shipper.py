@@ -0,0 +1,374 @@
+"""
+    Ship the metrics spool to an HTTP collector, in bulk.
+
+    Records are read in the order they were indexed (see
+    reader.SpoolIndex, so it doesn't matter whether they're in per-event
+    files, segments or archives), a batch at a time, and each batch is
+    POSTed as gzipped newline-delimited JSON.  Requests go over a small
+    pool of keep-alive connections, with up to one batch in flight per
+    connection.  Once every batch up to a record has been acknowledged
+    (with a 2xx), its index id is checkpointed to the state file, and
+    the next run picks up from there.  Delivery is at-least-once: a
+    batch that was sent but not checkpointed is sent again.
+
+    Connection failures, 408, 429 and 5xx are retried with exponential
+    backoff (honouring Retry-After), for as long as it takes.  Any other
+    status is an error: the shipper stops there, without checkpointing
+    past it, so nothing is skipped.
+
+    When the collector is slow, every connection ends up waiting on a
+    batch, and nothing more is read from the spool until one comes back:
+    the backlog stays on disk, not in memory.
+"""
+import os
+import sys
+import json
+import gzip
+import time
+import random
+import signal
+import threading
+import collections
+import configparser
+import http.client
+import urllib.parse
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import openvpn_client_disconnect
+from openvpn_client_disconnect import reader, spool
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_CONNECTIONS = 2
+DEFAULT_TIMEOUT = 30.0
+DEFAULT_MAX_BACKOFF = 300.0
+DEFAULT_INTERVAL = 10.0
+RETRY_STATUSES = (408, 429)
+
+
+class ShipError(Exception):
+    """ The collector turned a batch down for good, or we were stopped. """
+
+
+class ConnectionPool():
+    """
+        Up to size keep-alive connections to the host in url.  A request
+        waits for a free connection, so there are never more than size
+        in flight.
+    """
+    def __init__(self, url, size=DEFAULT_CONNECTIONS, timeout=DEFAULT_TIMEOUT):
+        parsed = urllib.parse.urlsplit(url)
+        if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+            raise ValueError(f'Not an http(s) URL: {url!r}')
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.path = parsed.path or '/'
+        if parsed.query:
+            self.path = f'{self.path}?{parsed.query}'
+        self.size = size
+        self.timeout = timeout
+        # How many connections have been opened, over our lifetime.
+        self.opened = 0
+        self._idle = []
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """ A new connection. """
+        self.opened += 1
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def post(self, body, headers):
+        """
+            POST body; return (status, Retry-After header or None).
+            Raises OSError or http.client.HTTPException if the request
+            didn't get an answer; that connection is dropped.
+        """
+        with self._slots:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                conn = self._connect()
+            try:
+                conn.request('POST', self.path, body=body, headers=headers)
+                response = conn.getresponse()
+                # Read it all, or the connection can't be reused.
+                response.read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                with self._lock:
+                    self._idle.append(conn)
+            return response.status, response.getheader('Retry-After')
+
+    def close(self):
+        """ Close every idle connection. """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+def encode_batch(records):
+    """ records as a gzipped, newline-delimited JSON request body. """
+    return gzip.compress(b''.join(spool.encode_json_record(x) for x in records), 6)
+
+def backoff_delay(attempt, initial, maximum, retry_after=None):
+    """
+        How long to wait before retry number attempt (from 0): doubling
+        from initial, with jitter, up to maximum; or what the collector
+        asked for with Retry-After, if it said.
+    """
+    if retry_after is not None:
+        try:
+            return min(maximum, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+    ceiling = min(maximum, initial * 2 ** attempt)
+    return ceiling / 2 + random.uniform(0, ceiling / 2)  # nosec not for security
+
+
+class Shipper():
+    """
+        Ship what index has to pool's collector, checkpointing to
+        state_path.
+    """
+    def __init__(self, index, pool, state_path, batch_size=DEFAULT_BATCH_SIZE,
+                 initial_backoff=1.0, max_backoff=DEFAULT_MAX_BACKOFF):
+        self.index = index
+        self.pool = pool
+        self.state_path = state_path
+        self.batch_size = batch_size
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.last_id = 0
+        self.stats = {'records': 0, 'batches': 0, 'bytes': 0, 'retries': 0, 'seconds': 0.0}
+        self._stopping = threading.Event()
+        self._load()
+
+    def _load(self):
+        """
+            Pick up from the last checkpoint, if there is one.  One we
+            can't make sense of means starting over: sending everything
+            again is better than skipping anything.
+        """
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as filepointer:
+                last_id = json.load(filepointer)['last_id']
+        except FileNotFoundError:
+            return
+        except (ValueError, KeyError, TypeError):
+            last_id = None
+        if not isinstance(last_id, int) or isinstance(last_id, bool):
+            print(f'Ignoring unreadable checkpoint {self.state_path}; '
+                  'shipping from the start.', file=sys.stderr)
+            return
+        self.last_id = last_id
+
+    def _checkpoint(self):
+        """ Atomically note how far the collector has acknowledged. """
+        tmp_path = f'{self.state_path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as filepointer:
+            json.dump({'last_id': self.last_id}, filepointer)
+        os.replace(tmp_path, self.state_path)
+
+    def stop(self):
+        """ Stop shipping (and retrying) as soon as possible. """
+        self._stopping.set()
+
+    def _send(self, body, count):
+        """ POST one batch until the collector takes it. """
+        headers = {'Content-Type': 'application/x-ndjson', 'Content-Encoding': 'gzip',
+                   'X-Record-Count': str(count)}
+        attempt = 0
+        while True:
+            retry_after = None
+            try:
+                status, retry_after = self.pool.post(body, headers)
+            except (OSError, http.client.HTTPException) as err:
+                problem = str(err)
+            else:
+                if 200 <= status < 300:
+                    return
+                if status not in RETRY_STATUSES and status < 500:
+                    raise ShipError(f'Collector refused a batch with HTTP {status}')
+                problem = f'HTTP {status}'
+            self.stats['retries'] += 1
+            delay = backoff_delay(attempt, self.initial_backoff, self.max_backoff, retry_after)
+            attempt += 1
+            if self._stopping.wait(delay):
+                raise ShipError(f'Stopped while retrying after {problem}')
+
+    def _acknowledge(self, future, last_id, count, size):
+        """ Wait for the oldest batch in flight; checkpoint once it's taken. """
+        future.result()
+        self.last_id = last_id
+        self._checkpoint()
+        self.stats['records'] += count
+        self.stats['batches'] += 1
+        self.stats['bytes'] += size
+
+    def ship(self):
+        """
+            Ship everything the index has past the checkpoint.  Return the
+            number of records shipped.  Raises ShipError if the collector
+            refuses a batch; everything before it is checkpointed.
+
+            A record the index can't read where it says has usually been
+            compacted since the index was refreshed, so the index is
+            refreshed and we try again.  If it's still unreadable, we
+            stop short of it, to pick it up next time.
+        """
+        started = time.monotonic()
+        shipped = self.stats['records']
+        in_flight = collections.deque()
+        queued_id = self.last_id
+        retried_at = None
+        with ThreadPoolExecutor(self.pool.size) as executor:
+            try:
+                while not self._stopping.is_set():
+                    rows = list(self.index.query(after_id=queued_id, limit=self.batch_size,
+                                                 with_ids=True))
+                    if not rows:
+                        break
+                    chunk = []
+                    for record_id, record in rows:
+                        if record is None:
+                            break
+                        chunk.append((record_id, record))
+                    if not chunk:
+                        if retried_at == queued_id:
+                            break
+                        retried_at = queued_id
+                        self.index.refresh()
+                        continue
+                    queued_id = chunk[-1][0]
+                    body = encode_batch([x[1] for x in chunk])
+                    if len(in_flight) >= self.pool.size:
+                        # Back-pressure: don't read on until a batch comes back.
+                        self._acknowledge(*in_flight.popleft())
+                    in_flight.append((executor.submit(self._send, body, len(chunk)),
+                                      queued_id, len(chunk), len(body)))
+                    # Paging goes by what the index has, not what we could read.
+                    if len(chunk) == len(rows) and len(rows) < self.batch_size:
+                        break
+                while in_flight:
+                    self._acknowledge(*in_flight.popleft())
+            except reader.INDEX_ERRORS:
+                # Batches in flight can still land; unacknowledged, they
+                # will be sent again next time.
+                raise
+            except BaseException:
+                # Whatever is still in flight will be sent again next time.
+                self._stopping.set()
+                raise
+            finally:
+                self.stats['seconds'] += time.monotonic() - started
+        return self.stats['records'] - shipped
+
+    def report(self):
+        """ What's been shipped, and how fast, as a dict. """
+        report = dict(self.stats, last_id=self.last_id, connections=self.pool.opened)
+        report['seconds'] = round(report['seconds'], 3)
+        report['records_per_second'] = (round(self.stats['records'] / self.stats['seconds'], 1)
+                                        if self.stats['seconds'] else None)
+        return report
+
+    def run(self, interval=DEFAULT_INTERVAL):
+        """
+            Keep the collector up to date with the spool, until stopped.
+            Trouble reading the spool is reported and tried again next
+            interval; a batch the collector refuses stops us (ShipError).
+        """
+        while not self._stopping.is_set():
+            try:
+                self.index.refresh()
+                self.ship()
+            except reader.INDEX_ERRORS as err:
+                print(f'Reading the spool failed, trying again in {interval}s: {err}',
+                      file=sys.stderr)
+            self._stopping.wait(interval)
+
+
+def main_work(argv):
+    """
+        Ship the spool named in the config file.
+    """
+    parser = ArgumentParser(description='Ship the client-disconnect metrics spool over HTTP')
+    parser.add_argument('--conf', type=str, required=True,
+                        help='Config file',
+                        dest='conffile', default=None)
+    parser.add_argument('--url', type=str, required=False,
+                        help='Collector URL (overrides ship-url)',
+                        dest='url', default=None)
+    parser.add_argument('--state', type=str, required=False,
+                        help='Checkpoint file (overrides ship-state)',
+                        dest='state_path', default=None)
+    parser.add_argument('--once', action='store_true',
+                        help='Ship what there is, print a report, and exit',
+                        dest='once')
+    args = parser.parse_args(argv[1:])
+
+    config = openvpn_client_disconnect.ingest_config_from_file([args.conffile])
+    settings = openvpn_client_disconnect.settings_from_config(config, args.conffile)
+
+    def _option(name, getter=config.get, fallback=None):
+        try:
+            return getter('client-disconnect', name)
+        except (configparser.NoOptionError, configparser.NoSectionError, ValueError):
+            return fallback
+
+    url = args.url or _option('ship-url')
+    if not url:
+        print('ship-url (or --url) must be set.', file=sys.stderr)
+        return False
+    try:
+        pool = ConnectionPool(url, _option('ship-connections', config.getint,
+                                           DEFAULT_CONNECTIONS),
+                              _option('ship-timeout', config.getfloat, DEFAULT_TIMEOUT))
+    except ValueError as err:
+        print(err, file=sys.stderr)
+        return False
+    index = reader.index_from_config(config, settings)
+    if index is None:
+        print('No usable metrics-log-dir configured.', file=sys.stderr)
+        return False
+    state_path = args.state_path or _option('ship-state') or \
+        os.path.join(settings['metrics_log_dir'], '.ship.json')
+    shipper = Shipper(index, pool, state_path,
+                      _option('ship-batch-size', config.getint, DEFAULT_BATCH_SIZE),
+                      max_backoff=_option('ship-max-backoff', config.getfloat,
+                                          DEFAULT_MAX_BACKOFF))
+    try:
+        if args.once:
+            index.refresh()
+            shipper.ship()
+            print(json.dumps(shipper.report(), sort_keys=True, indent=2))
+        else:
+            signal.signal(signal.SIGTERM, lambda _signum, _frame: shipper.stop())
+            shipper.run(_option('ship-interval', config.getfloat, DEFAULT_INTERVAL))
+    except ShipError as err:
+        print(f'{err}; checkpointed up to record {shipper.last_id}.', file=sys.stderr)
+        return False
+    except reader.INDEX_ERRORS as err:
+        print(f'Reading the spool failed: {err}; checkpointed up to record '
+              f'{shipper.last_id}.', file=sys.stderr)
+        return False
+    finally:
+        pool.close()
+        index.close()
+    return True
+
+def main():
+    """ Interface to the outside """
+    if main_work(sys.argv):
+        sys.exit(0)
+    sys.exit(1)
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,592 @@
+"""
+    Writers for the metrics spool directory.
+
+    The original spool format is one pretty-printed JSON file per
+    disconnect, named
+
+        log.<usercn>.<YYYYmmddHHMMSS>.<unique>.json
+
+    The <unique> part keeps a user who disconnects twice in one second
+    from overwriting their first record.  Files are written under a
+    temporary name and renamed into place, so readers never see half a
+    record.  They can be sharded into subdirectories (see LAYOUTS) so
+    that no one directory grows without bound.
+
+    At scale that's still millions of tiny files, so there's also
+    a segment format: compact one-line JSON records appended to rolling
+    segment files, named
+
+        segment.<bucket>.<seq>.jsonl
+
+    where <bucket> is the UTC start (YYYYmmddHHMMSS) of the max-age
+    window the record was written in, and <seq> counts up whenever a
+    segment in that window passes max-bytes.  Every record is a single
+    write() on an O_APPEND descriptor, so any number of hook processes
+    (from any number of openvpn instances) can share a segment without
+    interleaving records.
+
+    Segments can also be binary (.bin), which is about half the size,
+    most of a JSON record being its field names.  A binary
+    segment starts with a schema header:
+
+        b'OCDB' version(u8=1) length(u32) names
+
+    where names are joined by newlines, each interned as its position
+    in the header, counting from 1.
+    The header is written before the segment is linked into place, so
+    nobody ever sees a segment without one.  Then come records:
+
+        body_len(u32) count(u16) width(u8) ids(count x u16)
+            lengths(n x width) strings
+
+    width is a struct code ('B', 'H' or 'I'), the narrowest that fits
+    every length.  Each field is its id and its value's bytes; a field
+    that isn't in the header has id 0, and its name comes before its
+    value in the strings.  So n is count plus the number of 0 ids.
+    Everything is little-endian, and strings are UTF-8.
+"""
+import os
+import time
+import json
+import zlib
+import struct
+import itertools
+
+# Where a per-event file goes, relative to the spool directory:
+#   flat    right in the spool directory
+#   date    YYYY/MM/DD/HH/ of the disconnect's time_unix
+#   hash    two levels of a hash of the user's CN, e.g. 3f/a2/
+LAYOUTS = ('flat', 'date', 'hash')
+FILE_PREFIX = 'log.'
+FILE_SUFFIX = '.json'
+# In-progress files start with this, so they never match FILE_PREFIX.
+TMP_PREFIX = '.tmp.'
+SEGMENT_PREFIX = 'segment.'
+SEGMENT_JSON_SUFFIX = '.jsonl'
+SEGMENT_BINARY_SUFFIX = '.bin'
+BINARY_MAGIC = b'OCDB\x01'
+# Where writers leave a note of the newest segment, so they needn't
+# probe every sequence number to find it.
+SEGMENT_HINT = '.segment-hint'
+DEFAULT_SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_SEGMENT_MAX_AGE = 3600
+
+
+def segment_bucket(now, max_age):
+    """ The UTC start of the max_age window that now falls in, as a name part. """
+    start = int(now // max_age) * max_age
+    return time.strftime('%Y%m%d%H%M%S', time.gmtime(start))
+
+def segment_name(bucket, seq, suffix=SEGMENT_JSON_SUFFIX):
+    """ The file name of a segment. """
+    return f'{SEGMENT_PREFIX}{bucket}.{seq:04d}{suffix}'
+
+def parse_segment_name(name):
+    """
+        Return (bucket, seq, suffix) for a segment file name, or None if
+        it isn't one.
+    """
+    if not name.startswith(SEGMENT_PREFIX):
+        return None
+    parts = name[len(SEGMENT_PREFIX):].split('.', 2)
+    if len(parts) != 3 or not (parts[0].isdigit() and parts[1].isdigit()):
+        return None
+    return parts[0], int(parts[1]), f'.{parts[2]}'
+
+def encode_json_record(record):
+    """ One spool record as a compact, newline-terminated JSON line. """
+    line = json.dumps(record, sort_keys=True, separators=(',', ':'))
+    return f'{line}\n'.encode('utf-8')
+
+# Environment variables that aren't valid UTF-8 reach us as surrogates;
+# they have to survive the round trip, as they do through JSON.
+_ERRORS = 'surrogatepass'
+_HEADER_LENGTH = struct.Struct('<I')
+_RECORD_LENGTH = struct.Struct('<I')
+_RECORD_HEAD = struct.Struct('<HB')
+_WIDTHS = {ord('B'): 1, ord('H'): 2, ord('I'): 4}
+
+def encode_binary_header(names):
+    """ The schema header for a binary segment that interns names. """
+    encoded = [x.encode('utf-8', _ERRORS) for x in names]
+    # A name with a newline in it (if there ever is one) goes inline.
+    table = b'\n'.join(x for x in encoded if b'\n' not in x)
+    return BINARY_MAGIC + _HEADER_LENGTH.pack(len(table)) + table
+
+def parse_binary_header(data):
+    """
+        (names, length) for the binary segment header at the start of
+        data, or None if data doesn't hold all of it yet.  Raises
+        ValueError if it isn't one.
+    """
+    if not data.startswith(BINARY_MAGIC[:len(data)]) or \
+            len(data) >= len(BINARY_MAGIC) and not data.startswith(BINARY_MAGIC):
+        raise ValueError('Not a binary spool segment')
+    position = len(BINARY_MAGIC) + _HEADER_LENGTH.size
+    if len(data) < position:
+        return None
+    end = position + _HEADER_LENGTH.unpack_from(data, len(BINARY_MAGIC))[0]
+    if len(data) < end:
+        return None
+    table = data[position:end]
+    return (table.decode('utf-8', _ERRORS).split('\n') if table else []), end
+
+def read_binary_header(filepointer):
+    """
+        The names a binary segment's header interns, reading it from
+        filepointer (at the start of the segment), which is left just
+        past it.  Raises ValueError if it isn't one, or isn't all there.
+    """
+    data = b''
+    while True:
+        more = filepointer.read(max(4096, len(data)))
+        data += more
+        parsed = parse_binary_header(data)
+        if parsed is not None:
+            filepointer.seek(parsed[1])
+            return parsed[0]
+        if not more:
+            raise ValueError('Truncated binary spool header')
+
+def encode_binary_record(record, ids):
+    """ One spool record in the binary encoding, ids mapping names to their ids. """
+    field_ids = []
+    strings = []
+    for name, value in record.items():
+        field_id = ids.get(name, 0)
+        field_ids.append(field_id)
+        if not field_id:
+            strings.append(name.encode('utf-8', _ERRORS))
+        strings.append(value.encode('utf-8', _ERRORS))
+    longest = max(map(len, strings), default=0)
+    width = 'B' if longest < 0x100 else 'H' if longest < 0x10000 else 'I'
+    count = len(field_ids)
+    body = struct.pack(f'<HB{count}H{len(strings)}{width}', count, ord(width),
+                       *field_ids, *map(len, strings)) + b''.join(strings)
+    return _RECORD_LENGTH.pack(len(body)) + body
+
+def decode_binary_record(body, names):
+    """
+        The record in body (a binary record, less its length), names
+        being the names its segment's header interns.  Raises ValueError
+        if it's garbled.
+    """
+    try:
+        count, width = _RECORD_HEAD.unpack_from(body)
+        field_ids = struct.unpack_from(f'<{count}H', body, 3)
+        position = 3 + 2 * count
+        lengths = struct.unpack_from(f'<{count + field_ids.count(0)}{chr(width)}',
+                                     body, position)
+        position += len(lengths) * _WIDTHS[width]
+        strings = body[position:]
+        if len(lengths) == count and strings.isascii():
+            # The usual case: decode the strings in one go and slice
+            # them out, which is quicker than one at a time.
+            text = strings.decode('ascii')
+            bounds = list(itertools.accumulate(lengths, initial=0))
+            if bounds[-1] != len(text):
+                raise ValueError('Garbled binary spool record: wrong length')
+            return dict(zip([names[x - 1] for x in field_ids],
+                            [text[x:y] for x, y in zip(bounds, bounds[1:])]))
+        record = {}
+        remaining = iter(lengths)
+        for field_id in field_ids:
+            if field_id:
+                name = names[field_id - 1]
+            else:
+                length = next(remaining)
+                name = body[position:position + length].decode('utf-8', _ERRORS)
+                position += length
+            length = next(remaining)
+            record[name] = body[position:position + length].decode('utf-8', _ERRORS)
+            position += length
+    except (struct.error, KeyError, IndexError, UnicodeDecodeError) as err:
+        raise ValueError(f'Garbled binary spool record: {err}') from err
+    if position != len(body):
+        raise ValueError('Garbled binary spool record: wrong length')
+    return record
+
+
+def shard_path(layout, usercn, epoch_seconds):
+    """ The subdirectory a per-event file goes in, for layout. """
+    if layout == 'date':
+        return time.strftime('%Y/%m/%d/%H', time.gmtime(epoch_seconds))
+    if layout == 'hash':
+        digest = f'{zlib.crc32(usercn.encode("utf-8")):08x}'
+        return f'{digest[0:2]}/{digest[2:4]}'
+    return ''
+
+
+class FileSpool():
+    """
+        Write each record to its own JSON file in spool_dir.
+    """
+    def __init__(self, spool_dir, layout='flat'):
+        if layout not in LAYOUTS:
+            raise ValueError(f'Unknown spool layout {layout!r}')
+        self.spool_dir = spool_dir
+        self.layout = layout
+
+    def write(self, usercn, record):
+        """
+            Write one record.  Return the path written to.
+        """
+        epoch_seconds = int(record.get('time_unix'))
+        date = time.strftime('%Y%m%d%H%M%S', time.gmtime(epoch_seconds))
+        # A CN is client-controlled; it mustn't be able to pick a directory.
+        safe_cn = usercn.replace(os.sep, '_')
+        unique = f'{os.getpid():x}{os.urandom(4).hex()}'
+        filename = f'{FILE_PREFIX}{safe_cn}.{date}.{unique}{FILE_SUFFIX}'
+        outdir = os.path.join(self.spool_dir, shard_path(self.layout, usercn, epoch_seconds))
+        outfile = os.path.join(outdir, filename)
+        tmpfile = os.path.join(outdir, f'{TMP_PREFIX}{filename}')
+        js_dump = json.dumps(record, sort_keys=True, indent=2)
+        buf = f'{js_dump}\n'
+        try:
+            self._write_tmp(outdir, tmpfile, buf)
+            os.replace(tmpfile, outfile)
+        except BaseException:
+            try:
+                os.unlink(tmpfile)
+            except OSError:
+                pass
+            raise
+        return outfile
+
+    def _write_tmp(self, outdir, tmpfile, buf):
+        """
+            Write buf to tmpfile, in outdir.  Compaction removes shard
+            directories it has emptied, and can do so between our making
+            one and opening a file in it, so that's retried.  (Once our
+            file is in it, it isn't empty.)
+        """
+        for attempt in range(3):
+            if self.layout != 'flat':
+                os.makedirs(outdir, exist_ok=True)
+            try:
+                with open(tmpfile, 'w', encoding='utf-8') as outhandle:
+                    outhandle.write(buf)
+                return
+            except FileNotFoundError:
+                if self.layout == 'flat' or attempt == 2:
+                    raise
+
+
+class SegmentSpool():
+    """
+        Append records to rolling segment files in spool_dir.
+    """
+    suffix = SEGMENT_JSON_SUFFIX
+    # Whether a new segment starts with header().
+    has_header = False
+
+    def __init__(self, spool_dir, max_bytes=DEFAULT_SEGMENT_MAX_BYTES,
+                 max_age=DEFAULT_SEGMENT_MAX_AGE):
+        self.spool_dir = spool_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def _read_hint(self, bucket):
+        """ The newest sequence number known for bucket. """
+        try:
+            with open(os.path.join(self.spool_dir, SEGMENT_HINT), 'r',
+                      encoding='utf-8') as filepointer:
+                hint_bucket, hint_seq = filepointer.read().split()
+            if hint_bucket == bucket:
+                return int(hint_seq)
+        except (OSError, ValueError):
+            pass
+        return 0
+
+    def _write_hint(self, bucket, seq):
+        """ Tell later writers where the newest segment is. """
+        hint_path = os.path.join(self.spool_dir, SEGMENT_HINT)
+        tmp_path = f'{hint_path}.{os.getpid()}'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as filepointer:
+                filepointer.write(f'{bucket} {seq}\n')
+            os.replace(tmp_path, hint_path)
+        except OSError:
+            # Only an optimization.
+            pass
+
+    def header(self, _record):
+        """ What a new segment starts with, given the first record for it. """
+        return b''
+
+    def _create(self, path, record=None):
+        """
+            Open a segment for appending, creating it if need be,
+            starting with header(record) if our segments have one (in
+            which case it's open for reading too).
+            Return (fd, created).
+        """
+        if not self.has_header:
+            try:
+                fdesc = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_EXCL, 0o644)
+                return fdesc, True
+            except FileExistsError:
+                return os.open(path, os.O_WRONLY | os.O_APPEND), False
+        try:
+            return os.open(path, os.O_RDWR | os.O_APPEND), False
+        except FileNotFoundError:
+            header = self.header(record)
+        # Write the header somewhere else and link it into place, so
+        # the segment never exists without it.  The name is our own,
+        # even among threads of one process.
+        unique = f'{os.getpid():x}{os.urandom(4).hex()}'
+        tmp_path = os.path.join(self.spool_dir,
+                                f'{TMP_PREFIX}{os.path.basename(path)}.{unique}')
+        fdesc = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            os.write(fdesc, header)
+            os.link(tmp_path, path)
+            created = True
+        except FileExistsError:
+            created = False
+        finally:
+            os.close(fdesc)
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                # Already gone is as good as removed.
+                pass
+        return os.open(path, os.O_RDWR | os.O_APPEND), created
+
+    def open_segment(self, now=None, record=None):
+        """
+            Open the segment to append to right now.  record is what's
+            going in it, in case it has to be created.
+            Return (fd, path).
+        """
+        if now is None:
+            now = time.time()
+        bucket = segment_bucket(now, self.max_age)
+        seq = self._read_hint(bucket)
+        while True:
+            path = os.path.join(self.spool_dir, segment_name(bucket, seq, self.suffix))
+            fdesc, created = self._create(path, record)
+            if created or os.fstat(fdesc).st_size < self.max_bytes:
+                if created:
+                    self._write_hint(bucket, seq)
+                return fdesc, path
+            os.close(fdesc)
+            seq += 1
+
+    def encode(self, record, _fdesc, _path):
+        """ The bytes to append for record. """
+        return encode_json_record(record)
+
+    def write(self, _usercn, record):
+        """
+            Append one record.  The record goes out in a single write(),
+            which O_APPEND makes atomic with respect to other appenders.
+        """
+        fdesc, path = self.open_segment(record=record)
+        try:
+            os.write(fdesc, self.encode(record, fdesc, path))
+        finally:
+            os.close(fdesc)
+
+
+class BinarySegmentSpool(SegmentSpool):
+    """
+        Append records to rolling segment files in spool_dir, in the
+        binary encoding.  A new segment interns the names of the first
+        record that goes in it.
+    """
+    suffix = SEGMENT_BINARY_SUFFIX
+    has_header = True
+
+    def __init__(self, spool_dir, max_bytes=DEFAULT_SEGMENT_MAX_BYTES,
+                 max_age=DEFAULT_SEGMENT_MAX_AGE):
+        super().__init__(spool_dir, max_bytes, max_age)
+        # {(st_dev, st_ino): (header, {name: id})} for segments we've
+        # seen, so a long-lived writer parses each header once.
+        self._ids = {}
+
+    def header(self, record):
+        return encode_binary_header(sorted(record or ()))
+
+    def encode(self, record, fdesc, path):
+        stat = os.fstat(fdesc)
+        key = (stat.st_dev, stat.st_ino)
+        cached = self._ids.get(key)
+        # Once compaction removes a segment, a new one can get its inode:
+        # only trust what we cached if the header on disk is still it.
+        if cached is not None and os.pread(fdesc, len(cached[0]), 0) == cached[0]:
+            return encode_binary_record(record, cached[1])
+        size = 4096
+        while True:
+            data = os.pread(fdesc, size, 0)
+            parsed = parse_binary_header(data)
+            if parsed is not None or len(data) < size:
+                break
+            size *= 2
+        if parsed is None:
+            raise ValueError(f'{path} has no binary spool header')
+        names, end = parsed
+        ids = {name: num for num, name in enumerate(names, 1)}
+        self._ids[key] = (data[:end], ids)
+        return encode_binary_record(record, ids)
+
+
+def writer_for(spool_dir, spool_options=None):
+    """
+        A writer for spool_dir, as described by spool_options:
+            format              'files' (the default) or 'segments'
+            layout              for 'files', one of LAYOUTS
+            segment_max_bytes   roll to a new segment past this size
+            segment_max_age     roll to a new segment this often, in seconds
+            segment_encoding    'json' (the default) or 'binary'
+    """
+    spool_options = spool_options or {}
+    spool_format = spool_options.get('format', 'files')
+    if spool_format == 'files':
+        return FileSpool(spool_dir, spool_options.get('layout', 'flat'))
+    if spool_format == 'segments' and spool_options.get('segment_encoding') == 'binary':
+        return BinarySegmentSpool(spool_dir,
+                                  spool_options.get('segment_max_bytes',
+                                                    DEFAULT_SEGMENT_MAX_BYTES),
+                                  spool_options.get('segment_max_age', DEFAULT_SEGMENT_MAX_AGE))
+    if spool_format == 'segments':
+        return SegmentSpool(spool_dir,
+                            spool_options.get('segment_max_bytes', DEFAULT_SEGMENT_MAX_BYTES),
+                            spool_options.get('segment_max_age', DEFAULT_SEGMENT_MAX_AGE))
+    raise ValueError(f'Unknown spool format {spool_format!r}')
+
+
+def _segment_finished(name, entry, max_age, now, newest_seq, grace):
+    """
+        Is the segment called name done being written to?
+        A segment is done once its window has passed, or once a later
+        segment in the same window exists and it's gone quiet.
+    """
+    # Only readers need this; keep it off the hook's import path.
+    import calendar  # pylint: disable=import-outside-toplevel
+    bucket, seq, _suffix = parse_segment_name(name)
+    bucket_start = calendar.timegm(time.strptime(bucket, '%Y%m%d%H%M%S'))
+    if bucket_start + max_age + grace <= now:
+        return True
+    return seq < newest_seq.get(bucket, seq) and entry.stat().st_mtime + grace <= now
+
+def iter_spool_sources(spool_dir, max_age=DEFAULT_SEGMENT_MAX_AGE, now=None,
+                       grace=60, exclude=(), finished_only=True):
+    """
+        Yield the path of every spool file that's finished being written:
+        every per-event file, in any layout, and every finished segment.
+        With finished_only False, segments still being written are
+        included too.
+        Directories in exclude (e.g. an archive kept inside the spool)
+        are skipped.  Yields as it goes; nothing is listed up front.
+    """
+    if now is None:
+        now = time.time()
+    exclude = {os.path.abspath(x) for x in exclude}
+    pending = [spool_dir]
+    while pending:
+        directory = pending.pop()
+        segments = []
+        newest_seq = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                name = entry.name
+                if name.startswith('.'):
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    if os.path.abspath(entry.path) not in exclude:
+                        pending.append(entry.path)
+                elif name.startswith(FILE_PREFIX) and name.endswith(FILE_SUFFIX):
+                    yield entry.path
+                elif parse_segment_name(name):
+                    bucket, seq, _suffix = parse_segment_name(name)
+                    newest_seq[bucket] = max(seq, newest_seq.get(bucket, seq))
+                    segments.append(entry)
+        for entry in segments:
+            if not finished_only or \
+                    _segment_finished(entry.name, entry, max_age, now, newest_seq, grace):
+                yield entry.path
+
+def read_records(path, offset=0):
+    """
+        Yield (offset, end, record) for each record in a spool file,
+        starting at byte offset.  end is where the next record starts,
+        which is where to resume from.
+        A trailing partial line (or record) in a segment is left for
+        next time.
+    """
+    name = os.path.basename(path)
+    if name.endswith(SEGMENT_BINARY_SUFFIX):
+        yield from _read_binary_records(path, offset)
+        return
+    if name.startswith(FILE_PREFIX) and name.endswith(FILE_SUFFIX):
+        if offset:
+            return
+        with open(path, 'rb') as filepointer:
+            raw = filepointer.read()
+        try:
+            record = json.loads(raw.decode('utf-8'))
+        except ValueError:
+            return
+        if isinstance(record, dict):
+            yield 0, len(raw), record
+        return
+    with open(path, 'rb') as filepointer:
+        filepointer.seek(offset)
+        for raw in filepointer:
+            if not raw.endswith(b'\n'):
+                return
+            start = offset
+            offset += len(raw)
+            try:
+                record = json.loads(raw.decode('utf-8'))
+            except ValueError:
+                continue
+            if isinstance(record, dict):
+                yield start, offset, record
+
+def _read_binary_records(path, offset):
+    """ read_records, for a binary segment. """
+    with open(path, 'rb') as filepointer:
+        try:
+            names = read_binary_header(filepointer)
+        except ValueError:
+            # Not one of ours, or (somehow) not all there yet.
+            return
+        offset = max(offset, filepointer.tell())
+        filepointer.seek(offset)
+        while True:
+            raw = filepointer.read(_RECORD_LENGTH.size)
+            if len(raw) < _RECORD_LENGTH.size:
+                return
+            body = filepointer.read(_RECORD_LENGTH.unpack(raw)[0])
+            if len(body) < _RECORD_LENGTH.unpack(raw)[0]:
+                return
+            start = offset
+            offset += len(raw) + len(body)
+            try:
+                record = decode_binary_record(body, names)
+            except ValueError:
+                continue
+            yield start, offset, record
+
+def read_record_at(path, offset, length):
+    """
+        The record that read_records found at offset in path, length
+        bytes long, or None if it's not readable there any more.
+    """
+    with open(path, 'rb') as filepointer:
+        if path.endswith(SEGMENT_BINARY_SUFFIX):
+            try:
+                names = read_binary_header(filepointer)
+            except ValueError:
+                return None
+        filepointer.seek(offset)
+        raw = filepointer.read(length)
+    try:
+        if path.endswith(SEGMENT_BINARY_SUFFIX):
+            return decode_binary_record(raw[_RECORD_LENGTH.size:], names)
+        record = json.loads(raw.decode('utf-8'))
+    except ValueError:
+        return None
+    return record if isinstance(record, dict) else None
@@ -0,0 +1,399 @@
+"""
+    Local stand-ins for the services we talk to, for tests and for trying
+    things out without the real thing.
+
+    SyslogCollector listens like a syslog daemon would (on a unix
+    datagram socket, UDP, or TCP with octet-counted or newline framing)
+    and keeps every message it gets.
+
+    FakeManagementServer speaks enough of openvpn's management interface
+    protocol to feed client notifications to whatever connects to it.
+
+    HttpCollector takes bulk POSTs of spool records, the way
+    shipper.Shipper sends them, and can be told to be slow or to fail.
+"""
+import os
+import json
+import gzip
+import time
+import socket
+import threading
+import http.server
+
+
+class SyslogCollector():
+    """
+        A syslog receiver that remembers what it's sent.
+
+        kind is 'unix', 'udp' or 'tcp'.  For 'unix', address is the socket
+        path; otherwise it's (host, port), and port 0 picks a free one.
+        target is the transport target (see transport.parse_target) that
+        reaches this collector.
+    """
+    def __init__(self, kind, address=None):
+        self.kind = kind
+        self.messages = []
+        self._cond = threading.Condition()
+        self._threads = []
+        self._closing = False
+        if kind == 'unix':
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sock.bind(address)
+            self.address = address
+            self.target = f'unix:{address}'
+        elif kind == 'udp':
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._sock.bind(address or ('127.0.0.1', 0))
+            self.address = self._sock.getsockname()
+            self.target = f'udp://{self.address[0]}:{self.address[1]}'
+        elif kind == 'tcp':
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._sock.bind(address or ('127.0.0.1', 0))
+            self._sock.listen(16)
+            self.address = self._sock.getsockname()
+            self.target = f'tcp://{self.address[0]}:{self.address[1]}'
+        else:
+            raise ValueError(f'Unknown collector kind {kind!r}')
+        # How many connections / datagram reads we've had, for tests
+        # that care about connection reuse and batching.
+        self.connections = 0
+        self.reads = 0
+        self._start(self._accept if kind == 'tcp' else self._receive)
+
+    def _start(self, target, *args):
+        """ Run target in a background thread. """
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _add(self, message):
+        """ Keep one message, and wake anyone waiting for it. """
+        with self._cond:
+            self.messages.append(message)
+            self._cond.notify_all()
+
+    def _receive(self):
+        """ Datagrams: one message each. """
+        while not self._closing:
+            try:
+                data = self._sock.recv(65536)
+            except OSError:
+                return
+            self.reads += 1
+            self._add(data)
+
+    def _accept(self):
+        """ Streams: a reader thread per connection. """
+        while not self._closing:
+            try:
+                conn, _addr = self._sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            self._start(self._read_stream, conn)
+
+    def _read_stream(self, conn):
+        """ A stream: octet-counted (RFC 6587) or newline-framed messages. """
+        buf = b''
+        with conn:
+            while True:
+                try:
+                    data = conn.recv(65536)
+                except OSError:
+                    return
+                if not data:
+                    return
+                self.reads += 1
+                buf += data
+                while buf:
+                    length, space, rest = buf.partition(b' ')
+                    if space and length.isdigit():
+                        if len(rest) < int(length):
+                            break
+                        self._add(rest[:int(length)])
+                        buf = rest[int(length):]
+                        continue
+                    line, newline, rest = buf.partition(b'\n')
+                    if not newline:
+                        break
+                    self._add(line)
+                    buf = rest
+
+    def wait_for(self, count, timeout=5.0):
+        """
+            Wait until at least count messages have arrived.
+            Return the messages so far.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: len(self.messages) >= count, timeout)
+            return list(self.messages)
+
+    def close(self):
+        """ Stop listening. """
+        self._closing = True
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        if self.kind == 'unix':
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        """ For use in a with statement. """
+        return self
+
+    def __exit__(self, *_exc):
+        """ Stop listening at the end of the with statement. """
+        self.close()
+
+
+class FakeManagementServer():
+    """
+        Enough of an openvpn management interface to send >CLIENT
+        notifications to connected management clients, and remember the
+        commands they send back.
+
+        kind is 'unix' (address is a path) or 'tcp' (address is
+        (host, port), default a free port on localhost).  target is the
+        address to give management.ManagementListener.  With a password,
+        clients are prompted for it the way openvpn does.
+    """
+    banner = b">INFO:OpenVPN Management Interface Version 5 -- type 'help' for more info\r\n"
+
+    def __init__(self, kind='tcp', address=None, password=None):
+        self.kind = kind
+        self.password = password
+        self.commands = []
+        self.connections = 0
+        self._clients = []
+        self._cond = threading.Condition()
+        self._closing = False
+        if kind == 'unix':
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.bind(address)
+            self.address = address
+            self.target = f'unix:{address}'
+        elif kind == 'tcp':
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._sock.bind(address or ('127.0.0.1', 0))
+            self.address = self._sock.getsockname()
+            self.target = f'{self.address[0]}:{self.address[1]}'
+        else:
+            raise ValueError(f'Unknown management server kind {kind!r}')
+        self._sock.listen(16)
+        thread = threading.Thread(target=self._accept, daemon=True)
+        thread.start()
+
+    def _accept(self):
+        """ A thread per management client. """
+        while not self._closing:
+            try:
+                conn, _addr = self._sock.accept()
+            except OSError:
+                return
+            thread = threading.Thread(target=self._serve, args=(conn,), daemon=True)
+            thread.start()
+
+    def _serve(self, conn):
+        """ Log a client in, then note every command it sends. """
+        with conn, conn.makefile('rb') as lines:
+            try:
+                if self.password is not None:
+                    conn.sendall(b'ENTER PASSWORD:')
+                    if lines.readline().rstrip(b'\r\n').decode('utf-8') != self.password:
+                        conn.sendall(b'ERROR: bad password\r\n')
+                        return
+                    conn.sendall(b'SUCCESS: password is correct\r\n')
+                conn.sendall(self.banner)
+            except OSError:
+                return
+            with self._cond:
+                self.connections += 1
+                self._clients.append(conn)
+                self._cond.notify_all()
+            try:
+                for raw in lines:
+                    command = raw.rstrip(b'\r\n').decode('utf-8', 'replace')
+                    with self._cond:
+                        self.commands.append(command)
+                        self._cond.notify_all()
+                    conn.sendall(b'SUCCESS: command succeeded\r\n')
+            except OSError:
+                pass
+            finally:
+                with self._cond:
+                    if conn in self._clients:
+                        self._clients.remove(conn)
+
+    def wait_for_clients(self, count=1, timeout=5.0):
+        """ Wait until count clients are connected; return how many are. """
+        with self._cond:
+            self._cond.wait_for(lambda: len(self._clients) >= count, timeout)
+            return len(self._clients)
+
+    def wait_for_commands(self, count, timeout=5.0):
+        """ Wait until count commands have arrived; return them. """
+        with self._cond:
+            self._cond.wait_for(lambda: len(self.commands) >= count, timeout)
+            return list(self.commands)
+
+    def send(self, data):
+        """ Send raw bytes to every connected client. """
+        with self._cond:
+            clients = list(self._clients)
+        for conn in clients:
+            try:
+                conn.sendall(data)
+            except OSError:
+                pass
+
+    @staticmethod
+    def notification(kind, args, environ=None):
+        """
+            The lines of one >CLIENT notification, as bytes.  An environ
+            (even an empty one) adds a >CLIENT:ENV block.
+        """
+        lines = [f'>CLIENT:{",".join([kind] + [str(x) for x in args])}']
+        if environ is not None:
+            lines.extend(f'>CLIENT:ENV,{key}={value}' for key, value in environ.items())
+            lines.append('>CLIENT:ENV,END')
+        return ''.join(f'{line}\r\n' for line in lines).encode('utf-8')
+
+    def client_connect(self, cid, kid, environ):
+        """ Tell clients that someone is connecting. """
+        self.send(self.notification('CONNECT', [cid, kid], environ))
+
+    def client_disconnect(self, cid, environ):
+        """ Tell clients that someone has disconnected. """
+        self.send(self.notification('DISCONNECT', [cid], environ))
+
+    def drop_clients(self):
+        """ Hang up on every connected client, as a restarting openvpn would. """
+        with self._cond:
+            clients, self._clients = self._clients, []
+        for conn in clients:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self):
+        """ Stop listening, and hang up on everyone. """
+        self._closing = True
+        self.drop_clients()
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        if self.kind == 'unix':
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        """ For use in a with statement. """
+        return self
+
+    def __exit__(self, *_exc):
+        """ Stop at the end of the with statement. """
+        self.close()
+
+
+class _CollectorHandler(http.server.BaseHTTPRequestHandler):
+    """ One connection to an HttpCollector. """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.collector.connections += 1
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """ Take a batch, unless we've been told to answer otherwise. """
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        status, retry_after = self.server.collector.receive(self.headers, body)
+        self.send_response(status)
+        if retry_after is not None:
+            self.send_header('Retry-After', str(retry_after))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *_args):  # pylint: disable=arguments-differ
+        """ Keep quiet. """
+
+
+class HttpCollector():
+    """
+        A bulk HTTP endpoint for spool records, on a free port on
+        localhost.  url is where to POST to.
+
+        Each POST is taken as newline-delimited JSON records, gzipped if
+        it says so.  responses is a list of statuses (or (status,
+        retry_after) pairs) to answer the next requests with before
+        accepting any; delay is how long each request takes.
+    """
+    def __init__(self, responses=None, delay=0.0, path='/bulk'):
+        self.responses = list(responses or [])
+        self.delay = delay
+        self.records = []
+        self.batches = 0
+        self.requests = 0
+        self.connections = 0
+        self._cond = threading.Condition()
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _CollectorHandler)
+        self._server.daemon_threads = True
+        self._server.collector = self
+        self.address = self._server.server_address
+        self.url = f'http://{self.address[0]}:{self.address[1]}{path}'
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def receive(self, headers, body):
+        """ Handle one request; return (status, retry_after). """
+        if self.delay:
+            time.sleep(self.delay)
+        with self._cond:
+            self.requests += 1
+            if self.responses:
+                response = self.responses.pop(0)
+                return response if isinstance(response, tuple) else (response, None)
+        try:
+            if headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+            records = [json.loads(line) for line in body.splitlines() if line]
+        except (OSError, EOFError, ValueError):
+            return 400, None
+        with self._cond:
+            self.records.extend(records)
+            self.batches += 1
+            self._cond.notify_all()
+        return 200, None
+
+    def wait_for(self, count, timeout=5.0):
+        """
+            Wait until at least count records have arrived.
+            Return the records so far.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: len(self.records) >= count, timeout)
+            return list(self.records)
+
+    def close(self):
+        """ Stop listening. """
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        """ For use in a with statement. """
+        return self
+
+    def __exit__(self, *_exc):
+        """ Stop at the end of the with statement. """
+        self.close()
@@ -0,0 +1,105 @@
+"""
+    Made-up but realistic disconnect environments, for benchmarks and
+    load tests.
+
+    They're modelled on the variable dump in docs/README.metrics.md:
+    the same variables openvpn hands a client-disconnect script, with
+    the per-client ones varied (CN, addresses, byte counts, client
+    versions, certificate details) and the per-server ones fixed.
+"""
+import time
+import random
+
+# (IV_GUI_VER, IV_VER, IV_PLAT, IV_SSL), roughly as common as each other.
+CLIENTS = [
+    ('Viscosity_1.8.2b1_1512', '2.4.8', 'mac', 'OpenSSL_1.1.1d__10_Sep_2019'),
+    ('Viscosity_1.10.3_1715', '2.5.7', 'mac', 'OpenSSL_1.1.1q__5_Jul_2022'),
+    ('OpenVPN_GUI_11', '2.5.8', 'win', 'OpenSSL_1.1.1s__1_Nov_2022'),
+    ('OpenVPN_GUI_11', '2.6.0', 'win', 'OpenSSL_3.0.7_1_Nov_2022'),
+    ('net.tunnelblick.tunnelblick_5811_3.8.8a', '2.5.8', 'mac', 'OpenSSL_1.1.1s__1_Nov_2022'),
+    ('', '2.4.7', 'linux', 'OpenSSL_1.1.1f__31_Mar_2020'),
+    ('', '2.5.5', 'linux', 'OpenSSL_3.0.2_15_Mar_2022'),
+]
+# What the example config asks for.
+EXAMPLE_METRICS = ['IV_COMP_STUB', 'IV_COMP_STUBv2', 'IV_GUI_VER', 'IV_HWADDR', 'IV_LZ4',
+                   'IV_LZ4v2', 'IV_LZO', 'IV_NCP', 'IV_PLAT', 'IV_PROTO', 'IV_SSL',
+                   'IV_TCPNL', 'IV_VER', 'bytes_received', 'bytes_sent', 'time_duration',
+                   'time_unix', 'common_name', 'ifconfig_pool_remote_ip', 'trusted_ip',
+                   'trusted_port', 'link_mtu', 'tun_mtu', 'time_ascii', 'tls_digest_0',
+                   'tls_id_0', 'tls_serial_0', 'proto_1']
+# The same, mostly as patterns.
+EXAMPLE_SELECTORS = ['IV_*', 'bytes_*', 'time_*', 'common_name', 'ifconfig_pool_remote_ip',
+                     'trusted_*', '*_mtu', 'tls_*_0', 'proto_1']
+_CA = ('C=US, ST=Oregon, L=Corvallis, O=Work Company, OU=IT - NetOps, '
+       'CN=Work - ClearPass Onboard CA')
+
+
+def _hex_pairs(rng, count):
+    """ count random bytes as aa:bb:cc... """
+    return ':'.join(f'{rng.randrange(256):02x}' for _ in range(count))
+
+def environment(num, now=None, rng=None):
+    """
+        The environment for disconnect number num.  The same num (with
+        the same rng state) always gives the same environment.
+    """
+    if now is None:
+        now = int(time.time())
+    if rng is None:
+        rng = random.Random(num)
+    usercn = f'user{num:05d}@work.net'
+    gui_ver, iv_ver, platform, ssl = CLIENTS[num % len(CLIENTS)]
+    duration = int(rng.lognormvariate(7, 1.5))
+    trusted_ip = f'{rng.randrange(1, 224)}.{rng.randrange(256)}.{rng.randrange(256)}.' \
+        f'{rng.randrange(1, 255)}'
+    trusted_port = str(rng.randrange(1024, 65536))
+    pool_ip = f'10.58.{238 + num // 254 % 2}.{num % 254 + 1}'
+    environ = {
+        'IV_COMP_STUB': '1', 'IV_COMP_STUBv2': '1', 'IV_HWADDR': _hex_pairs(rng, 6),
+        'IV_LZ4': '1', 'IV_LZ4v2': '1', 'IV_LZO': '1', 'IV_NCP': '2', 'IV_PLAT': platform,
+        'IV_PROTO': '2', 'IV_SSL': ssl, 'IV_TCPNL': '1', 'IV_VER': iv_ver,
+        'auth_control_file': f'/tmp/openvpn_acf_{_hex_pairs(rng, 16).replace(":", "")}.tmp',
+        'bytes_received': str(int(rng.lognormvariate(14, 2.5))),
+        'bytes_sent': str(int(rng.lognormvariate(15, 2.5))),
+        'common_name': usercn,
+        'config': 'udp-stage.conf', 'daemon': '0', 'daemon_log_redirect': '1',
+        'daemon_pid': '1022', 'daemon_start_time': '1572267794',
+        'dev': 'tun0', 'dev_type': 'tun',
+        'ifconfig_broadcast': '10.58.239.255', 'ifconfig_local': '10.58.238.1',
+        'ifconfig_netmask': '255.255.254.0', 'ifconfig_pool_netmask': '255.255.254.0',
+        'ifconfig_pool_remote_ip': pool_ip,
+        'link_mtu': '1621', 'local_port_1': '1194', 'proto_1': 'udp',
+        'redirect_gateway': '0', 'remote_port_1': '1194',
+        'script_context': 'init', 'script_type': 'client-disconnect',
+        'time_ascii': time.strftime('%a %b %e %H:%M:%S %Y', time.localtime(now - duration)),
+        'time_duration': str(duration),
+        'time_unix': str(now - duration),
+        'trusted_ip': trusted_ip, 'trusted_port': trusted_port,
+        'tun_mtu': '1500',
+        'untrusted_ip': trusted_ip, 'untrusted_port': trusted_port,
+        'username': usercn, 'verb': '4',
+    }
+    if gui_ver:
+        environ['IV_GUI_VER'] = gui_ver
+    serial = 1000 + num
+    for depth, (subject, email, cert_serial) in enumerate([
+            (f'C=US, ST=Oregon, L=Corvallis, O=Work, CN={usercn}', usercn, serial),
+            (f'{_CA} (Signing)', 'ca-admin@work.net', 488),
+            (_CA, 'ca-admin@work.net', 487)]):
+        for part in subject.split(', '):
+            field, _, value = part.partition('=')
+            environ[f'X509_{depth}_{field}'] = value
+        environ[f'X509_{depth}_emailAddress'] = email
+        environ[f'tls_id_{depth}'] = f'{subject}, emailAddress={email}'
+        environ[f'tls_digest_{depth}'] = _hex_pairs(rng, 20)
+        environ[f'tls_digest_sha256_{depth}'] = _hex_pairs(rng, 32)
+        environ[f'tls_serial_{depth}'] = str(cert_serial)
+        environ[f'tls_serial_hex_{depth}'] = ':'.join(
+            f'{cert_serial:04x}'[i:i + 2] for i in range(0, 4, 2))
+    return environ
+
+def environments(count, seed=0, now=None):
+    """ Yield count environments, the same ones for the same seed. """
+    rng = random.Random(seed)
+    for num in range(count):
+        yield environment(num, now, rng)
@@ -0,0 +1,263 @@
+"""
+    Ways of getting syslog events off the box.
+
+    By default events go through python's syslog module, which opens the
+    log for every event and leaves framing and destination to libc.
+    A transport target can instead be given as:
+
+        syslog                  python's syslog module (the default)
+        unix:/dev/log           a local syslog socket (datagram, or
+                                stream if that's what's listening)
+        udp://host:514          a remote RFC 5424 collector over UDP
+        tcp://host:601          a remote RFC 5424 collector over TCP,
+                                octet-counted (RFC 6587)
+
+    Socket transports keep their connection open between events and
+    queue messages in a bounded in-memory queue.  Stream connections
+    send everything queued in one write, so a burst of events costs a
+    handful of syscalls rather than one per event.  If the queue fills
+    (say the collector is down), the oldest messages are dropped and
+    counted.
+
+    What's still queued when the process exits gets one last, quick try:
+    for the hook that's every event, and openvpn is waiting on it.
+"""
+import os
+import time
+import errno
+import atexit
+import socket
+import threading
+import collections
+
+# RFC 5424 severity for the events we send.
+SEVERITY_INFO = 6
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_BATCH_SIZE = 64
+APP_NAME = 'openvpn-client-disconnect'
+# How long to wait for a TCP collector to answer; and how long when
+# we're exiting.
+CONNECT_TIMEOUT = 5.0
+EXIT_CONNECT_TIMEOUT = 0.5
+
+
+def parse_target(target):
+    """
+        Split a target (see the module doc) into (kind, address), where
+        kind is 'syslog', 'unix', 'udp' or 'tcp'.
+    """
+    if target in (None, '', 'syslog'):
+        return 'syslog', None
+    if target.startswith('unix:'):
+        return 'unix', target[len('unix:'):]
+    for kind in ('udp', 'tcp'):
+        prefix = f'{kind}://'
+        if target.startswith(prefix):
+            host, _, port = target[len(prefix):].rpartition(':')
+            if not host or not port.isdigit():
+                break
+            return kind, (host.strip('[]'), int(port))
+    raise ValueError(f'Unparseable syslog transport {target!r}')
+
+def format_rfc3164(facility, message, app_name=APP_NAME):
+    """ A message the way a local syslog socket expects it. """
+    return f'<{facility | SEVERITY_INFO}>{app_name}[{os.getpid()}]: {message}'.encode('utf-8')
+
+def format_rfc5424(facility, message, hostname, app_name=APP_NAME, now=None):
+    """ A message for a remote collector. """
+    if now is None:
+        now = time.time()
+    stamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(now))
+    stamp = f'{stamp}.{int(now % 1 * 1000000):06d}Z'
+    return (f'<{facility | SEVERITY_INFO}>1 {stamp} {hostname} {app_name} '
+            f'{os.getpid()} - - {message}').encode('utf-8')
+
+def frame_octet_counted(payload):
+    """ RFC 6587 octet-counting framing, for stream transports. """
+    return str(len(payload)).encode('ascii') + b' ' + payload
+
+
+class ModuleSyslogTransport():
+    """
+        Python's syslog module, opened once.
+    """
+    def __init__(self, facility):
+        # Imported here: the socket transports don't need it.
+        import syslog  # pylint: disable=import-outside-toplevel
+        self._syslog = syslog
+        self.facility = facility
+        self.dropped = 0
+        syslog.openlog(facility=facility)
+
+    def send(self, message):
+        """ Log one message. """
+        self._syslog.syslog(message)
+
+    def flush(self, final=False):
+        """ Nothing is ever queued. """
+
+    def close(self):
+        """ Nothing to close. """
+
+
+class SocketTransport():
+    """
+        A persistent, queued, batching connection to a syslog socket.
+    """
+    def __init__(self, target, facility, hostname=None,
+                 queue_size=DEFAULT_QUEUE_SIZE, batch_size=DEFAULT_BATCH_SIZE):
+        self.kind, self.address = parse_target(target)
+        if self.kind == 'syslog':
+            raise ValueError('Use ModuleSyslogTransport for the syslog module')
+        self.facility = facility
+        self.hostname = hostname or socket.gethostname()
+        self.batch_size = batch_size
+        self.queue = collections.deque(maxlen=queue_size)
+        self.dropped = 0
+        self.sent = 0
+        self._sock = None
+        self._stream = self.kind == 'tcp'
+        self._lock = threading.Lock()
+
+    def _format(self, queued):
+        """ One queued (time, message), as it goes on the wire. """
+        when, message = queued
+        if self.kind == 'unix':
+            payload = format_rfc3164(self.facility, message)
+        else:
+            payload = format_rfc5424(self.facility, message, self.hostname, now=when)
+        if self._stream:
+            if self.kind == 'unix':
+                # Local stream sockets expect the traditional framing.
+                return payload + b'\n'
+            return frame_octet_counted(payload)
+        return payload
+
+    def _connect(self, timeout=CONNECT_TIMEOUT):
+        """ Open the socket if it isn't open. """
+        if self._sock is not None:
+            return
+        if self.kind == 'unix':
+            try:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                sock.connect(self.address)
+                self._stream = False
+            except OSError as err:
+                sock.close()
+                if err.errno != errno.EPROTOTYPE:
+                    raise
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(self.address)
+                self._stream = True
+        elif self.kind == 'udp':
+            sock = socket.socket(socket.AF_INET6 if ':' in self.address[0] else socket.AF_INET,
+                                 socket.SOCK_DGRAM)
+            sock.connect(self.address)
+        else:
+            sock = socket.create_connection(self.address, timeout=timeout)
+        self._sock = sock
+
+    def _disconnect(self):
+        """ Drop the socket; the next flush reconnects. """
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:  # pragma: no cover
+                pass
+            self._sock = None
+
+    def send(self, message):
+        """
+            Queue one message, and send the queue if it's a batch's worth.
+        """
+        with self._lock:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append((time.time(), message))
+            ready = len(self.queue) >= self.batch_size
+        if ready:
+            self.flush()
+
+    def flush(self, final=False):
+        """
+            Send everything queued.  Return True if the queue is empty
+            afterwards.  On a connection problem, reconnect once; if that
+            fails too, messages stay queued for next time.  With final,
+            there is no next time and no one to wait for: one attempt,
+            and a short connect timeout.
+        """
+        attempts = 1 if final else 2
+        timeout = EXIT_CONNECT_TIMEOUT if final else CONNECT_TIMEOUT
+        with self._lock:
+            for attempt in range(attempts):
+                try:
+                    self._connect(timeout)
+                    while self.queue:
+                        batch = [self.queue[i] for i in range(min(self.batch_size,
+                                                                  len(self.queue)))]
+                        frames = [self._format(x) for x in batch]
+                        if self._stream:
+                            self._sock.sendall(b''.join(frames))
+                            for _ in batch:
+                                self.queue.popleft()
+                        else:
+                            # One datagram per message; dequeue as we go so
+                            # a failure part-way doesn't resend any.
+                            for frame in frames:
+                                self._sock.send(frame)
+                                self.queue.popleft()
+                        self.sent += len(batch)
+                    return True
+                except OSError:
+                    self._disconnect()
+                    if attempt == attempts - 1:
+                        return False
+        return False  # pragma: no cover
+
+    def close(self):
+        """ Send what we can and hang up. """
+        self.flush()
+        with self._lock:
+            self._disconnect()
+
+
+# One transport per (target, facility), for the life of the process.
+_TRANSPORTS = {}
+_TRANSPORTS_LOCK = threading.Lock()
+
+def get_transport(target, facility):
+    """
+        The shared transport for target and facility, made if need be.
+        Anything still queued is sent when the process exits.
+    """
+    key = (target, facility)
+    with _TRANSPORTS_LOCK:
+        transport = _TRANSPORTS.get(key)
+        if transport is None:
+            if parse_target(target)[0] == 'syslog':
+                transport = ModuleSyslogTransport(facility)
+            else:
+                transport = SocketTransport(target, facility)
+            if not _TRANSPORTS:
+                atexit.register(flush_all, final=True)
+            _TRANSPORTS[key] = transport
+    return transport
+
+def flush_all(final=False):
+    """ Send whatever every transport has queued; see SocketTransport.flush. """
+    for transport in list(_TRANSPORTS.values()):
+        transport.flush(final)
+
+def start_flusher(interval=0.2):
+    """
+        For long-running processes: flush every transport every interval
+        seconds, so quiet periods don't leave events sitting in a queue.
+    """
+    def _loop():
+        while True:
+            time.sleep(interval)
+            flush_all()
+
+    thread = threading.Thread(target=_loop, name='transport-flusher', daemon=True)
+    thread.start()
+    return thread
@@ -37,6 +37,7 @@ def git_version():
 setup(
     name=NAME,
     packages=['openvpn_client_disconnect'],
+    scripts=['scripts/openvpn-client-disconnect-isolated'],
     version=VERSION,
     author='Greg Cox',
     author_email='gcox@mozilla.com',
@@ -44,7 +45,19 @@ setup(
     description=("Script to report on disconnecting VPN clients\n" +
                  'This package is built upon commit ' + git_version()),
     entry_points={
-        'console_scripts': ['openvpn-client-disconnect=openvpn_client_disconnect:main'],
+        'console_scripts': [
+            'openvpn-client-disconnect=openvpn_client_disconnect:main',
+            'openvpn-client-disconnect-daemon=openvpn_client_disconnect.daemon:main',
+            'openvpn-client-disconnect-compact=openvpn_client_disconnect.compact:main',
+            'openvpn-client-disconnect-query=openvpn_client_disconnect.reader:main',
+            'openvpn-client-disconnect-rollup=openvpn_client_disconnect.rollup:main',
+            'openvpn-client-disconnect-management=openvpn_client_disconnect.management:main',
+            'openvpn-client-disconnect-loadgen=openvpn_client_disconnect.loadgen:main',
+            'openvpn-client-disconnect-instrument=openvpn_client_disconnect.instrument:main',
+            'openvpn-client-disconnect-profile=openvpn_client_disconnect.profiling:main',
+            'openvpn-client-disconnect-ship=openvpn_client_disconnect.shipper:main',
+            'openvpn-client-disconnect-enrich=openvpn_client_disconnect.enrich:main',
+        ],
     },
     long_description=open('README.md').read(),
     license="MPL",
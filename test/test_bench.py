@@ -0,0 +1,70 @@
+""" openvpn-disconnect benchmark harness tests """
+
+import unittest
+import os
+import json
+import shutil
+import tempfile
+from io import StringIO
+import test.context  # pylint: disable=unused-import
+import mock
+from benchmarks import bench
+
+
+class TestBench(unittest.TestCase):
+    """
+        Tests for the benchmark harness (not for how fast anything is).
+    """
+
+    def setUp(self):
+        """ Somewhere for results """
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """ Clean up """
+        shutil.rmtree(self.workdir)
+
+    def test_01_stages(self):
+        """ Every stage can be set up and called """
+        workdir = tempfile.mkdtemp()
+        stage_bench = bench.Bench(workdir)
+        try:
+            for name in bench.STAGES:
+                if name == 'cold_process':
+                    continue
+                func, number = getattr(stage_bench, f'stage_{name}')()
+                self.assertGreater(number, 0)
+                func(stage_bench.environs[0])
+        finally:
+            stage_bench.close()
+            shutil.rmtree(workdir)
+
+    def test_02_run(self):
+        """ A run reports each stage it was asked for """
+        results = bench.run(['filter_names', 'event_build'], rounds=1)
+        self.assertEqual(sorted(results['results']), ['event_build', 'filter_names'])
+        self.assertGreater(results['results']['filter_names']['median_us'], 0)
+        self.assertIn('python', results['meta'])
+
+    def test_03_compare(self):
+        """ Only stages slower than baseline by more than the tolerance are flagged """
+        baseline = {'results': {'a': {'median_us': 10.0}, 'b': {'median_us': 10.0},
+                                'c': {'median_us': 10.0}}}
+        results = {'results': {'a': {'median_us': 12.0}, 'b': {'median_us': 13.0},
+                               'c': {'median_us': 5.0}, 'new': {'median_us': 1.0}}}
+        self.assertEqual(bench.compare(results, baseline, 0.25), {'b': 1.3})
+
+    def test_04_main_work(self):
+        """ Results are written, and a regression fails the run """
+        output = os.path.join(self.workdir, 'results.json')
+        baseline = os.path.join(self.workdir, 'baseline.json')
+        with open(baseline, 'w', encoding='utf-8') as filepointer:
+            json.dump({'results': {'filter_names': {'median_us': 0.000001}}}, filepointer)
+        with mock.patch('sys.stdout', new=StringIO()), \
+                mock.patch('sys.stderr', new=StringIO()) as fake_err:
+            self.assertFalse(bench.main_work(['bench', '--stage', 'filter_names',
+                                              '--rounds', '1', '--output', output,
+                                              '--baseline', baseline]))
+        self.assertIn('REGRESSION: filter_names', fake_err.getvalue())
+        with open(output, 'r', encoding='utf-8') as filepointer:
+            self.assertIn('filter_names', json.load(filepointer)['results'])
@@ -0,0 +1,210 @@
+""" openvpn-disconnect spool compaction tests """
+
+import unittest
+import os
+import gzip
+import json
+import shutil
+import tempfile
+from io import StringIO
+import test.context  # pylint: disable=unused-import
+import mock
+from openvpn_client_disconnect import spool
+from openvpn_client_disconnect import compact
+
+
+class TestCompact(unittest.TestCase):
+    """
+        Tests for moving the spool into archives.
+    """
+
+    def setUp(self):
+        """ Create a spool and an archive directory """
+        self.workdir = tempfile.mkdtemp()
+        self.spool_dir = os.path.join(self.workdir, 'spool')
+        self.archive_dir = os.path.join(self.workdir, 'archive')
+        os.mkdir(self.spool_dir)
+        os.mkdir(self.archive_dir)
+
+    def tearDown(self):
+        """ Clean up """
+        shutil.rmtree(self.workdir)
+
+    def _fill_files(self, count, layout='date'):
+        """ Write count per-event files, two hours' worth """
+        writer = spool.FileSpool(self.spool_dir, layout)
+        for index in range(count):
+            writer.write(f'user{index % 3}', {'common_name': f'user{index % 3}',
+                                             'time_unix': str(1591189200 + index * 7200 // count),
+                                             'index': str(index)})
+
+    def _archived(self):
+        """ Every record in every archive, checked against its index """
+        records = []
+        for name in sorted(os.listdir(self.archive_dir)):
+            if not name.endswith(compact.ARCHIVE_SUFFIX):
+                continue
+            path = os.path.join(self.archive_dir, name)
+            with gzip.open(path, 'rb') as filepointer:
+                data = filepointer.read()
+            entries = list(compact.index_entries(compact.Compactor.index_path(path)))
+            self.assertEqual(len(entries), len(data.splitlines()))
+            for epoch_seconds, usercn, offset, length in entries:
+                record = json.loads(data[offset:offset + length])
+                self.assertEqual(record['common_name'], usercn)
+                self.assertEqual(int(record['time_unix']), epoch_seconds)
+                records.append(record)
+        return records
+
+    def _spool_files(self):
+        """ Everything left in the spool """
+        return [os.path.join(root, name) for root, _dirs, names in os.walk(self.spool_dir)
+                for name in names]
+
+    def test_01_compact_files(self):
+        """ Per-event files end up in hourly archives and are removed """
+        self._fill_files(30)
+        compactor = compact.Compactor(self.spool_dir, self.archive_dir, batch_size=7)
+        self.assertEqual(compactor.run(), 30)
+        records = self._archived()
+        self.assertEqual(sorted(int(x['index']) for x in records), list(range(30)))
+        self.assertEqual(self._spool_files(), [])
+        self.assertEqual(os.listdir(self.spool_dir), [], 'Empty shards should be removed')
+        archives = [x for x in os.listdir(self.archive_dir) if x.endswith('.gz')]
+        self.assertEqual(sorted(archives), ['metrics.2020060313.jsonl.gz',
+                                            'metrics.2020060314.jsonl.gz'])
+
+    def test_02_compact_day(self):
+        """ Daily archives, appended to across runs """
+        self._fill_files(4, 'flat')
+        compact.Compactor(self.spool_dir, self.archive_dir, 'day').run()
+        self._fill_files(4, 'flat')
+        compact.Compactor(self.spool_dir, self.archive_dir, 'day').run()
+        self.assertEqual(len(self._archived()), 8)
+        self.assertTrue(os.path.exists(os.path.join(self.archive_dir,
+                                                    'metrics.20200603.jsonl.gz')))
+        with self.assertRaises(ValueError):
+            compact.Compactor(self.spool_dir, self.archive_dir, 'fortnight')
+
+    def test_03_segments(self):
+        """ Only finished segments are compacted """
+        writer = spool.SegmentSpool(self.spool_dir, max_age=3600)
+        with mock.patch('time.time', return_value=1591193143):
+            writer.write('bob', {'common_name': 'bob', 'time_unix': '1591193143'})
+            writer.write('sue', {'common_name': 'sue', 'time_unix': '1591193144'})
+        # The current window's segment stays put.
+        writer.write('amy', {'common_name': 'amy', 'time_unix': '1591193145'})
+        self.assertEqual(compact.Compactor(self.spool_dir, self.archive_dir).run(), 2)
+        self.assertEqual([x['common_name'] for x in self._archived()], ['bob', 'sue'])
+        self.assertEqual(len(self._spool_files()), 2, 'Current segment and hint remain')
+
+    def test_04_partial_segment_checkpoint(self):
+        """ A batch boundary inside a segment is resumed from, not repeated """
+        writer = spool.SegmentSpool(self.spool_dir, max_age=3600)
+        with mock.patch('time.time', return_value=1591193143):
+            for index in range(5):
+                writer.write('bob', {'common_name': 'bob', 'time_unix': '1591193143',
+                                     'index': str(index)})
+        compactor = compact.Compactor(self.spool_dir, self.archive_dir, batch_size=2)
+        real_commit = compactor._commit
+        calls = []
+
+        def _die_on_second(*args):
+            calls.append(args)
+            if len(calls) == 2:
+                raise KeyboardInterrupt
+            return real_commit(*args)
+
+        with mock.patch.object(compactor, '_commit', side_effect=_die_on_second), \
+                self.assertRaises(KeyboardInterrupt):
+            compactor.run()
+        self.assertEqual(len(self._archived()), 2)
+        compact.Compactor(self.spool_dir, self.archive_dir, batch_size=2).run()
+        self.assertEqual([x['index'] for x in self._archived()], ['0', '1', '2', '3', '4'])
+
+    def test_05_crash_while_writing(self):
+        """ A batch that died part-way through is rolled back and redone """
+        self._fill_files(10, 'flat')
+        compact.Compactor(self.spool_dir, self.archive_dir).run()
+        self._fill_files(10, 'flat')
+        real_write = gzip.GzipFile.write
+        writes = []
+
+        def _die_eventually(gzipfile, data):
+            writes.append(data)
+            if len(writes) == 5:
+                raise KeyboardInterrupt
+            return real_write(gzipfile, data)
+
+        with mock.patch('gzip.GzipFile.write', new=_die_eventually), \
+                self.assertRaises(KeyboardInterrupt):
+            compact.Compactor(self.spool_dir, self.archive_dir).run()
+        self.assertTrue(os.path.exists(os.path.join(self.archive_dir, compact.JOURNAL)))
+        compact.Compactor(self.spool_dir, self.archive_dir).run()
+        self.assertEqual(len(self._archived()), 20)
+        self.assertEqual(self._spool_files(), [])
+
+    def test_06_crash_after_commit(self):
+        """ A committed batch whose sources weren't removed yet is finished off """
+        self._fill_files(6, 'flat')
+        compactor = compact.Compactor(self.spool_dir, self.archive_dir)
+        with mock.patch.object(compactor, '_finish', side_effect=KeyboardInterrupt), \
+                self.assertRaises(KeyboardInterrupt):
+            compactor.run()
+        self.assertEqual(len(self._spool_files()), 6)
+        self.assertEqual(compact.Compactor(self.spool_dir, self.archive_dir).run(), 0)
+        self.assertEqual(len(self._archived()), 6)
+        self.assertEqual(self._spool_files(), [])
+
+    def test_07_unreadable_sources(self):
+        """ Sources with nothing readable in them are left, not removed """
+        self._fill_files(2, 'flat')
+        garbage = os.path.join(self.spool_dir, f'{spool.FILE_PREFIX}bob.1{spool.FILE_SUFFIX}')
+        with open(garbage, 'wb') as filepointer:
+            filepointer.write(b'{"common_name": "bob", "time_un')
+        empty = os.path.join(self.spool_dir, f'{spool.FILE_PREFIX}sue.1{spool.FILE_SUFFIX}')
+        open(empty, 'wb').close()
+        writer = spool.BinarySegmentSpool(self.spool_dir, max_age=3600)
+        with mock.patch('time.time', return_value=1591193143):
+            writer.write('amy', {'common_name': 'amy', 'time_unix': '1591193143'})
+        segment = [x for x in self._spool_files() if x.endswith(spool.SEGMENT_BINARY_SUFFIX)][0]
+        with open(segment, 'r+b') as filepointer:
+            filepointer.write(b'XXXX')
+        compactor = compact.Compactor(self.spool_dir, self.archive_dir)
+        self.assertEqual(compactor.run(), 2)
+        self.assertEqual(sorted(compactor.unreadable), sorted([garbage, segment]))
+        self.assertEqual(compactor.sources, 3)
+        self.assertEqual(sorted(x for x in self._spool_files()
+                                if x != os.path.join(self.spool_dir, spool.SEGMENT_HINT)),
+                         sorted([garbage, segment]))
+        # And they're still there next time.
+        self.assertEqual(compact.Compactor(self.spool_dir, self.archive_dir).run(), 0)
+        self.assertTrue(os.path.exists(garbage) and os.path.exists(segment))
+
+    def test_10_main_work(self):
+        """ The command line reads the spool location from the config """
+        self._fill_files(3, 'flat')
+        conffile = os.path.join(self.workdir, 'ocd.conf')
+        with open(conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write('[client-disconnect]\n'
+                              f'metrics-log-dir = {self.spool_dir}\n'
+                              f'metrics-archive-dir = {self.archive_dir}\n')
+        with mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            self.assertTrue(compact.main_work(['compact', '--conf', conffile]))
+        self.assertIn('Compacted 3 records from 3 spool files.', fake_out.getvalue())
+        self.assertEqual(len(self._archived()), 3)
+
+    def test_11_main_work_unconfigured(self):
+        """ Without a spool or an archive, there's nothing to do """
+        conffile = os.path.join(self.workdir, 'ocd.conf')
+        with open(conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write(f'[client-disconnect]\nmetrics-log-dir = {self.spool_dir}\n')
+        with mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            self.assertFalse(compact.main_work(['compact', '--conf', conffile]))
+        self.assertIn('No archive directory given.', fake_out.getvalue())
+        with open(conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write('[client-disconnect]\n')
+        with mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            self.assertFalse(compact.main_work(['compact', '--conf', conffile,
+                                                '--archive-dir', self.archive_dir]))
+        self.assertIn('No usable metrics-log-dir configured.', fake_out.getvalue())
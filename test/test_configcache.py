@@ -0,0 +1,119 @@
+""" openvpn-disconnect compiled settings cache tests """
+
+import unittest
+import os
+import json
+import shutil
+import tempfile
+import test.context  # pylint: disable=unused-import
+import mock
+import openvpn_client_disconnect
+from openvpn_client_disconnect import configcache, spool
+
+
+class TestConfigCache(unittest.TestCase):
+    """
+        Tests for caching compiled settings between hook runs.
+    """
+
+    def setUp(self):
+        """ Create a config file and somewhere to cache it """
+        self.workdir = tempfile.mkdtemp()
+        self.spool_dir = os.path.join(self.workdir, 'spool')
+        os.mkdir(self.spool_dir)
+        self.conffile = os.path.join(self.workdir, 'ocd.conf')
+        self.cache_path = os.path.join(self.workdir, 'settings.cache')
+        self._write_conf("['IV_*', 'bytes_sent']")
+
+    def tearDown(self):
+        """ Clean up """
+        shutil.rmtree(self.workdir)
+
+    def _write_conf(self, metrics, spool_dir=None):
+        """ (Re)write the config file """
+        with open(self.conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write('[client-disconnect]\n'
+                              f'metrics-log-dir = {spool_dir or self.spool_dir}\n'
+                              f'metrics = {metrics}\n'
+                              'syslog-events-send = true\n'
+                              'syslog-events-facility = local5\n'
+                              'metrics-spool-format = segments\n')
+
+    def test_01_compile_and_reuse(self):
+        """ The first load compiles and caches; the next only reads the cache """
+        first = configcache.load_settings(self.conffile, self.cache_path)
+        self.assertTrue(os.path.exists(self.cache_path))
+        self.assertEqual(os.stat(self.cache_path).st_mode & 0o777, 0o600)
+        with mock.patch.object(openvpn_client_disconnect,
+                               'ingest_config_from_file') as mock_ingest:
+            second = configcache.load_settings(self.conffile, self.cache_path)
+        mock_ingest.assert_not_called()
+        self.assertEqual(second, first)
+        self.assertIsInstance(second['metrics_requested'],
+                              openvpn_client_disconnect.MetricSelector)
+        self.assertEqual(second['metrics_requested'].prefixes, ('IV_',))
+        self.assertEqual(second['metrics_log_dir'], self.spool_dir)
+        self.assertEqual(second['spool_options'], {'format': 'segments'})
+
+    def test_02_config_changed(self):
+        """ Changing the config file invalidates the cache """
+        configcache.load_settings(self.conffile, self.cache_path)
+        self._write_conf("['bytes_received', 'tls_*_0']")
+        settings = configcache.load_settings(self.conffile, self.cache_path)
+        self.assertEqual(settings['metrics_requested'], set(['bytes_received', 'tls_*_0']))
+        with open(self.cache_path, 'r', encoding='utf-8') as filepointer:
+            cached = json.load(filepointer)
+        self.assertEqual(cached['settings']['metrics_requested']['patterns'],
+                         ['bytes_received', 'tls_*_0'])
+
+    def test_03_directories_rechecked(self):
+        """ Spool directory usability is checked on every load, not cached """
+        configcache.load_settings(self.conffile, self.cache_path)
+        os.rmdir(self.spool_dir)
+        settings = configcache.load_settings(self.conffile, self.cache_path)
+        self.assertIsNone(settings['metrics_log_dir'])
+        os.mkdir(self.spool_dir)
+        settings = configcache.load_settings(self.conffile, self.cache_path)
+        self.assertEqual(settings['metrics_log_dir'], self.spool_dir)
+
+    def test_04_untrusted_cache(self):
+        """ A cache others can write, or that's garbage, is ignored """
+        configcache.load_settings(self.conffile, self.cache_path)
+        os.chmod(self.cache_path, 0o666)
+        with mock.patch.object(openvpn_client_disconnect, 'ingest_config_from_file',
+                               wraps=openvpn_client_disconnect.ingest_config_from_file) \
+                as mock_ingest:
+            configcache.load_settings(self.conffile, self.cache_path)
+            mock_ingest.assert_called_once()
+            with open(self.cache_path, 'w', encoding='utf-8') as filepointer:
+                filepointer.write('not json')
+            os.chmod(self.cache_path, 0o600)
+            configcache.load_settings(self.conffile, self.cache_path)
+            self.assertEqual(mock_ingest.call_count, 2)
+
+    def test_05_unwritable_cache(self):
+        """ Not being able to write the cache just means compiling every time """
+        cache_path = os.path.join(self.workdir, 'nonexistent', 'settings.cache')
+        settings = configcache.load_settings(self.conffile, cache_path)
+        self.assertEqual(settings['metrics_log_dir'], self.spool_dir)
+        self.assertEqual(sorted(os.listdir(self.workdir)), ['ocd.conf', 'spool'])
+
+    def test_06_missing_config(self):
+        """ No config file is the same error as without a cache """
+        with self.assertRaises(IOError):
+            configcache.load_settings(os.path.join(self.workdir, 'nope'), self.cache_path)
+
+    def test_07_main_work(self):
+        """ The hook uses the cache when asked to """
+        with mock.patch.dict(os.environ, {'common_name': 'bob', 'trusted_ip': '1.2.3.4',
+                                          'time_unix': '1591193143', 'IV_VER': '2.4.9'}), \
+                mock.patch.object(openvpn_client_disconnect, 'log_event') as mock_logevent:
+            self.assertTrue(openvpn_client_disconnect.main_work(
+                ['script', '--conf', self.conffile, '--settings-cache', self.cache_path]))
+        self.assertTrue(os.path.exists(self.cache_path))
+        mock_logevent.assert_called_once()
+        records = [record
+                   for path in spool.iter_spool_sources(self.spool_dir, finished_only=False)
+                   for _start, _end, record in spool.read_records(path)]
+        self.assertEqual(records, [{'common_name': 'bob', 'time_unix': '1591193143',
+                                    'IV_VER': '2.4.9'}])
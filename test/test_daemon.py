@@ -0,0 +1,151 @@
+""" openvpn-disconnect daemon tests """
+
+import unittest
+import os
+import json
+import shutil
+import tempfile
+import threading
+from io import StringIO
+import test.context  # pylint: disable=unused-import
+import mock
+import openvpn_client_disconnect
+from openvpn_client_disconnect import daemon
+from openvpn_client_disconnect import server
+
+
+class TestDaemon(unittest.TestCase):
+    """
+        Tests for the persistent daemon and the forwarding client.
+    """
+
+    def setUp(self):
+        """ Create a config and a place for the socket """
+        self.workdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.workdir, 'ocd.sock')
+        self.conffile = os.path.join(self.workdir, 'ocd.conf')
+        with open(self.conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write('[client-disconnect]\n'
+                              f'metrics-log-dir = {self.workdir}\n'
+                              "metrics = ['trusted_ip']\n")
+        self.server = None
+        self.thread = None
+
+    def tearDown(self):
+        """ Stop any server and clean up """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+        shutil.rmtree(self.workdir)
+
+    def _start_server(self):
+        """ Run a daemon in a thread """
+        self.server = server.DisconnectServer(self.socket_path, self.conffile)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def _forward(self, num):
+        """ Forward a good event to the daemon; return its answer """
+        return daemon.forward_event(self.socket_path, {'common_name': 'bob',
+                                                       'trusted_ip': '10.0.0.1',
+                                                       'time_unix': str(1591193143 + num)})
+
+    def test_02_forward_no_daemon(self):
+        """ With nobody listening, tell the caller to do it themselves """
+        self.assertIsNone(daemon.forward_event(self.socket_path, {'common_name': 'bob'}))
+
+    def test_03_forward_event(self):
+        """ A forwarded event is written by the daemon """
+        self._start_server()
+        result = daemon.forward_event(self.socket_path,
+                                      {'common_name': 'bob', 'trusted_ip': '1.2.3.4',
+                                       'time_unix': '1591193143',
+                                       'password': 'hunter2'})  # nosec
+        self.assertEqual(result, (True, ''))
+        written = [x for x in os.listdir(self.workdir) if x.startswith('log.bob.')]
+        self.assertEqual(len(written), 1)
+        with open(os.path.join(self.workdir, written[0]), encoding='utf-8') as filepointer:
+            record = json.load(filepointer)
+        self.assertEqual(record, {'common_name': 'bob', 'time_unix': '1591193143',
+                                  'trusted_ip': '1.2.3.4'})
+
+    def test_04_forward_bad_event(self):
+        """ The daemon's validation failures come back to the hook """
+        self._start_server()
+        result = daemon.forward_event(self.socket_path, {'common_name': 'bob'})
+        self.assertEqual(result, (False, 'No trusted_ip environment variable provided.'))
+
+    def test_05_daemon_survives_errors(self):
+        """ An exception while handling becomes a failure reply """
+        self._start_server()
+        with mock.patch.object(openvpn_client_disconnect, 'handle_disconnect',
+                               side_effect=RuntimeError('boom')):
+            result = daemon.forward_event(self.socket_path, {'common_name': 'bob'})
+        self.assertFalse(result[0])
+        self.assertIn('boom', result[1])
+
+    def test_06_reload(self):
+        """ reload picks up a changed config """
+        self._start_server()
+        self.assertFalse(self.server.settings['event_send'])
+        with open(self.conffile, 'a', encoding='utf-8') as filepointer:
+            filepointer.write('syslog-events-send = true\n')
+        self.assertTrue(self.server.reload())
+        self.assertTrue(self.server.settings['event_send'])
+
+    def test_07_reload_broken(self):
+        """ A broken config on reload leaves the daemon as it was """
+        self._start_server()
+        settings = self.server.settings
+        with open(self.conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write('this is not a config file\n')
+        with mock.patch('sys.stderr', new=StringIO()) as fake_err:
+            self.assertFalse(self.server.reload())
+        self.assertIs(self.server.settings, settings)
+        self.assertIn(self.conffile, fake_err.getvalue())
+        result = self._forward(1)
+        self.assertEqual(result, (True, ''))
+
+    def test_08_socket_in_use(self):
+        """ A live daemon's socket is left alone; a dead one's is replaced """
+        self._start_server()
+        with mock.patch('sys.stderr', new=StringIO()) as fake_err:
+            self.assertFalse(daemon.main_work(['daemon', '--conf', self.conffile,
+                                               '--socket', self.socket_path]))
+        self.assertIn('already listening', fake_err.getvalue())
+        result = self._forward(2)
+        self.assertEqual(result, (True, ''))
+        # Stopped without cleaning up after itself.
+        self.server.shutdown()
+        self.thread.join()
+        self.server.socket.close()
+        self.server = None
+        self.assertTrue(os.path.exists(self.socket_path))
+        self.assertFalse(server.socket_in_use(self.socket_path))
+        self._start_server()
+        result = self._forward(3)
+        self.assertEqual(result, (True, ''))
+
+    def test_10_main_work_forwards(self):
+        """ main_work hands off to the daemon when one is running """
+        with mock.patch.object(daemon, 'forward_event',
+                               return_value=(False, 'nope')) as mock_forward, \
+                mock.patch.object(openvpn_client_disconnect,
+                                  'handle_disconnect') as mock_handle, \
+                mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            result = openvpn_client_disconnect.main_work(['script', '--conf', self.conffile,
+                                                          '--daemon-socket', self.socket_path])
+        self.assertFalse(result)
+        mock_forward.assert_called_once_with(self.socket_path, os.environ)
+        mock_handle.assert_not_called()
+        self.assertIn('nope', fake_out.getvalue())
+
+    def test_11_main_work_fallback(self):
+        """ main_work does the work itself when the daemon is down """
+        with mock.patch.object(openvpn_client_disconnect, 'handle_disconnect',
+                               return_value=(True, '')) as mock_handle:
+            result = openvpn_client_disconnect.main_work(['script', '--conf', self.conffile,
+                                                          '--daemon-socket', self.socket_path])
+        self.assertTrue(result)
+        mock_handle.assert_called_once()
@@ -0,0 +1,217 @@
+""" openvpn-disconnect network enrichment tests """
+
+import unittest
+import os
+import io
+import json
+import shutil
+import tempfile
+import ipaddress
+import test.context  # pylint: disable=unused-import
+import mock
+import openvpn_client_disconnect
+from openvpn_client_disconnect import enrich
+
+NETWORKS_CSV = """network,site,asn
+# Offices
+10.0.0.0/8,corp,
+10.1.0.0/16,mtv,AS1
+10.1.2.0/24,mtv-lab,AS1
+192.0.2.0/24,tor,AS64500
+2001:db8::/32,v6-corp,AS64501
+2001:db8:1::/48,v6-ber,AS64501
+"""
+
+
+class TestEnrich(unittest.TestCase):
+    """
+        Tests for compiling and searching the network table.
+    """
+
+    def setUp(self):
+        """ A CSV and a table compiled from it """
+        self.workdir = tempfile.mkdtemp()
+        self.csv_path = os.path.join(self.workdir, 'networks.csv')
+        self.table_path = os.path.join(self.workdir, 'networks.table')
+        self._write_csv(NETWORKS_CSV)
+        enrich._TABLES.clear()
+
+    def tearDown(self):
+        """ Clean up """
+        for _key, table in enrich._TABLES.values():
+            table.close()
+        enrich._TABLES.clear()
+        shutil.rmtree(self.workdir)
+
+    def _write_csv(self, text):
+        """ Replace the CSV """
+        with open(self.csv_path, 'w', encoding='utf-8') as filepointer:
+            filepointer.write(text)
+
+    def test_01_address_key(self):
+        """ Keys sort like addresses, with IPv4 mapped into IPv6 """
+        self.assertEqual(enrich.address_key('10.1.2.3'),
+                         ipaddress.IPv6Address('::ffff:10.1.2.3').packed)
+        self.assertEqual(enrich.address_key('2001:db8::1'),
+                         ipaddress.IPv6Address('2001:db8::1').packed)
+        self.assertLess(enrich.address_key('9.255.255.255'), enrich.address_key('10.0.0.0'))
+        for bad in ['10.1.2', '10.1.2.256', 'bob', '', '2001:db8::g', '-1.2.3.4']:
+            with self.assertRaises(ValueError, msg=bad):
+                enrich.address_key(bad)
+
+    def test_02_compile_ranges(self):
+        """ Nested networks become non-overlapping ranges, innermost winning """
+        nets = [(ipaddress.ip_network(x), ()) for x in
+                ['10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24', '10.3.0.0/16', '10.1.2.0/24']]
+        ranges = enrich.compile_ranges(nets)
+        base = 0xffff << 32
+        self.assertEqual([(hex(x - base), hex(y - base), num) for x, y, num in ranges], [
+            ('0xa000000', '0xa00ffff', 0),
+            ('0xa010000', '0xa0101ff', 1),
+            ('0xa010200', '0xa0102ff', 4),
+            ('0xa010300', '0xa01ffff', 1),
+            ('0xa020000', '0xa02ffff', 0),
+            ('0xa030000', '0xa03ffff', 3),
+            ('0xa040000', '0xaffffff', 0),
+        ])
+        for (_first, last, _num), (first, _last, _other) in zip(ranges, ranges[1:]):
+            self.assertLess(last, first)
+
+    def test_03_lookup(self):
+        """ The most specific network, its columns, and nothing for the unknown """
+        self.assertEqual(enrich.compile_csv(self.csv_path, self.table_path), (6, 9))
+        table = enrich.RangeTable(self.table_path)
+        self.assertEqual(table.fields, ('source_network', 'source_site', 'source_asn'))
+        self.assertEqual(table.fields_for('10.1.2.77'), {
+            'source_network': '10.1.2.0/24', 'source_site': 'mtv-lab', 'source_asn': 'AS1'})
+        self.assertEqual(table.fields_for('10.1.3.1')['source_site'], 'mtv')
+        # Empty values are left out.
+        self.assertEqual(table.fields_for('10.200.0.1'), {
+            'source_network': '10.0.0.0/8', 'source_site': 'corp'})
+        self.assertEqual(table.fields_for('10.255.255.255')['source_site'], 'corp')
+        self.assertEqual(table.fields_for('2001:db8:1:2::5')['source_site'], 'v6-ber')
+        self.assertEqual(table.fields_for('2001:db8:2::5')['source_site'], 'v6-corp')
+        for outside in ['9.255.255.255', '11.0.0.0', '0.0.0.0', '192.0.3.0', '::1',
+                        'ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff']:
+            self.assertEqual(table.fields_for(outside), {}, outside)
+        table.close()
+
+    def test_04_matches_ipaddress(self):
+        """ Lookups agree with asking ipaddress about every network """
+        lines = ['network,site']
+        for num in range(200):
+            lines.append(f'10.{num}.0.0/16,big{num}')
+            lines.append(f'10.{num}.{num}.0/24,small{num}')
+        self._write_csv('\n'.join(lines) + '\n')
+        enrich.compile_csv(self.csv_path, self.table_path)
+        _columns, networks = enrich.read_csv(self.csv_path)
+        table = enrich.RangeTable(self.table_path)
+        for address in ['10.0.0.0', '10.5.5.5', '10.5.6.5', '10.199.199.255', '10.200.0.0',
+                        '10.17.17.0', '10.17.16.255', '10.17.18.0']:
+            matching = [x for x in networks if ipaddress.ip_address(address) in x[0]]
+            expected = max(matching, key=lambda x: x[0].prefixlen)[1][0] if matching else None
+            self.assertEqual(table.fields_for(address).get('source_site'), expected, address)
+        table.close()
+
+    def test_05_bad_csv(self):
+        """ Mistakes in the CSV are reported with their line """
+        for text, problem in [('network,Site\n', 'column name'),
+                              ('network,network\n', 'column name'),
+                              ('network,site\n10.0.0.1/8,x\n', ':2:'),
+                              ('network,site\nbob,x\n', ':2:'),
+                              ('network,site\n10.0.0.0/8,x,y\n', 'more values'),
+                              ('', 'header')]:
+            self._write_csv(text)
+            with self.assertRaises(ValueError) as raised:
+                enrich.read_csv(self.csv_path)
+            self.assertIn(problem, str(raised.exception))
+
+    def test_06_bad_table(self):
+        """ Anything but a whole table is refused """
+        enrich.compile_csv(self.csv_path, self.table_path)
+        with open(self.table_path, 'rb') as filepointer:
+            data = filepointer.read()
+        for broken in [b'', b'not a table at all', data[:-3], data + b'x']:
+            with open(self.table_path, 'wb') as filepointer:
+                filepointer.write(broken)
+            with self.assertRaises(ValueError):
+                enrich.RangeTable(self.table_path)
+
+    def test_07_replaced_table(self):
+        """ A recompiled table is picked up by the next lookup """
+        enrich.compile_csv(self.csv_path, self.table_path)
+        self.assertEqual(enrich.lookup_fields(self.table_path, '192.0.2.1')['source_site'],
+                         'tor')
+        first = enrich.table_for(self.table_path)
+        self.assertIs(enrich.table_for(self.table_path), first)
+        self._write_csv('network,site\n192.0.2.0/24,yyz\n')
+        enrich.compile_csv(self.csv_path, self.table_path)
+        self.assertEqual(enrich.lookup_fields(self.table_path, '192.0.2.1')['source_site'],
+                         'yyz')
+        first.close()
+        self.assertEqual(sorted(os.listdir(self.workdir)), ['networks.csv', 'networks.table'])
+
+    def test_08_hook_enriches(self):
+        """ The spool record and the syslog event both get the fields """
+        enrich.compile_csv(self.csv_path, self.table_path)
+        spool_dir = os.path.join(self.workdir, 'spool')
+        os.mkdir(spool_dir)
+        settings = {'detach_queue_dir': None, 'metrics_log_dir': spool_dir,
+                    'metrics_requested': ['bytes_sent'], 'spool_options': None,
+                    'event_send': True, 'event_facility': 0, 'enrich_table': self.table_path}
+        environ = {'common_name': 'bob', 'trusted_ip': '10.1.2.3', 'bytes_sent': '5',
+                   'time_unix': '1591189200'}
+        with mock.patch.object(openvpn_client_disconnect, 'log_event') as log_event:
+            self.assertEqual(openvpn_client_disconnect.handle_disconnect(settings, environ),
+                             (True, ''))
+        expected = {'source_network': '10.1.2.0/24', 'source_site': 'mtv-lab',
+                    'source_asn': 'AS1'}
+        self.assertEqual(log_event.call_args[1]['enrichment'], expected)
+        names = os.listdir(spool_dir)
+        self.assertEqual(len(names), 1)
+        with open(os.path.join(spool_dir, names[0]), 'r', encoding='utf-8') as filepointer:
+            record = json.load(filepointer)
+        self.assertEqual(record, dict(expected, bytes_sent='5', common_name='bob',
+                                             time_unix='1591189200'))
+        event = openvpn_client_disconnect.build_event('bob', environ, 'vpn', expected)
+        self.assertEqual(event['details']['source_site'], 'mtv-lab')
+        self.assertEqual(event['details']['sourceipaddress'], '10.1.2.3')
+
+    def test_09_hook_without_table(self):
+        """ A table that's missing, or an address it can't place, loses nothing """
+        settings = {'enrich_table': os.path.join(self.workdir, 'nope')}
+        self.assertIsNone(openvpn_client_disconnect._enrichment(settings, '10.1.2.3'))
+        enrich.compile_csv(self.csv_path, self.table_path)
+        settings['enrich_table'] = self.table_path
+        self.assertIsNone(openvpn_client_disconnect._enrichment(settings, 'bob'))
+        self.assertEqual(openvpn_client_disconnect._enrichment(settings, '8.8.8.8'), {})
+        self.assertIsNone(openvpn_client_disconnect._enrichment({}, '10.1.2.3'))
+
+    def test_10_main(self):
+        """ The command line compiles the configured table and looks up addresses """
+        conffile = os.path.join(self.workdir, 'ocd.conf')
+        with open(conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write(f'[client-disconnect]\nenrich-table = {self.table_path}\n')
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            self.assertTrue(enrich.main_work(['enrich', '--conf', conffile,
+                                              '--csv', self.csv_path,
+                                              '--lookup', '192.0.2.9', '--lookup', '8.8.8.8']))
+        lines = stdout.getvalue().splitlines()
+        self.assertIn('6 networks compiled into 9 ranges', lines[0])
+        self.assertEqual(json.loads(lines[1])['192.0.2.9']['source_asn'], 'AS64500')
+        self.assertEqual(json.loads(lines[2]), {'8.8.8.8': {}})
+        with mock.patch('sys.stderr', new_callable=io.StringIO):
+            self.assertFalse(enrich.main_work(['enrich', '--table', self.table_path,
+                                               '--lookup', 'bob']))
+            with self.assertRaises(SystemExit):
+                enrich.main_work(['enrich', '--table', self.table_path])
+            with self.assertRaises(SystemExit):
+                enrich.main_work(['enrich', '--lookup', '10.0.0.1'])
+        with mock.patch.object(enrich, 'main_work', return_value=True), \
+                self.assertRaises(SystemExit) as exiting:
+            enrich.main()
+        self.assertEqual(exiting.exception.code, 0)
+        with mock.patch.object(enrich, 'main_work', return_value=False), \
+                self.assertRaises(SystemExit) as exiting:
+            enrich.main()
+        self.assertEqual(exiting.exception.code, 1)
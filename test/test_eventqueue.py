@@ -0,0 +1,198 @@
+""" openvpn-disconnect detach queue tests """
+
+import unittest
+import os
+import json
+import fcntl
+import shutil
+import tempfile
+import test.context  # pylint: disable=unused-import
+import mock
+import openvpn_client_disconnect
+from openvpn_client_disconnect import eventqueue
+
+
+class TestEventQueue(unittest.TestCase):
+    """
+        Tests for the write-ahead queue used by detach mode.
+    """
+
+    def setUp(self):
+        """ Create a queue directory """
+        self.queue_dir = tempfile.mkdtemp()
+        self.handled = []
+
+    def tearDown(self):
+        """ Clean up """
+        shutil.rmtree(self.queue_dir)
+
+    def _handler(self, environ):
+        """ Remember what we were given """
+        self.handled.append(environ)
+
+    def test_01_enqueue_drain(self):
+        """ Events come out in the order they went in, minus secrets """
+        eventqueue.enqueue(self.queue_dir, {'common_name': 'one', 'password': 'x'})  # nosec
+        eventqueue.enqueue(self.queue_dir, {'common_name': 'two'})
+        self.assertEqual(eventqueue.drain(self.queue_dir, self._handler), 2)
+        self.assertEqual(self.handled, [{'common_name': 'one'}, {'common_name': 'two'}])
+        self.assertEqual(sorted(os.listdir(self.queue_dir)), [eventqueue.WORKER_LOCK])
+
+    def test_02_drain_empty(self):
+        """ An empty queue is fine """
+        self.assertEqual(eventqueue.drain(self.queue_dir, self._handler), 0)
+
+    def test_03_resume_after_crash(self):
+        """ A claimed journal left by a dead worker is resumed from its offset """
+        eventqueue.enqueue(self.queue_dir, {'common_name': 'one'})
+        eventqueue.enqueue(self.queue_dir, {'common_name': 'two'})
+        claimed = eventqueue._claim_journal(self.queue_dir)
+        with open(claimed, 'rb') as filepointer:
+            first_line = filepointer.readline()
+        eventqueue._write_offset(claimed + eventqueue.OFFSET_SUFFIX, len(first_line))
+        eventqueue.enqueue(self.queue_dir, {'common_name': 'three'})
+        self.assertEqual(eventqueue.drain(self.queue_dir, self._handler), 2)
+        self.assertEqual(self.handled, [{'common_name': 'two'}, {'common_name': 'three'}])
+
+    def test_04_torn_line(self):
+        """ A half-written final line is skipped, not fatal """
+        eventqueue.enqueue(self.queue_dir, {'common_name': 'one'})
+        with open(os.path.join(self.queue_dir, eventqueue.JOURNAL), 'ab') as filepointer:
+            filepointer.write(b'{"common_na')
+        self.assertEqual(eventqueue.drain(self.queue_dir, self._handler), 1)
+
+    def test_05_drain_locked(self):
+        """ Only one worker drains at a time """
+        eventqueue.enqueue(self.queue_dir, {'common_name': 'one'})
+        lock_fd = eventqueue._try_lock(self.queue_dir)
+        try:
+            self.assertTrue(eventqueue.worker_running(self.queue_dir))
+            self.assertEqual(eventqueue.drain(self.queue_dir, self._handler), 0)
+        finally:
+            os.close(lock_fd)
+        self.assertFalse(eventqueue.worker_running(self.queue_dir))
+
+    def test_06_enqueue_after_claim(self):
+        """ An enqueuer that lost the race to a claim writes to a new journal """
+        path = os.path.join(self.queue_dir, eventqueue.JOURNAL)
+        real_flock = fcntl.flock
+        claimed = []
+
+        def _claim_then_lock(fdesc, operation):
+            if not claimed:
+                claimed.append(eventqueue._claim_journal(self.queue_dir))
+            return real_flock(fdesc, operation)
+
+        with mock.patch('fcntl.flock', side_effect=_claim_then_lock):
+            eventqueue.enqueue(self.queue_dir, {'common_name': 'one'})
+        self.assertEqual(os.path.getsize(claimed[0]), 0)
+        self.assertGreater(os.path.getsize(path), 0)
+
+    def test_10_submit(self):
+        """ submit starts a worker only if none is running """
+        with mock.patch.object(eventqueue, 'spawn_worker') as mock_spawn:
+            eventqueue.submit(self.queue_dir, '/some/conf', {'common_name': 'one'})
+        mock_spawn.assert_called_once_with('/some/conf')
+        lock_fd = eventqueue._try_lock(self.queue_dir)
+        try:
+            with mock.patch.object(eventqueue, 'spawn_worker') as mock_spawn:
+                eventqueue.submit(self.queue_dir, '/some/conf', {'common_name': 'two'})
+            mock_spawn.assert_not_called()
+        finally:
+            os.close(lock_fd)
+
+    def test_11_handle_disconnect_detaches(self):
+        """ With a queue configured, handle_disconnect only queues """
+        settings = {'detach_queue_dir': self.queue_dir, 'conffile': '/some/conf'}
+        environ = {'common_name': 'bob', 'trusted_ip': '1.2.3.4'}
+        with mock.patch.object(eventqueue, 'submit') as mock_submit, \
+                mock.patch.object(openvpn_client_disconnect,
+                                  'log_metrics_to_disk') as mock_metrics:
+            result = openvpn_client_disconnect.handle_disconnect(settings, environ)
+        self.assertEqual(result, (True, ''))
+        mock_submit.assert_called_once_with(self.queue_dir, '/some/conf', environ)
+        mock_metrics.assert_not_called()
+
+    def test_12_main_work(self):
+        """ The worker drains the configured queue with detach turned off """
+        conffile = os.path.join(self.queue_dir, 'ocd.conf')
+        with open(conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write(f'[client-disconnect]\ndetach-queue-dir = {self.queue_dir}\n')
+        eventqueue.enqueue(self.queue_dir, {'common_name': 'bob', 'trusted_ip': '1.2.3.4'})
+        eventqueue.enqueue(self.queue_dir, {'common_name': 'sue', 'trusted_ip': '1.2.3.4'})
+        with mock.patch.object(openvpn_client_disconnect, 'handle_disconnect',
+                               return_value=(True, '')) as mock_handle:
+            self.assertTrue(eventqueue.main_work(['worker', '--conf', conffile]))
+        self.assertEqual(mock_handle.call_count, 2)
+        self.assertFalse(mock_handle.call_args[1]['detach'])
+        self.assertFalse(os.path.exists(os.path.join(self.queue_dir, eventqueue.FAILED)))
+
+    def test_13_main_work_unconfigured(self):
+        """ Without a queue configured, the worker has nothing to do """
+        conffile = os.path.join(self.queue_dir, 'ocd.conf')
+        with open(conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write('[client-disconnect]\n')
+        self.assertFalse(eventqueue.main_work(['worker', '--conf', conffile]))
+
+    def test_14_submit_while_spawning(self):
+        """ Only one worker is started until it gets going """
+        with mock.patch.object(eventqueue, 'spawn_worker') as mock_spawn:
+            for num in range(100):
+                eventqueue.submit(self.queue_dir, '/some/conf', {'common_name': f'u{num}'})
+        self.assertEqual(mock_spawn.call_count, 1)
+        # The worker clears the mark as it starts, so the next event can start another.
+        conffile = os.path.join(self.queue_dir, 'ocd.conf')
+        with open(conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write(f'[client-disconnect]\ndetach-queue-dir = {self.queue_dir}\n')
+        with mock.patch.object(openvpn_client_disconnect, 'handle_disconnect',
+                               return_value=(True, '')) as mock_handle:
+            self.assertTrue(eventqueue.main_work(['worker', '--conf', conffile]))
+        self.assertEqual(mock_handle.call_count, 100)
+        self.assertFalse(os.path.exists(os.path.join(self.queue_dir, eventqueue.SPAWNING)))
+        with mock.patch.object(eventqueue, 'spawn_worker') as mock_spawn:
+            eventqueue.submit(self.queue_dir, '/some/conf', {'common_name': 'late'})
+        mock_spawn.assert_called_once_with('/some/conf')
+        # A worker that never started doesn't hold everyone else up for long.
+        marker = os.path.join(self.queue_dir, eventqueue.SPAWNING)
+        stale = os.path.getmtime(marker) - eventqueue.STALE_SPAWN_SECONDS - 1
+        os.utime(marker, (stale, stale))
+        with mock.patch.object(eventqueue, 'spawn_worker') as mock_spawn:
+            eventqueue.submit(self.queue_dir, '/some/conf', {'common_name': 'later'})
+        mock_spawn.assert_called_once_with('/some/conf')
+        # Nor does one that couldn't be started at all.
+        os.unlink(marker)
+        with mock.patch.object(eventqueue, 'spawn_worker', side_effect=OSError('no')), \
+                self.assertRaises(OSError):
+            eventqueue.submit(self.queue_dir, '/some/conf', {'common_name': 'last'})
+        self.assertFalse(os.path.exists(marker))
+
+    def test_15_failed_events_kept(self):
+        """ Events the worker can't report are kept aside and logged, not lost """
+        conffile = os.path.join(self.queue_dir, 'ocd.conf')
+        with open(conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write(f'[client-disconnect]\ndetach-queue-dir = {self.queue_dir}\n')
+        for usercn in ('bob', 'sue', 'amy'):
+            eventqueue.enqueue(self.queue_dir, {'common_name': usercn, 'trusted_ip': '1.2.3.4'})
+        results = [RuntimeError('boom'), (False, 'No trusted_ip'), (True, '')]
+        with mock.patch.object(openvpn_client_disconnect, 'handle_disconnect',
+                               side_effect=results) as mock_handle, \
+                mock.patch('syslog.syslog') as mock_syslog:
+            self.assertTrue(eventqueue.main_work(['worker', '--conf', conffile]))
+        self.assertEqual(mock_handle.call_count, 3)
+        failed = os.path.join(self.queue_dir, eventqueue.FAILED)
+        with open(failed, 'r', encoding='utf-8') as filepointer:
+            self.assertEqual([json.loads(x)['common_name'] for x in filepointer], ['bob', 'sue'])
+        self.assertEqual(mock_syslog.call_count, 2)
+        self.assertIn('boom', mock_syslog.call_args_list[0][0][1])
+        self.assertIn('No trusted_ip', mock_syslog.call_args_list[1][0][1])
+        # If they can't even be kept aside, they stay queued.
+        eventqueue.enqueue(self.queue_dir, {'common_name': 'joe', 'trusted_ip': '1.2.3.4'})
+        with mock.patch.object(openvpn_client_disconnect, 'handle_disconnect',
+                               return_value=(False, 'nope')), \
+                mock.patch.object(eventqueue, '_keep_failed', side_effect=OSError('full')), \
+                self.assertRaises(OSError):
+            eventqueue.main_work(['worker', '--conf', conffile])
+        with mock.patch.object(openvpn_client_disconnect, 'handle_disconnect',
+                               return_value=(True, '')) as mock_handle:
+            self.assertTrue(eventqueue.main_work(['worker', '--conf', conffile]))
+        self.assertEqual(mock_handle.call_args[0][1]['common_name'], 'joe')
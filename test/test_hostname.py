@@ -0,0 +1,99 @@
+""" openvpn-disconnect hostname cache tests """
+
+import unittest
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+import test.context  # pylint: disable=unused-import
+import mock
+from openvpn_client_disconnect import hostname
+
+
+class TestHostname(unittest.TestCase):
+    """
+        Tests for the cached FQDN lookup.
+    """
+
+    def setUp(self):
+        """ Create a place for the cache """
+        self.workdir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.workdir, 'fqdn.cache')
+
+    def tearDown(self):
+        """ Clean up """
+        shutil.rmtree(self.workdir)
+
+    def _write(self, fqdn, resolved_at):
+        """ Seed the cache """
+        with open(self.cache_file, 'w', encoding='utf-8') as filepointer:
+            json.dump({'fqdn': fqdn, 'resolved_at': resolved_at}, filepointer)
+
+    def test_01_resolve(self):
+        """ A quick lookup is used """
+        with mock.patch('socket.getfqdn', return_value='my.host.name'):
+            self.assertEqual(hostname.resolve_fqdn(), 'my.host.name')
+
+    def test_02_resolve_timeout(self):
+        """ A slow lookup is abandoned in favor of gethostname """
+        release = threading.Event()
+
+        def _slow():
+            release.wait(5)
+            return 'slow.host.name'
+
+        try:
+            with mock.patch('socket.getfqdn', side_effect=_slow), \
+                    mock.patch('socket.gethostname', return_value='myhost'):
+                self.assertEqual(hostname.resolve_fqdn(0.05), 'myhost')
+        finally:
+            release.set()
+
+    def test_03_no_cache(self):
+        """ With no cache, resolve now and remember it """
+        with mock.patch('socket.getfqdn', return_value='my.host.name'):
+            self.assertEqual(hostname.cached_fqdn(self.cache_file), 'my.host.name')
+        self.assertEqual(hostname._read_cache(self.cache_file)[0], 'my.host.name')
+
+    def test_04_fresh_cache(self):
+        """ A fresh cache means no lookup at all """
+        self._write('cached.host.name', time.time())
+        with mock.patch('socket.getfqdn') as mock_getfqdn, \
+                mock.patch.object(hostname, '_start_background_refresh') as mock_refresh:
+            self.assertEqual(hostname.cached_fqdn(self.cache_file, 60), 'cached.host.name')
+        mock_getfqdn.assert_not_called()
+        mock_refresh.assert_not_called()
+
+    def test_05_stale_cache(self):
+        """ A stale cache is still used, with a refresh in the background """
+        self._write('cached.host.name', time.time() - 120)
+        with mock.patch('socket.getfqdn') as mock_getfqdn, \
+                mock.patch.object(hostname, '_start_background_refresh') as mock_refresh:
+            self.assertEqual(hostname.cached_fqdn(self.cache_file, 60, 1.0),
+                             'cached.host.name')
+        mock_getfqdn.assert_not_called()
+        mock_refresh.assert_called_once_with(self.cache_file, 1.0)
+
+    def test_06_corrupt_cache(self):
+        """ An unreadable cache is the same as none """
+        with open(self.cache_file, 'w', encoding='utf-8') as filepointer:
+            filepointer.write('{"fqdn": ')
+        self.assertEqual(hostname._read_cache(self.cache_file), (None, 0))
+
+    def test_07_background_refresh_once(self):
+        """ Only one background refresh runs at a time """
+        with mock.patch('subprocess.Popen') as mock_popen:
+            hostname._start_background_refresh(self.cache_file, 1.0)
+            hostname._start_background_refresh(self.cache_file, 1.0)
+        mock_popen.assert_called_once()
+        self.assertTrue(os.path.exists(self.cache_file + '.refreshing'))
+
+    def test_08_main_work(self):
+        """ The refresher updates the cache and clears its marker """
+        open(self.cache_file + '.refreshing', 'w', encoding='utf-8').close()
+        with mock.patch('socket.getfqdn', return_value='new.host.name'):
+            self.assertTrue(hostname.main_work(['refresh', '--cache-file', self.cache_file]))
+        self.assertEqual(hostname._read_cache(self.cache_file)[0], 'new.host.name')
+        self.assertFalse(os.path.exists(self.cache_file + '.refreshing'))
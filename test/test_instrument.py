@@ -0,0 +1,250 @@
+""" openvpn-disconnect stage timing tests """
+
+import unittest
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import threading
+import test.context  # pylint: disable=unused-import
+import mock
+import openvpn_client_disconnect
+from openvpn_client_disconnect import instrument
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestInstrument(unittest.TestCase):
+    """
+        Tests for the shared stage timing counters.
+    """
+
+    def setUp(self):
+        """ Somewhere for a counter file """
+        self.workdir = tempfile.mkdtemp()
+        self.counters = os.path.join(self.workdir, 'counters')
+        self.textfile = os.path.join(self.workdir, 'ocd.prom')
+        instrument._RECORDERS.clear()
+
+    def tearDown(self):
+        """ Clean up """
+        shutil.rmtree(self.workdir)
+        instrument._RECORDERS.clear()
+        openvpn_client_disconnect._PER_THREAD.recorder = None
+
+    def _write_conf(self, extra='syslog-events-send = false\n'):
+        """ A config that spools and instruments, plus extra; return its path """
+        spool_dir = os.path.join(self.workdir, 'spool')
+        os.mkdir(spool_dir)
+        conffile = os.path.join(self.workdir, 'ocd.conf')
+        with open(conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write('[client-disconnect]\n'
+                              f'metrics-log-dir = {spool_dir}\n'
+                              "metrics = ['IV_*']\n"
+                              f'instrument-file = {self.counters}\n'
+                              f'instrument-textfile = {self.textfile}\n'
+                              f'{extra}')
+        return conffile
+
+    def test_01_observe(self):
+        """ Observations land in the right buckets once flushed """
+        recorder = instrument.Recorder(self.counters)
+        recorder.observe('filter', 0.0002)
+        recorder.observe('filter', 0.003)
+        recorder.observe('filter', 60)
+        self.assertFalse(os.path.exists(self.counters))
+        recorder.flush()
+        stats = recorder.stats()['filter']
+        self.assertEqual(stats['count'], 3)
+        self.assertAlmostEqual(stats['sum'], 60.0032)
+        self.assertEqual(stats['errors'], 0)
+        self.assertEqual(len(stats['buckets']), len(instrument.BUCKETS) + 1)
+        self.assertEqual(stats['buckets'][0], 1)
+        self.assertEqual(stats['buckets'][instrument.BUCKETS.index(0.005)], 1)
+        self.assertEqual(stats['buckets'][-1], 1)
+        self.assertEqual(recorder.stats()['config']['count'], 0)
+
+    def test_02_timer_and_errors(self):
+        """ A stage that raises is timed, and counted as an error """
+        recorder = instrument.Recorder(self.counters)
+        with recorder.timer('spool_write'):
+            pass
+        with self.assertRaises(OSError):
+            with recorder.timer('spool_write'):
+                raise OSError('disk full')
+        recorder.error('total')
+        recorder.flush()
+        stats = recorder.stats()
+        self.assertEqual(stats['spool_write']['count'], 2)
+        self.assertEqual(stats['spool_write']['errors'], 1)
+        self.assertEqual(stats['total']['count'], 0)
+        self.assertEqual(stats['total']['errors'], 1)
+
+    def test_03_shared_between_processes(self):
+        """ Separate processes add to the same counters """
+        code = ('from openvpn_client_disconnect import instrument\n'
+                f'recorder = instrument.Recorder({self.counters!r})\n'
+                'for _ in range(50):\n'
+                '    recorder.observe("total", 0.001)\n'
+                '    recorder.flush()\n')
+        env = dict(os.environ, PYTHONPATH=REPO_ROOT)
+        workers = [subprocess.Popen([sys.executable, '-c', code], env=env)
+                   for _ in range(4)]
+        for worker in workers:
+            self.assertEqual(worker.wait(), 0)
+        self.assertEqual(instrument.Recorder(self.counters).stats()['total']['count'], 200)
+
+    def test_04_bad_file_is_reset(self):
+        """ A counter file of another layout is started again """
+        with open(self.counters, 'wb') as filepointer:
+            filepointer.write(b'\x01' * 4096)
+        recorder = instrument.Recorder(self.counters)
+        recorder.observe('fqdn', 0.01)
+        recorder.flush()
+        self.assertEqual(os.path.getsize(self.counters), instrument._SIZE)
+        stats = recorder.stats()
+        self.assertEqual(stats['fqdn']['count'], 1)
+        self.assertEqual(stats['config']['count'], 0)
+
+    def test_05_unwritable_is_not_an_error(self):
+        """ Failing to update the counters doesn't fail the caller """
+        recorder = instrument.Recorder(os.path.join(self.workdir, 'nope', 'counters'))
+        recorder.observe('total', 0.01)
+        recorder.flush()
+
+    def test_06_render(self):
+        """ The textfile is in the Prometheus format, with cumulative buckets """
+        recorder = instrument.Recorder(self.counters, self.textfile)
+        recorder.observe('syslog_send', 0.0002)
+        recorder.observe('syslog_send', 0.02, error=True)
+        recorder.flush(now=1000)
+        with open(self.textfile, 'r', encoding='utf-8') as filepointer:
+            text = filepointer.read()
+        name = 'openvpn_client_disconnect_stage_seconds'
+        self.assertIn(f'# TYPE {name} histogram\n', text)
+        self.assertIn(f'{name}_bucket{{stage="syslog_send",le="0.0005"}} 1\n', text)
+        self.assertIn(f'{name}_bucket{{stage="syslog_send",le="0.025"}} 2\n', text)
+        self.assertIn(f'{name}_bucket{{stage="syslog_send",le="+Inf"}} 2\n', text)
+        self.assertIn(f'{name}_count{{stage="syslog_send"}} 2\n', text)
+        self.assertIn(f'{name}_sum{{stage="syslog_send"}} 0.020200000\n', text)
+        self.assertIn('openvpn_client_disconnect_stage_errors_total{stage="syslog_send"} 1\n',
+                      text)
+        self.assertEqual(sorted(os.listdir(self.workdir)), ['counters', 'ocd.prom'])
+
+    def test_07_render_interval(self):
+        """ The textfile is only rendered once per interval """
+        recorder = instrument.Recorder(self.counters, self.textfile, 60)
+        recorder.observe('total', 0.01)
+        recorder.flush(now=1000)
+        os.unlink(self.textfile)
+        recorder.observe('total', 0.01)
+        recorder.flush(now=1059)
+        self.assertFalse(os.path.exists(self.textfile))
+        recorder.observe('total', 0.01)
+        recorder.flush(now=1060)
+        self.assertTrue(os.path.exists(self.textfile))
+
+    def test_08_recorder_for(self):
+        """ Settings without an instrument-file don't record """
+        self.assertIsNone(instrument.recorder_for({'instrument_file': None}))
+        settings = {'instrument_file': self.counters, 'instrument_textfile': self.textfile,
+                    'instrument_render_interval': 30}
+        recorder = instrument.recorder_for(settings)
+        self.assertEqual(recorder.render_interval, 30)
+        self.assertIs(instrument.recorder_for(dict(settings)), recorder)
+
+    def test_09_hook_records_stages(self):
+        """ A hook run times its stages """
+        conffile = self._write_conf()
+        environ = {'common_name': 'bob', 'trusted_ip': '1.2.3.4', 'IV_VER': '2.5.8',
+                   'time_unix': '1700000000'}
+        with mock.patch.dict(os.environ, environ):
+            self.assertTrue(openvpn_client_disconnect.main_work(['hook', '--conf', conffile]))
+        stats = instrument.Recorder(self.counters).stats()
+        for stage in ['config', 'filter', 'spool_write', 'total']:
+            self.assertEqual(stats[stage]['count'], 1, stage)
+        for stage in ['fqdn', 'syslog_send']:
+            self.assertEqual(stats[stage]['count'], 0, stage)
+        self.assertTrue(os.path.exists(self.textfile))
+
+    def test_10_hook_failure_counted(self):
+        """ A disconnect we can't handle is an error """
+        settings = {'instrument_file': self.counters}
+        success, _message = openvpn_client_disconnect.handle_disconnect(settings, {})
+        self.assertFalse(success)
+        stats = instrument.Recorder(self.counters).stats()
+        self.assertEqual(stats['total']['count'], 1)
+        self.assertEqual(stats['total']['errors'], 1)
+
+    def test_11_main(self):
+        """ The command line renders on demand """
+        conffile = self._write_conf()
+        output = os.path.join(self.workdir, 'other.prom')
+        self.assertTrue(instrument.main_work(['instrument', '--conf', conffile,
+                                              '--output', output]))
+        self.assertTrue(os.path.exists(output))
+        self.assertTrue(os.path.exists(self.counters))
+        with mock.patch.object(instrument, 'main_work', return_value=True), \
+                self.assertRaises(SystemExit) as exiting:
+            instrument.main()
+        self.assertEqual(exiting.exception.code, 0)
+        with mock.patch.object(instrument, 'main_work', return_value=False), \
+                self.assertRaises(SystemExit) as exiting:
+            instrument.main()
+        self.assertEqual(exiting.exception.code, 1)
+
+    def test_12_main_unconfigured(self):
+        """ Nothing to render without the options set """
+        conffile = os.path.join(self.workdir, 'bare.conf')
+        with open(conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write('[client-disconnect]\n')
+        with mock.patch('sys.stderr'):
+            self.assertFalse(instrument.main_work(['instrument', '--conf', conffile]))
+
+    def test_13_fqdn_timed_once(self):
+        """ Looking our name up is one fqdn observation, cached or not """
+        cache_file = os.path.join(self.workdir, 'fqdn.json')
+        conffile = self._write_conf('syslog-events-send = true\n')
+        with open(conffile, 'r', encoding='utf-8') as filepointer:
+            config = filepointer.read()
+        environ = {'common_name': 'bob', 'trusted_ip': '1.2.3.4', 'time_unix': '1700000000'}
+        for num, extra in enumerate(['', f'hostname-cache-file = {cache_file}\n'], 1):
+            with open(conffile, 'w', encoding='utf-8') as filepointer:
+                filepointer.write(config + extra)
+            with mock.patch.dict(os.environ, environ), \
+                    mock.patch('socket.getfqdn', return_value='vpn.example.com'), \
+                    mock.patch('syslog.syslog'):
+                self.assertTrue(openvpn_client_disconnect.main_work(['hook', '--conf',
+                                                                     conffile]))
+            stats = instrument.Recorder(self.counters).stats()
+            self.assertEqual(stats['fqdn']['count'], num, extra)
+            self.assertEqual(stats['syslog_send']['count'], num, extra)
+
+    def test_14_recorder_per_thread(self):
+        """ Threads handling events at once each time stages into their own recorder """
+        recorders = {'a': mock.MagicMock(), 'b': mock.MagicMock()}
+        both_started = threading.Barrier(2, timeout=5)
+
+        def _handle(settings, _environ, _detach):
+            both_started.wait()
+            with openvpn_client_disconnect._stage('filter'):
+                pass
+            return True, settings['name']
+
+        def _run(name):
+            openvpn_client_disconnect.handle_disconnect({'name': name}, {})
+
+        with mock.patch.object(openvpn_client_disconnect, '_recorder',
+                               side_effect=lambda settings: recorders[settings['name']]), \
+                mock.patch.object(openvpn_client_disconnect, '_handle_disconnect',
+                                  side_effect=_handle):
+            workers = [threading.Thread(target=_run, args=(x,)) for x in recorders]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        for recorder in recorders.values():
+            self.assertEqual([x[0][0] for x in recorder.timer.call_args_list],
+                             ['total', 'filter'])
+        self.assertIsNone(getattr(openvpn_client_disconnect._PER_THREAD, 'recorder', None))
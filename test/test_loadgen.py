@@ -0,0 +1,88 @@
+""" openvpn-disconnect disconnect storm simulator tests """
+
+import unittest
+import os
+import sys
+import json
+import shutil
+import tempfile
+from io import StringIO
+import test.context  # pylint: disable=unused-import
+import mock
+from openvpn_client_disconnect import loadgen
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestLoadgen(unittest.TestCase):
+    """
+        Tests for the disconnect storm simulator.
+    """
+
+    def setUp(self):
+        """ Somewhere to storm """
+        self.workdir = tempfile.mkdtemp()
+        self.env = {'PATH': os.environ.get('PATH', ''), 'PYTHONPATH': REPO_ROOT}
+
+    def tearDown(self):
+        """ Clean up """
+        shutil.rmtree(self.workdir)
+
+    def test_01_percentile(self):
+        """ Percentiles of a sorted list """
+        self.assertIsNone(loadgen.percentile([], 0.5))
+        values = list(range(101))
+        self.assertEqual(loadgen.percentile(values, 0.5), 50)
+        self.assertEqual(loadgen.percentile(values, 0.99), 99)
+        self.assertEqual(loadgen.percentile(values, 1.0), 100)
+
+    def test_02_count_spool_files(self):
+        """ Files are counted in every shard, hidden ones aren't """
+        os.makedirs(os.path.join(self.workdir, 'ab', 'cd'))
+        os.makedirs(os.path.join(self.workdir, '.hidden'))
+        for path in ['log.a.json', 'ab/cd/log.b.json', '.segment-hint', '.hidden/x']:
+            with open(os.path.join(self.workdir, path), 'w', encoding='utf-8'):
+                pass
+        self.assertEqual(loadgen.count_spool_files(self.workdir), 2)
+
+    def test_03_storm(self):
+        """ Every disconnect is run, and its latency recorded """
+        command = [sys.executable, '-c',
+                   'import os, sys; sys.exit(0 if os.environ["common_name"] != '
+                   '"user00003@work.net" else 1)']
+        storm = loadgen.Storm(command, 6, concurrency=2, rate=200, base_env=self.env).run()
+        report = storm.report()
+        self.assertEqual(report['invocations'], 6)
+        self.assertEqual(report['failures'], 1)
+        self.assertEqual(sorted(x[0] for x in storm.results), list(range(6)))
+        self.assertGreater(report['latency_ms']['p50'], 0)
+        self.assertLessEqual(report['stall_seconds_per_instance'], report['stall_seconds_total'])
+        self.assertGreaterEqual(report['wall_seconds'], 5 / 200)
+
+    def test_04_main_work(self):
+        """ A real storm against the hook lands in the spool and the stand-in """
+        output = os.path.join(self.workdir, 'report.json')
+        with mock.patch.dict(os.environ, {'PYTHONPATH': REPO_ROOT}), \
+                mock.patch.object(loadgen, 'hook_command',
+                                  return_value=[sys.executable, '-c',
+                                                'import openvpn_client_disconnect; '
+                                                'openvpn_client_disconnect.main()']), \
+                mock.patch('sys.stdout', new=StringIO()):
+            self.assertTrue(loadgen.main_work(['loadgen', '--count', '5', '--concurrency', '2',
+                                               '--spool-format', 'segments',
+                                               '--output', output]))
+        with open(output, 'r', encoding='utf-8') as filepointer:
+            report = json.load(filepointer)
+        self.assertEqual(report['invocations'], 5)
+        self.assertEqual(report['failures'], 0)
+        self.assertEqual(report['syslog_received_after_settle'], 5)
+        self.assertGreaterEqual(report['spool_files'], 1)
+
+    def test_05_target_stall(self):
+        """ Missing the stall target fails the run """
+        with mock.patch.object(loadgen, 'hook_command', return_value=[sys.executable, '-c', '']), \
+                mock.patch('sys.stdout', new=StringIO()), \
+                mock.patch('sys.stderr', new=StringIO()) as fake_err:
+            self.assertFalse(loadgen.main_work(['loadgen', '--count', '2', '--syslog', 'none',
+                                                '--target-stall', '0']))
+        self.assertIn('over the 0.0s target', fake_err.getvalue())
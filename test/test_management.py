@@ -0,0 +1,234 @@
+""" openvpn-disconnect management interface listener tests """
+
+import unittest
+import os
+import time
+import shutil
+import asyncio
+import tempfile
+import threading
+from io import StringIO
+import test.context  # pylint: disable=unused-import
+import mock
+import openvpn_client_disconnect
+from openvpn_client_disconnect import management, spool
+from openvpn_client_disconnect.standins import FakeManagementServer
+
+
+def _environ(usercn, num=0):
+    """ The sort of environment openvpn reports a disconnect with """
+    return {'common_name': usercn, 'trusted_ip': '10.0.0.1', 'trusted_port': '1194',
+            'time_unix': str(1591190000 + num), 'bytes_sent': str(num),
+            'bytes_received': '20', 'password': 'hunter2', 'IV_VER': '2.4.9'}
+
+
+class TestManagement(unittest.TestCase):
+    """
+        Tests for the management interface listener.
+    """
+
+    def setUp(self):
+        """ Create a spool, and settings that write segments to it """
+        self.workdir = tempfile.mkdtemp()
+        self.spool_dir = os.path.join(self.workdir, 'spool')
+        os.mkdir(self.spool_dir)
+        self.settings = {
+            'conffile': None, 'detach_queue_dir': None,
+            'metrics_log_dir': self.spool_dir,
+            'metrics_requested': set(['bytes_sent', 'password', 'IV_VER']),
+            'spool_options': {'format': 'segments'},
+            'event_send': False,
+        }
+        self._loop = None
+        self._thread = None
+        self._task = None
+
+    def tearDown(self):
+        """ Stop any listener, and clean up """
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._task.cancel)
+            self._thread.join(5)
+            self._loop.close()
+        shutil.rmtree(self.workdir)
+
+    def _listen(self, listener):
+        """ Run a listener in the background """
+        self._loop = asyncio.new_event_loop()
+        self._task = self._loop.create_task(listener.run())
+
+        def _run():
+            try:
+                self._loop.run_until_complete(self._task)
+            except asyncio.CancelledError:
+                pass
+
+        self._thread = threading.Thread(target=_run, daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _wait(condition, timeout=5.0):
+        """ Poll until condition() is true """
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def _records(self):
+        """ Everything in the spool """
+        records = []
+        for path in spool.iter_spool_sources(self.spool_dir, finished_only=False):
+            records.extend(record for _s, _e, record in spool.read_records(path))
+        return records
+
+    def test_01_parse_address(self):
+        """ Addresses parse, and junk doesn't """
+        self.assertEqual(management.parse_address('unix:/run/mgmt'), ('unix', '/run/mgmt'))
+        self.assertEqual(management.parse_address('/run/mgmt'), ('unix', '/run/mgmt'))
+        self.assertEqual(management.parse_address('127.0.0.1:7505'),
+                         ('tcp', ('127.0.0.1', 7505)))
+        self.assertEqual(management.parse_address('[::1]:7505'), ('tcp', ('::1', 7505)))
+        with self.assertRaises(ValueError):
+            management.parse_address('nohost')
+
+    def test_02_parser(self):
+        """ Notifications come out once their ENV block ends """
+        parser = management.NotificationParser()
+        self.assertIsNone(parser.feed('>INFO:OpenVPN Management Interface'))
+        self.assertIsNone(parser.feed('>CLIENT:ENV,stray=1'))
+        self.assertIsNone(parser.feed('>CLIENT:DISCONNECT,5'))
+        self.assertIsNone(parser.feed('>CLIENT:ENV,common_name=bob'))
+        self.assertIsNone(parser.feed('>CLIENT:ENV,tricky=a=b'))
+        self.assertEqual(parser.feed('>CLIENT:ENV,END'),
+                         ('DISCONNECT', ['5'], {'common_name': 'bob', 'tricky': 'a=b'}))
+        self.assertEqual(parser.feed('>CLIENT:ADDRESS,5,10.8.0.2,1'),
+                         ('ADDRESS', ['5', '10.8.0.2', '1'], {}))
+
+    def test_03_disconnects(self):
+        """ Disconnects land in the spool, filtered like the hook does it """
+        with FakeManagementServer() as server:
+            listener = management.ManagementListener(server.target, self.settings)
+            self._listen(listener)
+            self.assertEqual(server.wait_for_clients(), 1)
+            for num in range(50):
+                server.client_disconnect(num, _environ(f'user{num}', num))
+            self.assertTrue(self._wait(lambda: listener.events == 50))
+        records = sorted(self._records(), key=lambda x: int(x['bytes_sent']))
+        self.assertEqual(len(records), 50)
+        self.assertEqual(records[7], {'common_name': 'user7', 'time_unix': '1591190007',
+                                      'bytes_sent': '7', 'IV_VER': '2.4.9'})
+        self.assertEqual(listener.failures, 0)
+
+    def test_04_bad_event(self):
+        """ A disconnect the hook would refuse is counted, and we carry on """
+        with FakeManagementServer() as server, \
+                mock.patch('sys.stderr', new=StringIO()) as fake_err:
+            listener = management.ManagementListener(server.target, self.settings)
+            self._listen(listener)
+            server.wait_for_clients()
+            server.client_disconnect(1, {'common_name': 'bob'})
+            server.client_disconnect(2, _environ('alice'))
+            self.assertTrue(self._wait(lambda: listener.events == 1))
+        self.assertEqual(listener.failures, 1)
+        self.assertIn('trusted_ip', fake_err.getvalue())
+
+    def test_05_password_and_approve(self):
+        """ A password is given when asked, and connections approved when wanted """
+        path = os.path.join(self.workdir, 'mgmt.sock')
+        with FakeManagementServer('unix', path, password='sekrit') as server:
+            listener = management.ManagementListener(server.target, self.settings,
+                                                     password='sekrit', approve=True)
+            self._listen(listener)
+            self.assertEqual(server.wait_for_clients(), 1)
+            server.client_connect(3, 1, {'common_name': 'bob'})
+            self.assertEqual(server.wait_for_commands(1), ['client-auth-nt 3 1'])
+
+    def test_06_no_approve(self):
+        """ Without approve, connections are left to someone else """
+        with FakeManagementServer() as server:
+            listener = management.ManagementListener(server.target, self.settings)
+            self._listen(listener)
+            server.wait_for_clients()
+            server.client_connect(3, 1, {'common_name': 'bob'})
+            server.client_disconnect(3, _environ('bob'))
+            self.assertTrue(self._wait(lambda: listener.events == 1))
+            self.assertEqual(server.commands, [])
+
+    def test_07_reconnect(self):
+        """ When openvpn hangs up, we come back """
+        with FakeManagementServer() as server:
+            listener = management.ManagementListener(server.target, self.settings,
+                                                     reconnect_delay=0.01)
+            self._listen(listener)
+            server.wait_for_clients()
+            server.drop_clients()
+            self.assertTrue(self._wait(lambda: server.connections == 2))
+            server.wait_for_clients()
+            server.client_disconnect(1, _environ('bob'))
+            self.assertTrue(self._wait(lambda: listener.events == 1))
+        self.assertEqual(listener.sessions, 2)
+
+    def test_08_main(self):
+        """ main_work builds a listener per interface and serves them """
+        conffile = os.path.join(self.workdir, 'ocd.conf')
+        with open(conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write(f'[client-disconnect]\nmetrics-log-dir = {self.spool_dir}\n'
+                              'syslog-events-send = true\n')
+        pwfile = os.path.join(self.workdir, 'pw')
+        with open(pwfile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write('sekrit\n')
+        with mock.patch.object(management, 'serve', new_callable=mock.Mock) as mock_serve, \
+                mock.patch('openvpn_client_disconnect.transport.start_flusher'), \
+                mock.patch('openvpn_client_disconnect.hostname.resolve_fqdn',
+                           return_value='vpn.example.com'), \
+                mock.patch('asyncio.run') as mock_run:
+            self.assertTrue(management.main_work(
+                ['script', '--conf', conffile, '--management', '127.0.0.1:7505',
+                 '--management', 'unix:/run/mgmt', '--password-file', pwfile]))
+        listeners = mock_serve.call_args[0][0]
+        self.assertEqual([x.kind for x in listeners], ['tcp', 'unix'])
+        self.assertEqual(listeners[0].password, 'sekrit')
+        self.assertEqual(listeners[0].settings['metrics_log_dir'], self.spool_dir)
+        self.assertEqual(listeners[0].settings['event_hostname'], 'vpn.example.com')
+        mock_run.assert_called_once_with(mock_serve.return_value)
+
+    def test_09_slow_disconnect(self):
+        """ A slow disconnect doesn't hold up the interface """
+        release = threading.Event()
+        real_handle = openvpn_client_disconnect.handle_disconnect
+
+        def _slow_handle(*args, **kwargs):
+            release.wait(5)
+            return real_handle(*args, **kwargs)
+
+        with FakeManagementServer() as server, \
+                mock.patch.object(openvpn_client_disconnect, 'handle_disconnect',
+                                  side_effect=_slow_handle):
+            listener = management.ManagementListener(server.target, self.settings,
+                                                     approve=True)
+            self._listen(listener)
+            server.wait_for_clients()
+            server.client_disconnect(1, _environ('bob', 1))
+            server.client_disconnect(2, _environ('sue', 2))
+            server.client_connect(3, 1, {'common_name': 'alice'})
+            self.assertEqual(server.wait_for_commands(1), ['client-auth-nt 3 1'])
+            self.assertEqual(listener.events, 0)
+            release.set()
+            self.assertTrue(self._wait(lambda: listener.events == 2))
+            listener.close()
+        self.assertEqual([x['common_name'] for x in self._records()], ['bob', 'sue'])
+
+    def test_10_hostname_once(self):
+        """ Without a hostname cache, our name is looked up once, up front """
+        settings = dict(self.settings, event_send=True)
+        with mock.patch('openvpn_client_disconnect.hostname.resolve_fqdn',
+                        return_value='vpn.example.com') as mock_resolve:
+            listening = management.settings_for_listening(settings)
+        mock_resolve.assert_called_once_with(2.0)
+        self.assertEqual(openvpn_client_disconnect._event_hostname(listening),
+                         'vpn.example.com')
+        self.assertNotIn('event_hostname', settings)
+        with mock.patch('openvpn_client_disconnect.hostname.resolve_fqdn') as mock_resolve:
+            cached = dict(settings, hostname_cache_file='/some/cache')
+            self.assertIs(management.settings_for_listening(cached), cached)
+            self.assertIs(management.settings_for_listening(self.settings), self.settings)
+        mock_resolve.assert_not_called()
@@ -0,0 +1,173 @@
+""" openvpn-disconnect sampled profiling tests """
+
+import unittest
+import os
+import io
+import shutil
+import tempfile
+import cProfile
+import test.context  # pylint: disable=unused-import
+import mock
+import openvpn_client_disconnect
+from openvpn_client_disconnect import profiling
+
+
+def _work(count):
+    """ Something to profile """
+    return sum(_leaf(x) for x in range(count))
+
+def _leaf(value):
+    """ Something for _work to call """
+    return value * 2
+
+
+class TestProfiling(unittest.TestCase):
+    """
+        Tests for sampling profiles and merging them.
+    """
+
+    def setUp(self):
+        """ Somewhere for profiles """
+        self.workdir = tempfile.mkdtemp()
+        self.profile_dir = os.path.join(self.workdir, 'profiles')
+        os.mkdir(self.profile_dir)
+        self.settings = {'profile_dir': self.profile_dir, 'profile_sample_rate': 1}
+
+    def tearDown(self):
+        """ Clean up """
+        shutil.rmtree(self.workdir)
+
+    def _profile(self, count=100):
+        """ Save one profile of _work; return its path """
+        profiler = cProfile.Profile()
+        profiler.runcall(_work, count)
+        return profiling.save(profiler, self.profile_dir, 0.002)
+
+    def test_01_sampled(self):
+        """ 1 in rate runs are sampled; none if rate is 0 """
+        self.assertTrue(profiling.sampled(1))
+        self.assertFalse(profiling.sampled(0))
+        with mock.patch('os.urandom', return_value=b'\x00\x00\x03\xe8'):
+            self.assertTrue(profiling.sampled(1000))
+        with mock.patch('os.urandom', return_value=b'\x00\x00\x03\xe9'):
+            self.assertFalse(profiling.sampled(1000))
+
+    def test_02_run_sampled(self):
+        """ A sampled run is profiled into the profile dir """
+        self.assertEqual(profiling.run_sampled(self.settings, 0.001, _work, 10), 90)
+        paths = profiling.profile_paths(self.profile_dir)
+        self.assertEqual(len(paths), 1)
+        merged, used, bad = profiling.merge(paths)
+        self.assertEqual((used, bad), (paths, []))
+        self.assertIn(profiling.SETTINGS_LOAD, merged.stats)
+        self.assertIn('_leaf', [x[2] for x in merged.stats])
+
+    def test_03_run_unsampled(self):
+        """ An unsampled run leaves nothing behind """
+        self.settings['profile_sample_rate'] = 0
+        self.assertEqual(profiling.run_sampled(self.settings, 0.001, _work, 10), 90)
+        self.assertEqual(os.listdir(self.profile_dir), [])
+
+    def test_04_merge(self):
+        """ Profiles add up; unreadable ones are skipped """
+        for _ in range(3):
+            self._profile(100)
+        broken = os.path.join(self.profile_dir, '0.0.prof')
+        with open(broken, 'wb') as filepointer:
+            filepointer.write(b'not a profile')
+        with open(os.path.join(self.profile_dir, '.1.1.prof'), 'wb') as filepointer:
+            filepointer.write(b'half a profile')
+        merged, used, bad = profiling.merge(profiling.profile_paths(self.profile_dir))
+        self.assertEqual(len(used), 3)
+        self.assertEqual(bad, [broken])
+        leaf = [value for func, value in merged.stats.items() if func[2] == '_leaf'][0]
+        self.assertEqual(leaf[1], 300)
+        self.assertEqual(merged.stats[profiling.SETTINGS_LOAD][1], 3)
+
+    def test_05_collapsed_stacks(self):
+        """ Time is attributed down the call graph """
+        work = (__file__, 10, '_work')
+        leaf = (__file__, 20, '_leaf')
+        other = ('other.py', 1, 'other')
+        stats = {
+            work: (1, 1, 0.001, 0.004, {}),
+            other: (1, 1, 0.001, 0.003, {}),
+            leaf: (4, 4, 0.005, 0.005, {work: (3, 3, 0.003, 0.003),
+                                        other: (1, 1, 0.002, 0.002)}),
+        }
+        stacks = profiling.collapsed_stacks(stats)
+        name = os.path.basename(__file__)
+        self.assertEqual(set(stacks), set([f'_work ({name}:10)',
+                                           f'_work ({name}:10);_leaf ({name}:20)',
+                                           'other (other.py:1)',
+                                           f'other (other.py:1);_leaf ({name}:20)']))
+        self.assertAlmostEqual(stacks[f'_work ({name}:10);_leaf ({name}:20)'], 3000)
+        self.assertAlmostEqual(stacks[f'other (other.py:1);_leaf ({name}:20)'], 2000)
+
+    def test_06_collapsed_recursion(self):
+        """ Recursion doesn't go on forever """
+        func = ('a.py', 1, 'recurse')
+        stats = {func: (2, 10, 0.01, 0.01, {func: (8, 9, 0.009, 0.009)})}
+        stacks = profiling.collapsed_stacks(stats)
+        self.assertEqual(stacks, {})
+        stats[('~', 0, '<main>')] = (1, 1, 0.0, 0.01, {})
+        stats[func][4][('~', 0, '<main>')] = (1, 1, 0.01, 0.01)
+        stacks = profiling.collapsed_stacks(stats)
+        self.assertEqual(list(stacks), ['<main>;recurse (a.py:1)'])
+
+    def test_07_hook_profiles(self):
+        """ A sampled hook run leaves a profile of handling the disconnect """
+        conffile = os.path.join(self.workdir, 'ocd.conf')
+        with open(conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write('[client-disconnect]\nsyslog-events-send = false\n'
+                              f'profile-dir = {self.profile_dir}\nprofile-sample-rate = 1\n')
+        with mock.patch.dict(os.environ, {'common_name': 'bob', 'trusted_ip': '1.2.3.4'}):
+            self.assertTrue(openvpn_client_disconnect.main_work(['hook', '--conf', conffile]))
+        merged, used, _bad = profiling.merge(profiling.profile_paths(self.profile_dir))
+        self.assertEqual(len(used), 1)
+        self.assertIn('handle_disconnect', [x[2] for x in merged.stats])
+
+    def test_08_main(self):
+        """ The command line writes a ranked report and collapsed stacks """
+        for _ in range(2):
+            self._profile()
+        report = os.path.join(self.workdir, 'report.txt')
+        collapsed = os.path.join(self.workdir, 'stacks.folded')
+        self.assertTrue(profiling.main_work(['profile', '--profile-dir', self.profile_dir,
+                                             '--output', report, '--collapsed', collapsed,
+                                             '--sort', 'tottime', '--clean']))
+        with open(report, 'r', encoding='utf-8') as filepointer:
+            text = filepointer.read()
+        self.assertTrue(text.startswith(f'2 profiles merged from {self.profile_dir}.'))
+        self.assertIn('_leaf', text)
+        with open(collapsed, 'r', encoding='utf-8') as filepointer:
+            lines = filepointer.read().splitlines()
+        self.assertIn(';_leaf (', ''.join(lines))
+        for line in lines:
+            stack, microseconds = line.rsplit(' ', 1)
+            self.assertTrue(stack)
+            self.assertGreater(int(microseconds), 0)
+        self.assertEqual(os.listdir(self.profile_dir), [])
+
+    def test_09_main_config(self):
+        """ The profile dir can come from the config; no profiles is a failure """
+        conffile = os.path.join(self.workdir, 'ocd.conf')
+        with open(conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write(f'[client-disconnect]\nprofile-dir = {self.profile_dir}\n')
+        with mock.patch('sys.stderr', new_callable=io.StringIO):
+            self.assertFalse(profiling.main_work(['profile', '--conf', conffile]))
+        self._profile()
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            self.assertTrue(profiling.main_work(['profile', '--conf', conffile]))
+        self.assertIn('1 profiles merged', stdout.getvalue())
+        with mock.patch('sys.stderr', new_callable=io.StringIO), \
+                self.assertRaises(SystemExit):
+            profiling.main_work(['profile'])
+        with mock.patch.object(profiling, 'main_work', return_value=True), \
+                self.assertRaises(SystemExit) as exiting:
+            profiling.main()
+        self.assertEqual(exiting.exception.code, 0)
+        with mock.patch.object(profiling, 'main_work', return_value=False), \
+                self.assertRaises(SystemExit) as exiting:
+            profiling.main()
+        self.assertEqual(exiting.exception.code, 1)
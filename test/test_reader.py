@@ -0,0 +1,242 @@
+""" openvpn-disconnect spool query tests """
+
+import unittest
+import os
+import json
+import gzip
+import fcntl
+import shutil
+import threading
+import tempfile
+from io import StringIO
+import test.context  # pylint: disable=unused-import
+import mock
+from openvpn_client_disconnect import spool
+from openvpn_client_disconnect import compact
+from openvpn_client_disconnect import reader
+
+
+class TestReader(unittest.TestCase):
+    """
+        Tests for the indexed spool reader.
+    """
+
+    def setUp(self):
+        """ Create a spool with some records in it """
+        self.workdir = tempfile.mkdtemp()
+        self.spool_dir = os.path.join(self.workdir, 'spool')
+        self.archive_dir = os.path.join(self.workdir, 'archive')
+        os.mkdir(self.spool_dir)
+        os.mkdir(self.archive_dir)
+        self.index_path = os.path.join(self.workdir, 'index.sqlite')
+        writer = spool.FileSpool(self.spool_dir, 'date')
+        for index in range(12):
+            writer.write(f'user{index % 3}',
+                         {'common_name': f'user{index % 3}',
+                          'time_unix': str(1591189200 + index * 600),
+                          'IV_VER': '2.4.8' if index % 2 else '2.5.1',
+                          'IV_PLAT': 'mac' if index % 4 else 'win',
+                          'index': str(index)})
+        self.index = reader.SpoolIndex(self.index_path, self.spool_dir, self.archive_dir)
+
+    def tearDown(self):
+        """ Clean up """
+        self.index.close()
+        shutil.rmtree(self.workdir)
+
+    def _indexes(self, **kwargs):
+        """ The 'index' field of every record matching a query """
+        return sorted(int(x['index']) for x in self.index.query(**kwargs))
+
+    def test_01_refresh(self):
+        """ Everything gets indexed, once """
+        self.assertEqual(self.index.refresh(), 12)
+        self.assertEqual(self.index.refresh(), 12)
+        self.assertEqual(self._indexes(), list(range(12)))
+
+    def test_02_filters(self):
+        """ CN, time and field filters all narrow the results """
+        self.index.refresh()
+        self.assertEqual(self._indexes(cn='user1'), [1, 4, 7, 10])
+        self.assertEqual(self._indexes(since=1591189200 + 3000, until=1591189200 + 4800),
+                         [5, 6, 7, 8])
+        self.assertEqual(self._indexes(fields={'IV_VER': '2.4.*'}), [1, 3, 5, 7, 9, 11])
+        self.assertEqual(self._indexes(fields={'IV_VER': '2.4.8', 'IV_PLAT': 'win'}), [])
+        self.assertEqual(self._indexes(cn='user0', fields={'IV_PLAT': 'win'}), [0])
+        # Not an indexed field, so filtered after reading.
+        self.assertEqual(self._indexes(fields={'index': '1*'}), [1, 10, 11])
+
+    def test_03_only_matches_parsed(self):
+        """ Records the index rules out are never read """
+        self.index.refresh()
+        with mock.patch('json.loads', wraps=json.loads) as mock_loads:
+            self.assertEqual(self._indexes(cn='user2'), [2, 5, 8, 11])
+        self.assertEqual(mock_loads.call_count, 4)
+
+    def test_04_incremental_segments(self):
+        """ A growing segment is indexed a tail at a time """
+        writer = spool.SegmentSpool(self.spool_dir)
+        writer.write('amy', {'common_name': 'amy', 'time_unix': '1591193143', 'index': '100'})
+        self.assertEqual(self.index.refresh(), 13)
+        writer.write('amy', {'common_name': 'amy', 'time_unix': '1591193144', 'index': '101'})
+        with mock.patch.object(spool, 'read_records', wraps=spool.read_records) as mock_read:
+            self.assertEqual(self.index.refresh(), 14)
+        segment_reads = [x for x in mock_read.call_args_list if x[0][1]]
+        self.assertEqual(len(segment_reads), 1, 'Only the segment tail should be read')
+        self.assertEqual(self._indexes(cn='amy'), [100, 101])
+
+    def test_05_survives_compaction(self):
+        """ Compacted records keep their ids and are read from archives """
+        self.index.refresh()
+        before = {x[1]['index']: x[0] for x in self.index.query(with_ids=True)}
+        compact.Compactor(self.spool_dir, self.archive_dir, batch_size=5).run()
+        self.assertEqual(self.index.refresh(), 12)
+        after = {x[1]['index']: x[0] for x in self.index.query(with_ids=True)}
+        self.assertEqual(before, after)
+        self.assertEqual(self._indexes(cn='user1', fields={'IV_VER': '2.4.*'}), [1, 7])
+        # New records after that get new, higher ids.
+        spool.FileSpool(self.spool_dir).write('amy', {'common_name': 'amy',
+                                                      'time_unix': '1591193143',
+                                                      'index': '100'})
+        self.index.refresh()
+        newer = list(self.index.query(after_id=max(after.values()), with_ids=True))
+        self.assertEqual([x[1]['index'] for x in newer], ['100'])
+
+    def test_06_removed_records(self):
+        """ Records whose file is gone drop out of the index """
+        self.index.refresh()
+        victim = next(spool.iter_spool_sources(self.spool_dir))
+        os.unlink(victim)
+        self.assertEqual(self.index.refresh(), 11)
+
+    def test_08_binary_segments(self):
+        """ Records in binary segments are indexed, queried and compacted """
+        writer = spool.BinarySegmentSpool(self.spool_dir)
+        for index in (100, 101):
+            writer.write('amy', {'common_name': 'amy', 'time_unix': str(1591193143 + index),
+                                 'IV_VER': '2.6.0', 'index': str(index)})
+        self.assertEqual(self.index.refresh(), 14)
+        self.assertEqual(self._indexes(cn='amy'), [100, 101])
+        self.assertEqual(self._indexes(fields={'IV_VER': '2.6.*'}), [100, 101])
+        with mock.patch('time.time', return_value=1591193143 + 7200):
+            compact.Compactor(self.spool_dir, self.archive_dir).run()
+        self.assertEqual(self.index.refresh(), 14)
+        self.assertEqual(self._indexes(cn='amy'), [100, 101])
+
+    def test_09_refresh_while_compacting(self):
+        """ A refresh during a compaction batch forgets nothing, and ids stay put """
+        compact.Compactor(self.spool_dir, self.archive_dir, batch_size=5).run()
+        self.index.refresh()
+        before = {x[1]['index']: x[0] for x in self.index.query(with_ids=True)}
+        spool.FileSpool(self.spool_dir).write('amy', {'common_name': 'amy',
+                                                      'time_unix': '1591193143',
+                                                      'index': '100'})
+        self.assertEqual(self.index.refresh(), 13)
+        journal = os.path.join(self.archive_dir, compact.JOURNAL)
+        with open(journal, 'w', encoding='utf-8') as filepointer:
+            filepointer.write('{}')
+        # Mid-batch, the new record has left the spool but isn't archived yet.
+        os.unlink(next(spool.iter_spool_sources(self.spool_dir)))
+        self.assertEqual(self.index.refresh(), 13)
+        os.unlink(journal)
+        self.assertEqual(self.index.refresh(), 12)
+        after = {x[1]['index']: x[0] for x in self.index.query(with_ids=True)}
+        self.assertEqual(before, after)
+
+    def test_07_parse_time(self):
+        """ Times on the command line """
+        self.assertEqual(reader.parse_time('1591189200'), 1591189200)
+        self.assertEqual(reader.parse_time('2020-06-03T13:00:00'), 1591189200)
+        self.assertEqual(reader.parse_time('2020-06-03T15:00:00+02:00'), 1591189200)
+
+    def test_10_main_work(self):
+        """ The query command prints matching records """
+        conffile = os.path.join(self.workdir, 'ocd.conf')
+        with open(conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write('[client-disconnect]\n'
+                              f'metrics-log-dir = {self.spool_dir}\n'
+                              f'metrics-index-file = {self.index_path}\n')
+        with mock.patch('sys.stdout', new=StringIO()) as fake_out:
+            self.assertTrue(reader.main_work(['query', '--conf', conffile, '--cn', 'user0',
+                                              '--field', 'IV_PLAT=win',
+                                              '--since', '2020-06-03']))
+        lines = fake_out.getvalue().splitlines()
+        self.assertEqual([json.loads(x)['index'] for x in lines], ['0'])
+        with mock.patch('sys.stderr', new=StringIO()), self.assertRaises(SystemExit):
+            reader.main_work(['query', '--conf', conffile, '--field', 'IV_PLAT'])
+
+    def test_11_main_work_unconfigured(self):
+        """ Without a spool, there's nothing to query """
+        conffile = os.path.join(self.workdir, 'ocd.conf')
+        with open(conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write('[client-disconnect]\n')
+        with mock.patch('sys.stderr', new=StringIO()) as fake_err:
+            self.assertFalse(reader.main_work(['query', '--conf', conffile]))
+        self.assertIn('No usable metrics-log-dir configured.', fake_err.getvalue())
+
+    def test_12_refresh_waits_for_compaction(self):
+        """ A refresh waits for a running compaction to finish """
+        lock_fd = os.open(os.path.join(self.archive_dir, compact.LOCK),
+                          os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        counts = []
+        worker = threading.Thread(target=lambda: counts.append(self._refresh_elsewhere()))
+        worker.start()
+        worker.join(0.5)
+        self.assertTrue(worker.is_alive())
+        os.close(lock_fd)
+        worker.join(5)
+        self.assertEqual(counts, [12])
+
+    def _refresh_elsewhere(self):
+        """ refresh, with an sqlite connection of its own """
+        index = reader.SpoolIndex(self.index_path, self.spool_dir, self.archive_dir)
+        try:
+            return index.refresh()
+        finally:
+            index.close()
+
+    def test_13_uncommitted_archive_tail(self):
+        """ Archive bytes the .idx doesn't cover yet, or torn ones, aren't indexed """
+        compact.Compactor(self.spool_dir, self.archive_dir).run()
+        self.assertEqual(self.index.refresh(), 12)
+        archive = next(os.path.join(self.archive_dir, x) for x in os.listdir(self.archive_dir)
+                       if x.endswith(compact.ARCHIVE_SUFFIX))
+        sidecar = compact.Compactor.index_path(archive)
+        line = json.dumps({'common_name': 'amy', 'time_unix': '1591193143',
+                           'index': '100'}).encode() + b'\n'
+        member = gzip.compress(line)
+        before = os.path.getsize(archive)
+        # A torn member: nothing is indexed, and nothing raises.
+        with open(archive, 'ab') as filepointer:
+            filepointer.write(member[:len(member) // 2])
+        self.assertEqual(self.index.refresh(), 12)
+        with open(archive, 'r+b') as filepointer:
+            filepointer.truncate(before)
+            filepointer.seek(before)
+            filepointer.write(b'not gzip at all')
+        self.assertEqual(self.index.refresh(), 12)
+        # A whole member whose .idx lines aren't written yet.
+        with open(archive, 'r+b') as filepointer:
+            filepointer.truncate(before)
+            filepointer.seek(before)
+            filepointer.write(member)
+        self.assertEqual(self.index.refresh(), 12)
+        # Once they are, it's picked up.
+        offset = compact.uncompressed_size(sidecar)
+        with open(sidecar, 'a', encoding='utf-8') as filepointer:
+            filepointer.write(f'1591193143\tamy\t{offset}\t{len(line)}\n')
+        self.assertEqual(self.index.refresh(), 13)
+        self.assertEqual(self._indexes(cn='amy'), [100])
+
+    def test_14_main_work_refresh_fails(self):
+        """ A spool that can't be read is reported, not a traceback """
+        conffile = os.path.join(self.workdir, 'ocd.conf')
+        with open(conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write('[client-disconnect]\n'
+                              f'metrics-log-dir = {self.spool_dir}\n'
+                              f'metrics-index-file = {self.index_path}\n')
+        with mock.patch.object(reader.SpoolIndex, 'refresh', side_effect=EOFError('torn')), \
+                mock.patch('sys.stderr', new=StringIO()) as fake_err:
+            self.assertFalse(reader.main_work(['query', '--conf', conffile]))
+        self.assertIn('torn', fake_err.getvalue())
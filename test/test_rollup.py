@@ -0,0 +1,167 @@
+""" openvpn-disconnect rollup tests """
+
+import unittest
+import os
+import json
+import shutil
+import sqlite3
+import tempfile
+from io import StringIO
+import test.context  # pylint: disable=unused-import
+import mock
+from openvpn_client_disconnect import spool
+from openvpn_client_disconnect import compact
+from openvpn_client_disconnect import reader
+from openvpn_client_disconnect import rollup
+
+
+class TestRollup(unittest.TestCase):
+    """
+        Tests for the incremental rollup engine.
+    """
+
+    def setUp(self):
+        """ Create a spool and an index over it """
+        self.workdir = tempfile.mkdtemp()
+        self.spool_dir = os.path.join(self.workdir, 'spool')
+        os.mkdir(self.spool_dir)
+        self.state_path = os.path.join(self.workdir, 'rollup.json')
+        self.index = reader.SpoolIndex(os.path.join(self.workdir, 'index.sqlite'),
+                                       self.spool_dir)
+        self.writer = spool.FileSpool(self.spool_dir)
+        self.written = 0
+
+    def tearDown(self):
+        """ Clean up """
+        self.index.close()
+        shutil.rmtree(self.workdir)
+
+    def _write(self, usercn, version, sent, received, duration='60'):
+        """ Add one disconnect to the spool """
+        self.written += 1
+        self.writer.write(usercn, {'common_name': usercn,
+                                   'time_unix': str(1591189200 + self.written),
+                                   'IV_VER': version, 'IV_PLAT': 'mac',
+                                   'bytes_sent': str(sent), 'bytes_received': str(received),
+                                   'time_duration': duration})
+
+    def test_01_version_key(self):
+        """ Versions sort numerically """
+        self.assertLess(rollup.version_key('2.4.9'), rollup.version_key('2.4.10'))
+        self.assertLess(rollup.version_key('2.4.8'), rollup.version_key('2.5.0'))
+        self.assertLess(rollup.version_key('2.5.0'), rollup.version_key('2.5_git'))
+
+    def test_02_aggregate(self):
+        """ Counts, sums and percentile estimates """
+        aggregate = rollup.Aggregate()
+        for value in range(1, 1001):
+            aggregate.add({'bytes_sent': str(value), 'bytes_received': 'junk'}, value)
+        summary = aggregate.summary()
+        self.assertEqual(summary['count'], 1000)
+        self.assertEqual(summary['first_seen'], 1)
+        self.assertEqual(summary['last_seen'], 1000)
+        self.assertEqual(summary['bytes_sent']['sum'], 500500)
+        # Power-of-two buckets: within a factor of two is the promise.
+        self.assertTrue(250 <= summary['bytes_sent']['p50'] <= 1000)
+        self.assertTrue(495 <= summary['bytes_sent']['p99'] <= 1980)
+        self.assertIsNone(summary['bytes_received']['p50'])
+        self.assertEqual(rollup.Aggregate.from_state(aggregate.to_state()).summary(), summary)
+
+    def test_03_space_saving(self):
+        """ Heavy hitters float to the top of a small sketch """
+        sketch = rollup.SpaceSaving(3)
+        for index in range(100):
+            sketch.add(f'small{index}', 1)
+            sketch.add('big', 50)
+        sketch.add('medium', 500)
+        top = sketch.top(2)
+        self.assertEqual(top[0][0], 'big')
+        self.assertEqual(top[0][1], 5000)
+        self.assertLessEqual(len(sketch.counters), 3)
+
+    def test_04_update_incremental(self):
+        """ Each update only reads what's new """
+        self._write('bob', '2.4.8', 100, 200)
+        self._write('sue', '2.5.1', 1000, 2000)
+        self.index.refresh()
+        state = rollup.Rollup()
+        self.assertEqual(state.update(self.index, chunk_size=1), 2)
+        state.save(self.state_path)
+
+        self._write('bob', '2.5.1', 300, 400)
+        self.index.refresh()
+        state = rollup.Rollup.load(self.state_path)
+        with mock.patch.object(self.index, 'query', wraps=self.index.query) as mock_query:
+            self.assertEqual(state.update(self.index), 1)
+        self.assertEqual(mock_query.call_args[1]['after_id'], 2)
+        report = state.report(min_version='2.5')
+        self.assertEqual(report['records'], 3)
+        self.assertEqual(report['users'], 2)
+        self.assertEqual(report['versions']['IV_VER']['2.4.8']['count'], 1)
+        self.assertEqual(report['versions']['IV_VER']['2.5.1']['bytes_sent']['sum'], 1300)
+        self.assertEqual(report['top_talkers'][0], {'common_name': 'sue', 'bytes': 3000,
+                                                    'error': 0})
+        self.assertEqual(report['outdated'], {}, 'bob has upgraded since')
+        self.assertEqual(state.outdated('IV_VER', '2.6'), {'bob': '2.5.1', 'sue': '2.5.1'})
+
+    def test_05_update_across_compaction(self):
+        """ Records compacted since the last refresh are not skipped """
+        archive_dir = os.path.join(self.workdir, 'archive')
+        os.mkdir(archive_dir)
+        self.index.close()
+        self.index = reader.SpoolIndex(os.path.join(self.workdir, 'index.sqlite'),
+                                       self.spool_dir, archive_dir)
+        self._write('bob', '2.4.8', 100, 200)
+        self.index.refresh()
+        state = rollup.Rollup()
+        self.assertEqual(state.update(self.index), 1)
+        for _ in range(3):
+            self._write('sue', '2.5.1', 1000, 2000)
+        self.index.refresh()
+        last_id = state.last_id
+        compact.Compactor(self.spool_dir, archive_dir).run()
+        # Not even a refresh finds them: stop short, and don't move on.
+        with mock.patch.object(self.index, 'refresh'):
+            self.assertEqual(state.update(self.index, chunk_size=2), 0)
+        self.assertEqual(state.last_id, last_id)
+        # A refresh finds them in the archive.
+        self.assertEqual(state.update(self.index, chunk_size=2), 3)
+        self.assertEqual(state.report()['records'], 4)
+
+    def test_10_main_work(self):
+        """ The command line updates the state and reports """
+        self._write('bob', '2.4.8', 100, 200)
+        conffile = os.path.join(self.workdir, 'ocd.conf')
+        with open(conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write('[client-disconnect]\n'
+                              f'metrics-log-dir = {self.spool_dir}\n'
+                              f'metrics-rollup-state = {self.state_path}\n')
+        for _ in range(2):
+            with mock.patch('sys.stdout', new=StringIO()) as fake_out:
+                self.assertTrue(rollup.main_work(['rollup', '--conf', conffile,
+                                                  '--min-version', '2.5']))
+        report = json.loads(fake_out.getvalue())
+        self.assertEqual(report['records'], 1)
+        self.assertEqual(report['outdated'], {'bob': '2.4.8'})
+        self.assertTrue(os.path.exists(self.state_path))
+
+    def test_11_main_work_unconfigured(self):
+        """ Without a spool, there's nothing to roll up """
+        conffile = os.path.join(self.workdir, 'ocd.conf')
+        with open(conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write('[client-disconnect]\n')
+        with mock.patch('sys.stderr', new=StringIO()):
+            self.assertFalse(rollup.main_work(['rollup', '--conf', conffile]))
+
+    def test_12_main_work_refresh_fails(self):
+        """ A spool that can't be read is reported, not a traceback """
+        conffile = os.path.join(self.workdir, 'ocd.conf')
+        with open(conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write('[client-disconnect]\n'
+                              f'metrics-log-dir = {self.spool_dir}\n'
+                              f'metrics-rollup-state = {self.state_path}\n')
+        with mock.patch.object(reader.SpoolIndex, 'refresh',
+                               side_effect=sqlite3.OperationalError('database is locked')), \
+                mock.patch('sys.stderr', new=StringIO()) as fake_err:
+            self.assertFalse(rollup.main_work(['rollup', '--conf', conffile]))
+        self.assertIn('database is locked', fake_err.getvalue())
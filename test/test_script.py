@@ -2,6 +2,8 @@
 
 import unittest
 import os
+import shutil
+import tempfile
 from io import StringIO
 import syslog
 import datetime
@@ -33,20 +35,20 @@ class TestClientDisconnect(unittest.TestCase):
         """ With no config files, get an empty ConfigParser """
         with self.assertRaises(IOError), \
                 mock.patch('sys.stderr', new=StringIO()):
-            self.openvpn_client_disconnect._ingest_config_from_file([])
+            self.openvpn_client_disconnect.ingest_config_from_file([])
 
     def test_04_ingest_no_config_file(self):
         """ With all missing config files, get an empty ConfigParser """
         with self.assertRaises(IOError), \
                 mock.patch('sys.stderr', new=StringIO()):
             _not_a_real_file = '/tmp/no-such-file.txt'  # nosec hardcoded_tmp_directory
-            self.openvpn_client_disconnect._ingest_config_from_file([_not_a_real_file])
+            self.openvpn_client_disconnect.ingest_config_from_file([_not_a_real_file])
 
     def test_05_ingest_bad_config_file(self):
         """ With a bad config file, get an empty ConfigParser """
         with self.assertRaises(IOError), \
                 mock.patch('sys.stderr', new=StringIO()):
-            self.openvpn_client_disconnect._ingest_config_from_file(['test/context.py'])
+            self.openvpn_client_disconnect.ingest_config_from_file(['test/context.py'])
 
     def test_06_ingest_config_from_file(self):
         """ With an actual config file, get a populated ConfigParser """
@@ -54,7 +56,7 @@ class TestClientDisconnect(unittest.TestCase):
         with open(test_reading_file, 'w', encoding='utf-8') as filepointer:
             filepointer.write('[aa]\nbb = cc\n')
         filepointer.close()
-        result = self.openvpn_client_disconnect._ingest_config_from_file([test_reading_file])
+        result = self.openvpn_client_disconnect.ingest_config_from_file([test_reading_file])
         os.remove(test_reading_file)
         self.assertIsInstance(result, configparser.ConfigParser,
                               'Did not create a config object')
@@ -65,6 +67,12 @@ class TestClientDisconnect(unittest.TestCase):
         self.assertEqual(result.get('aa', 'bb'), 'cc',
                          'Should have read a correct value.')
 
+    def test_09_shareable_environment(self):
+        """ Secrets are stripped from an environment that leaves the process """
+        result = self.openvpn_client_disconnect.shareable_environment(
+            {'password': 'hunter2', 'common_name': 'bob'})  # nosec hardcoded_password_string
+        self.assertEqual(result, {'common_name': 'bob'})
+
     def test_10_log_metrics_to_disk(self):
         """ Validate that log_metrics_to_disk does the right things. """
         # common_name, time_unix = always shared
@@ -76,19 +84,24 @@ class TestClientDisconnect(unittest.TestCase):
         os.environ['something1'] = 'foo'
         os.environ['something2'] = 'bar'
         os.environ['password'] = 'hunter2'  # nosec hardcoded_password_string
-        with mock.patch('openvpn_client_disconnect.open', create=True,
-                        return_value=mock.MagicMock(spec=StringIO())) as mock_open:
-            _tmp_dir = '/tmp'  # nosec hardcoded_tmp_directory
+        _tmp_dir = tempfile.mkdtemp()
+        try:
             self.openvpn_client_disconnect.log_metrics_to_disk('bob', _tmp_dir,
                                                                set(['common_name', 'time_unix',
                                                                     'something1', 'password']))
-        file_handle = mock_open.return_value.__enter__.return_value
+            written = os.listdir(_tmp_dir)
+            self.assertEqual(len(written), 1, 'Should have written exactly one file')
+            self.assertRegex(written[0], r'^log\.bob\.20200603140543\.[0-9a-f]+\.json$')
+            with open(os.path.join(_tmp_dir, written[0]), encoding='utf-8') as filepointer:
+                contents = filepointer.read()
+        finally:
+            shutil.rmtree(_tmp_dir)
         expected_response = ('{\n'
                              '  "common_name": "bob-device",\n'
                              '  "something1": "foo",\n'
                              '  "time_unix": "1591193143"\n'
                              '}\n')
-        file_handle.write.assert_called_with(expected_response)
+        self.assertEqual(contents, expected_response)
 
     def test_11_log_event(self):
         """ Validate that log_event does the right things. """
@@ -107,9 +120,10 @@ class TestClientDisconnect(unittest.TestCase):
                 mock.patch('os.getpid', return_value=12345), \
                 mock.patch('socket.getfqdn', return_value='my.host.name'):
             self.openvpn_client_disconnect.log_event('someone@example.com', syslog.LOG_LOCAL0)
-        mock_openlog.assert_called_once_with(facility=syslog.LOG_LOCAL0)
+        mock_openlog.assert_not_called()
         mock_syslog.assert_called_once()
-        arg_passed_in = mock_syslog.call_args_list[0][0][0]
+        self.assertEqual(mock_syslog.call_args_list[0][0][0], syslog.LOG_LOCAL0 | syslog.LOG_INFO)
+        arg_passed_in = mock_syslog.call_args_list[0][0][1]
         json_sent = json.loads(arg_passed_in)
         details = json_sent['details']
         self.assertEqual(json_sent['category'], 'authentication')
@@ -130,6 +144,58 @@ class TestClientDisconnect(unittest.TestCase):
         self.assertEqual(details['sourceipaddress'], '1.2.3.4')
         self.assertEqual(details['success'], 'true')
 
+    def test_12_log_event_hostname(self):
+        """ A hostname handed to log_event is used instead of a lookup """
+        with mock.patch('syslog.openlog'), \
+                mock.patch('syslog.syslog') as mock_syslog, \
+                mock.patch('socket.getfqdn') as mock_getfqdn:
+            self.openvpn_client_disconnect.log_event('someone@example.com', syslog.LOG_LOCAL0,
+                                                     {}, hostname='cached.host.name')
+        mock_getfqdn.assert_not_called()
+        json_sent = json.loads(mock_syslog.call_args_list[0][0][1])
+        self.assertEqual(json_sent['hostname'], 'cached.host.name')
+
+    def test_13_event_hostname(self):
+        """ The hostname cache is only consulted when configured """
+        self.assertIsNone(self.openvpn_client_disconnect._event_hostname(
+            {'hostname_cache_file': None}))
+        with mock.patch('openvpn_client_disconnect.hostname.cached_fqdn',
+                        return_value='cached.host.name') as mock_cached:
+            result = self.openvpn_client_disconnect._event_hostname(
+                {'hostname_cache_file': '/some/file', 'hostname_cache_ttl': 60,
+                 'hostname_lookup_timeout': 1.5})
+        self.assertEqual(result, 'cached.host.name')
+        mock_cached.assert_called_once_with('/some/file', 60, 1.5)
+
+    def test_14_event_transport(self):
+        """ A transport is only used when configured """
+        self.assertIsNone(self.openvpn_client_disconnect._event_transport(
+            {'event_transport': None, 'event_facility': syslog.LOG_AUTH}))
+        with mock.patch('openvpn_client_disconnect.transport.get_transport',
+                        return_value='a transport') as mock_get:
+            result = self.openvpn_client_disconnect._event_transport(
+                {'event_transport': 'udp://127.0.0.1:514', 'event_facility': syslog.LOG_AUTH})
+        self.assertEqual(result, 'a transport')
+        mock_get.assert_called_once_with('udp://127.0.0.1:514', syslog.LOG_AUTH)
+
+    def test_15_metric_selector(self):
+        """ Names, prefixes and patterns pick out variables in one pass """
+        selector = self.openvpn_client_disconnect.MetricSelector(
+            ['bytes_sent', 'IV_*', 'tls_*_0', 'pass*', 'password'])
+        self.assertEqual(selector, set(['bytes_sent', 'IV_*', 'tls_*_0', 'pass*', 'password']))
+        self.assertEqual(selector.prefixes, ('IV_', 'pass'))
+        environ = {'bytes_sent': '1', 'bytes_received': '2', 'IV_VER': '2.4.9',
+                   'IV_PLAT': 'mac', 'XIV_VER': 'no', 'tls_digest_0': 'ab', 'tls_digest_1': 'cd',
+                   'password': 'hunter2', 'passage': 'yes',  # nosec hardcoded_password_string
+                   'common_name': 'bob'}
+        self.assertEqual(selector.select(environ),
+                         {'bytes_sent': '1', 'IV_VER': '2.4.9', 'IV_PLAT': 'mac',
+                          'tls_digest_0': 'ab', 'passage': 'yes', 'common_name': 'bob',
+                          'time_unix': ''})
+        restored = self.openvpn_client_disconnect.MetricSelector.from_state(selector.to_state())
+        self.assertEqual(restored, selector)
+        self.assertEqual(restored.select(environ), selector.select(environ))
+
     def test_20_main_main(self):
         ''' Test the main() interface '''
         with self.assertRaises(SystemExit) as exiting, \
@@ -164,7 +230,7 @@ class TestClientDisconnect(unittest.TestCase):
     def test_22_main_blank(self):
         ''' With envvars provided, bomb out '''
         config = configparser.ConfigParser()
-        with mock.patch.object(self.openvpn_client_disconnect, '_ingest_config_from_file',
+        with mock.patch.object(self.openvpn_client_disconnect, 'ingest_config_from_file',
                                return_value=config), \
                 mock.patch('sys.stdout', new=StringIO()) as fake_out:
             result = self.openvpn_client_disconnect.main_work(['script', '--conf',
@@ -177,7 +243,7 @@ class TestClientDisconnect(unittest.TestCase):
         ''' With just one envvar provided, bomb out '''
         os.environ['common_name'] = 'bob-device'
         config = configparser.ConfigParser()
-        with mock.patch.object(self.openvpn_client_disconnect, '_ingest_config_from_file',
+        with mock.patch.object(self.openvpn_client_disconnect, 'ingest_config_from_file',
                                return_value=config), \
                 mock.patch('sys.stdout', new=StringIO()) as fake_out:
             result = self.openvpn_client_disconnect.main_work(['script', '--conf',
@@ -190,7 +256,7 @@ class TestClientDisconnect(unittest.TestCase):
         os.environ['common_name'] = 'bob-device'
         os.environ['trusted_ip'] = '10.20.30.40'
         config = configparser.ConfigParser()
-        with mock.patch.object(self.openvpn_client_disconnect, '_ingest_config_from_file',
+        with mock.patch.object(self.openvpn_client_disconnect, 'ingest_config_from_file',
                                return_value=config), \
                 mock.patch.object(self.openvpn_client_disconnect,
                                   'log_metrics_to_disk') as mock_metrics, \
@@ -199,7 +265,8 @@ class TestClientDisconnect(unittest.TestCase):
             result = self.openvpn_client_disconnect.main_work(['script', '--conf',
                                                                'test/context.py'])
         self.assertTrue(result, 'With all environmental variables, main_work must work')
-        mock_metrics.assert_called_once_with('bob-device', None, set([]))
+        mock_metrics.assert_called_once_with('bob-device', None, set([]), os.environ,
+                                             spool_options=None, enrichment=None)
         mock_logevent.assert_not_called()
 
     def test_25_complete_with_logging(self):
@@ -210,7 +277,7 @@ class TestClientDisconnect(unittest.TestCase):
         config.add_section('client-disconnect')
         config.set('client-disconnect', 'syslog-events-send', 'true')
         config.set('client-disconnect', 'syslog-events-facility', 'invalid')
-        with mock.patch.object(self.openvpn_client_disconnect, '_ingest_config_from_file',
+        with mock.patch.object(self.openvpn_client_disconnect, 'ingest_config_from_file',
                                return_value=config), \
                 mock.patch.object(self.openvpn_client_disconnect,
                                   'log_metrics_to_disk') as mock_metrics, \
@@ -219,8 +286,11 @@ class TestClientDisconnect(unittest.TestCase):
             result = self.openvpn_client_disconnect.main_work(['script', '--conf',
                                                                'test/context.py'])
         self.assertTrue(result, 'With all environmental variables, main_work must work')
-        mock_metrics.assert_called_once_with('bob-device', None, set([]))
-        mock_logevent.assert_called_once_with('bob-device', syslog.LOG_AUTH)
+        mock_metrics.assert_called_once_with('bob-device', None, set([]), os.environ,
+                                             spool_options=None, enrichment=None)
+        mock_logevent.assert_called_once_with('bob-device', syslog.LOG_AUTH, os.environ,
+                                              hostname=None, transport=None,
+                                              enrichment=None)
 
     def test_26_complete_with_logging(self):
         ''' Run correctly with logging enabled. '''
@@ -230,7 +300,7 @@ class TestClientDisconnect(unittest.TestCase):
         config.add_section('client-disconnect')
         config.set('client-disconnect', 'syslog-events-send', 'true')
         config.set('client-disconnect', 'syslog-events-facility', 'mail')
-        with mock.patch.object(self.openvpn_client_disconnect, '_ingest_config_from_file',
+        with mock.patch.object(self.openvpn_client_disconnect, 'ingest_config_from_file',
                                return_value=config), \
                 mock.patch.object(self.openvpn_client_disconnect,
                                   'log_metrics_to_disk') as mock_metrics, \
@@ -239,5 +309,8 @@ class TestClientDisconnect(unittest.TestCase):
             result = self.openvpn_client_disconnect.main_work(['script', '--conf',
                                                                'test/context.py'])
         self.assertTrue(result, 'With all environmental variables, main_work must work')
-        mock_metrics.assert_called_once_with('bob-device', None, set([]))
-        mock_logevent.assert_called_once_with('bob-device', syslog.LOG_MAIL)
+        mock_metrics.assert_called_once_with('bob-device', None, set([]), os.environ,
+                                             spool_options=None, enrichment=None)
+        mock_logevent.assert_called_once_with('bob-device', syslog.LOG_MAIL, os.environ,
+                                              hostname=None, transport=None,
+                                              enrichment=None)
@@ -0,0 +1,251 @@
+""" openvpn-disconnect spool shipper tests """
+
+import unittest
+import os
+import io
+import json
+import shutil
+import sqlite3
+import tempfile
+import test.context  # pylint: disable=unused-import
+import mock
+from openvpn_client_disconnect import spool
+from openvpn_client_disconnect import compact
+from openvpn_client_disconnect import reader
+from openvpn_client_disconnect import shipper
+from openvpn_client_disconnect.standins import HttpCollector
+
+
+class TestShipper(unittest.TestCase):
+    """
+        Tests for shipping the spool to an HTTP collector.
+    """
+
+    def setUp(self):
+        """ Create a spool and an index over it """
+        self.workdir = tempfile.mkdtemp()
+        self.spool_dir = os.path.join(self.workdir, 'spool')
+        os.mkdir(self.spool_dir)
+        self.state_path = os.path.join(self.workdir, 'ship.json')
+        self.index_path = os.path.join(self.workdir, 'index.sqlite')
+        self.index = reader.SpoolIndex(self.index_path,
+                                       self.spool_dir)
+        self.writer = spool.FileSpool(self.spool_dir)
+        self.written = 0
+        self.pools = []
+
+    def tearDown(self):
+        """ Clean up """
+        for pool in self.pools:
+            pool.close()
+        self.index.close()
+        shutil.rmtree(self.workdir)
+
+    def _write(self, count):
+        """ Add count disconnects to the spool, and index them """
+        for _ in range(count):
+            self.written += 1
+            self.writer.write('bob', {'common_name': 'bob',
+                                      'time_unix': str(1591189200 + self.written),
+                                      'bytes_sent': str(self.written)})
+        self.index.refresh()
+
+    def _shipper(self, collector, batch_size=10, connections=2):
+        """ A Shipper to collector that doesn't wait long to retry """
+        pool = shipper.ConnectionPool(collector.url, connections, 5)
+        self.pools.append(pool)
+        return shipper.Shipper(self.index, pool, self.state_path, batch_size,
+                               initial_backoff=0.01, max_backoff=0.05)
+
+    def test_01_ship_everything(self):
+        """ Every record arrives, in batches, over one connection """
+        self._write(35)
+        with HttpCollector() as collector:
+            ship = self._shipper(collector, connections=1)
+            self.assertEqual(ship.ship(), 35)
+            records = collector.wait_for(35)
+        self.assertEqual(sorted(int(x['bytes_sent']) for x in records), list(range(1, 36)))
+        self.assertEqual(collector.batches, 4)
+        self.assertEqual(collector.connections, 1)
+        report = ship.report()
+        self.assertEqual((report['records'], report['batches'], report['retries']), (35, 4, 0))
+        self.assertGreater(report['records_per_second'], 0)
+        self.assertLess(report['bytes'], len(b''.join(spool.encode_json_record(x)
+                                                      for x in records)))
+
+    def test_02_checkpoint(self):
+        """ A new shipper picks up where the last one was acknowledged """
+        self._write(12)
+        with HttpCollector() as collector:
+            self.assertEqual(self._shipper(collector).ship(), 12)
+            self._write(5)
+            ship = self._shipper(collector)
+            self.assertEqual(ship.last_id, 12)
+            self.assertEqual(ship.ship(), 5)
+            self.assertEqual(ship.ship(), 0)
+        self.assertEqual(len(collector.records), 17)
+        with open(self.state_path, 'r', encoding='utf-8') as filepointer:
+            self.assertEqual(json.load(filepointer), {'last_id': 17})
+
+    def test_03_retry(self):
+        """ Unavailable and too-many-requests are retried """
+        self._write(10)
+        with HttpCollector([503, (429, 0), 500]) as collector:
+            ship = self._shipper(collector)
+            self.assertEqual(ship.ship(), 10)
+        self.assertEqual(len(collector.records), 10)
+        self.assertEqual(collector.requests, 4)
+        self.assertEqual(ship.report()['retries'], 3)
+
+    def test_04_refused(self):
+        """ A batch that's refused stops shipping, without skipping it """
+        self._write(25)
+        with HttpCollector([200, 200, 400]) as collector:
+            ship = self._shipper(collector, connections=1)
+            with self.assertRaises(shipper.ShipError):
+                ship.ship()
+        # The first two "accepted" without storing anything.
+        self.assertEqual(ship.last_id, 20)
+        self.assertEqual(ship.report()['records'], 20)
+
+    def test_05_connection_failure(self):
+        """ A collector that isn't there yet is retried until stopped """
+        self._write(3)
+        with HttpCollector() as collector:
+            url = collector.url
+        pool = shipper.ConnectionPool(url, 1, 1)
+        self.pools.append(pool)
+        ship = shipper.Shipper(self.index, pool, self.state_path, initial_backoff=0.01,
+                               max_backoff=0.01)
+        real_wait = ship._stopping.wait
+
+        def _wait(delay):
+            if ship.stats['retries'] >= 3:
+                ship.stop()
+            return real_wait(delay)
+
+        with mock.patch.object(ship._stopping, 'wait', side_effect=_wait), \
+                self.assertRaises(shipper.ShipError):
+            ship.ship()
+        self.assertEqual(ship.last_id, 0)
+        self.assertFalse(os.path.exists(self.state_path))
+
+    def test_06_back_pressure(self):
+        """ A slow collector bounds what's in flight to the pool size """
+        self._write(40)
+        queried = []
+        real_query = self.index.query
+
+        def _query(**kwargs):
+            queried.append(collector.requests)
+            return real_query(**kwargs)
+
+        with HttpCollector(delay=0.05) as collector:
+            ship = self._shipper(collector, connections=2)
+            with mock.patch.object(self.index, 'query', side_effect=_query):
+                self.assertEqual(ship.ship(), 40)
+        self.assertLessEqual(collector.connections, 2)
+        # Reading the third batch waited for the first to be answered.
+        self.assertGreaterEqual(queried[3], 1)
+
+    def test_07_backoff_delay(self):
+        """ Backoff doubles, with jitter, up to the maximum; Retry-After wins """
+        for attempt in range(6):
+            delay = shipper.backoff_delay(attempt, 1.0, 10.0)
+            ceiling = min(10.0, 2 ** attempt)
+            self.assertTrue(ceiling / 2 <= delay <= ceiling)
+        self.assertEqual(shipper.backoff_delay(0, 1.0, 10.0, '7'), 7.0)
+        self.assertEqual(shipper.backoff_delay(0, 1.0, 10.0, '700'), 10.0)
+        self.assertLessEqual(shipper.backoff_delay(0, 1.0, 10.0, 'Wed, 21 Oct'), 1.0)
+        with self.assertRaises(ValueError):
+            shipper.ConnectionPool('ftp://example.com/')
+
+    def test_08_main(self):
+        """ The command line ships once and reports """
+        self._write(7)
+        with HttpCollector() as collector:
+            conffile = os.path.join(self.workdir, 'ocd.conf')
+            with open(conffile, 'w', encoding='utf-8') as filepointer:
+                filepointer.write('[client-disconnect]\n'
+                                  f'metrics-log-dir = {self.spool_dir}\n'
+                                  "metrics = ['*']\n"
+                                  f'metrics-index-file = {self.index_path}\n'
+                                  f'ship-url = {collector.url}\n'
+                                  'ship-batch-size = 5\n')
+            with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+                self.assertTrue(shipper.main_work(['ship', '--conf', conffile, '--once',
+                                                   '--state', self.state_path]))
+            report = json.loads(stdout.getvalue())
+            self.assertEqual((report['records'], report['batches']), (7, 2))
+            self.assertEqual(len(collector.records), 7)
+        with mock.patch('sys.stderr', new_callable=io.StringIO):
+            self.assertFalse(shipper.main_work(['ship', '--conf', conffile, '--once',
+                                                '--url', 'nope']))
+        with mock.patch.object(shipper, 'main_work', return_value=True), \
+                self.assertRaises(SystemExit) as exiting:
+            shipper.main()
+        self.assertEqual(exiting.exception.code, 0)
+        with mock.patch.object(shipper, 'main_work', return_value=False), \
+                self.assertRaises(SystemExit) as exiting:
+            shipper.main()
+        self.assertEqual(exiting.exception.code, 1)
+
+    def test_09_across_compaction(self):
+        """ Records compacted since the last refresh are not checkpointed past """
+        archive_dir = os.path.join(self.workdir, 'archive')
+        os.mkdir(archive_dir)
+        self.index.close()
+        self.index = reader.SpoolIndex(self.index_path, self.spool_dir, archive_dir)
+        self._write(2)
+        with HttpCollector() as collector:
+            ship = self._shipper(collector, batch_size=2)
+            self.assertEqual(ship.ship(), 2)
+            self._write(3)
+            compact.Compactor(self.spool_dir, archive_dir).run()
+            # Not even a refresh finds them: stop short, and don't move on.
+            with mock.patch.object(self.index, 'refresh'):
+                self.assertEqual(ship.ship(), 0)
+            self.assertEqual(ship.last_id, 2)
+            # A refresh finds them in the archive.
+            self.assertEqual(ship.ship(), 3)
+        self.assertEqual(sorted(int(x['bytes_sent']) for x in collector.records),
+                         [1, 2, 3, 4, 5])
+
+    def test_10_run_survives_read_errors(self):
+        """ The long-running shipper reports spool trouble and tries again """
+        self._write(3)
+        real_refresh = self.index.refresh
+        refreshes = []
+
+        def _refresh():
+            refreshes.append(1)
+            if len(refreshes) == 1:
+                raise sqlite3.OperationalError('database is locked')
+            return real_refresh()
+
+        with HttpCollector() as collector:
+            ship = self._shipper(collector)
+
+            def _ship():
+                shipped = real_ship()
+                ship.stop()
+                return shipped
+
+            real_ship = ship.ship
+            with mock.patch.object(self.index, 'refresh', side_effect=_refresh), \
+                    mock.patch.object(ship, 'ship', side_effect=_ship), \
+                    mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+                ship.run(interval=0.01)
+            self.assertEqual(len(collector.records), 3)
+        self.assertIn('database is locked', stderr.getvalue())
+        self.assertEqual(ship.last_id, 3)
+
+    def test_11_corrupt_checkpoint(self):
+        """ A checkpoint that can't be read means starting over, not crashing """
+        for content in ('{"last_id": 1', '', '[]', '{}', '{"last_id": "7"}'):
+            with open(self.state_path, 'w', encoding='utf-8') as filepointer:
+                filepointer.write(content)
+            with HttpCollector() as collector, \
+                    mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+                self.assertEqual(self._shipper(collector).last_id, 0)
+            self.assertIn('unreadable checkpoint', stderr.getvalue())
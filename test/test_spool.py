@@ -0,0 +1,355 @@
+""" openvpn-disconnect spool writer tests """
+
+import unittest
+import os
+import json
+import time
+import shutil
+import tempfile
+import multiprocessing
+import configparser
+import test.context  # pylint: disable=unused-import
+import mock
+import openvpn_client_disconnect
+from openvpn_client_disconnect import spool
+
+
+def _append_many(spool_dir, worker, count, writer_class=spool.SegmentSpool):
+    """ Write count records from one process """
+    writer = writer_class(spool_dir, max_bytes=10 * 1024 * 1024)
+    for index in range(count):
+        writer.write('bob', {'common_name': 'bob', 'time_unix': '1591193143',
+                             'worker': str(worker), 'index': str(index),
+                             'padding': 'x' * 2000})
+
+
+class TestSpool(unittest.TestCase):
+    """
+        Tests for the spool writers.
+    """
+
+    def setUp(self):
+        """ Create a spool directory """
+        self.spool_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """ Clean up """
+        shutil.rmtree(self.spool_dir)
+
+    def _segments(self):
+        """ The segment files in the spool, sorted """
+        return sorted(x for x in os.listdir(self.spool_dir) if spool.parse_segment_name(x))
+
+    def _records(self):
+        """ Every record in every segment """
+        result = []
+        for name in self._segments():
+            with open(os.path.join(self.spool_dir, name), encoding='utf-8') as filepointer:
+                result.extend(json.loads(line) for line in filepointer)
+        return result
+
+    def test_01_names(self):
+        """ Segment names round-trip """
+        self.assertEqual(spool.segment_bucket(1591193143, 3600), '20200603140000')
+        name = spool.segment_name('20200603140000', 3)
+        self.assertEqual(name, 'segment.20200603140000.0003.jsonl')
+        self.assertEqual(spool.parse_segment_name(name), ('20200603140000', 3, '.jsonl'))
+        self.assertIsNone(spool.parse_segment_name('log.bob.20200603140543.json'))
+        self.assertIsNone(spool.parse_segment_name('segment.x.y.jsonl'))
+
+    def test_02_append(self):
+        """ Records are compact, one per line, in the same segment """
+        writer = spool.SegmentSpool(self.spool_dir)
+        writer.write('bob', {'time_unix': '1', 'common_name': 'bob'})
+        writer.write('bob', {'time_unix': '2', 'common_name': 'bob'})
+        self.assertEqual(len(self._segments()), 1)
+        with open(os.path.join(self.spool_dir, self._segments()[0]), 'rb') as filepointer:
+            self.assertEqual(filepointer.read(),
+                             b'{"common_name":"bob","time_unix":"1"}\n'
+                             b'{"common_name":"bob","time_unix":"2"}\n')
+
+    def test_03_rotate_size(self):
+        """ A full segment rolls over to the next sequence number """
+        writer = spool.SegmentSpool(self.spool_dir, max_bytes=30)
+        for index in range(3):
+            writer.write('bob', {'common_name': 'bob', 'time_unix': str(index)})
+        self.assertEqual([spool.parse_segment_name(x)[1] for x in self._segments()], [0, 1, 2])
+        self.assertEqual(len(self._records()), 3)
+
+    def test_04_rotate_age(self):
+        """ A new window gets a new segment """
+        writer = spool.SegmentSpool(self.spool_dir, max_age=60)
+        with mock.patch('time.time', return_value=1591193143):
+            writer.write('bob', {'common_name': 'bob'})
+        with mock.patch('time.time', return_value=1591193143 + 60):
+            writer.write('bob', {'common_name': 'bob'})
+        self.assertEqual(self._segments(), ['segment.20200603140500.0000.jsonl',
+                                            'segment.20200603140600.0000.jsonl'])
+
+    def test_05_concurrent_appends(self):
+        """ Several processes sharing a segment never tear a record """
+        workers = [multiprocessing.Process(target=_append_many,
+                                           args=(self.spool_dir, worker, 100))
+                   for worker in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        records = self._records()
+        self.assertEqual(len(records), 400)
+        self.assertEqual(len({(x['worker'], x['index']) for x in records}), 400)
+
+    def test_06_writer_for(self):
+        """ writer_for builds the writer the options ask for """
+        writer = spool.writer_for(self.spool_dir, {'format': 'segments',
+                                                   'segment_max_bytes': 10})
+        self.assertIsInstance(writer, spool.SegmentSpool)
+        self.assertEqual(writer.max_bytes, 10)
+        self.assertEqual(writer.max_age, spool.DEFAULT_SEGMENT_MAX_AGE)
+        with self.assertRaises(ValueError):
+            spool.writer_for(self.spool_dir, {'format': 'carrier-pigeon'})
+
+    def test_07_file_unique_names(self):
+        """ Two records in the same second both survive """
+        writer = spool.FileSpool(self.spool_dir)
+        first = writer.write('bob', {'common_name': 'bob', 'time_unix': '1591193143'})
+        second = writer.write('bob', {'common_name': 'bob', 'time_unix': '1591193143'})
+        self.assertNotEqual(first, second)
+        self.assertEqual(len(os.listdir(self.spool_dir)), 2)
+
+    def test_08_file_layouts(self):
+        """ The sharded layouts put files in bounded subdirectories """
+        record = {'common_name': 'bob', 'time_unix': '1591193143'}
+        written = spool.FileSpool(self.spool_dir, 'date').write('bob', record)
+        self.assertEqual(os.path.dirname(os.path.relpath(written, self.spool_dir)),
+                         '2020/06/03/14')
+        written = spool.FileSpool(self.spool_dir, 'hash').write('bob', record)
+        shard = os.path.dirname(os.path.relpath(written, self.spool_dir))
+        self.assertRegex(shard, r'^[0-9a-f]{2}/[0-9a-f]{2}$')
+        self.assertEqual(shard, spool.shard_path('hash', 'bob', 0))
+        with self.assertRaises(ValueError):
+            spool.FileSpool(self.spool_dir, 'by-mood')
+
+    def test_09_file_atomic(self):
+        """ A failed write leaves neither the record nor its temp file """
+        writer = spool.FileSpool(self.spool_dir)
+        with mock.patch('os.replace', side_effect=OSError('disk on fire')), \
+                self.assertRaises(OSError):
+            writer.write('bob', {'common_name': 'bob', 'time_unix': '1591193143'})
+        self.assertEqual(os.listdir(self.spool_dir), [])
+        written = writer.write('a/../../b', {'common_name': 'x', 'time_unix': '1591193143'})
+        self.assertEqual(os.path.dirname(written), self.spool_dir)
+
+    def test_12_iter_sources(self):
+        """ Every finished file is found, wherever it's sharded to """
+        record = {'common_name': 'bob', 'time_unix': '1591193143'}
+        flat = spool.FileSpool(self.spool_dir).write('bob', record)
+        dated = spool.FileSpool(self.spool_dir, 'date').write('bob', record)
+        os.makedirs(os.path.join(self.spool_dir, 'archive'))
+        spool.FileSpool(os.path.join(self.spool_dir, 'archive')).write('bob', record)
+        writer = spool.SegmentSpool(self.spool_dir, max_bytes=30, max_age=3600)
+        with mock.patch('time.time', return_value=1591193143):
+            writer.write('bob', record)
+        old_segment = os.path.join(self.spool_dir, 'segment.20200603140000.0000.jsonl')
+        # Halfway through the current window, so the test can't straddle two.
+        now = (int(time.time()) // 3600) * 3600 + 1800
+        with mock.patch('time.time', return_value=now):
+            writer.write('bob', record)
+            writer.write('bob', record)
+        for name in os.listdir(self.spool_dir):
+            if name.startswith(spool.SEGMENT_PREFIX):
+                os.utime(os.path.join(self.spool_dir, name), (now, now))
+        sources = set(spool.iter_spool_sources(
+            self.spool_dir, 3600, now=now, exclude=[os.path.join(self.spool_dir, 'archive')]))
+        self.assertEqual(sources, {flat, dated, old_segment})
+        # A full segment that's gone quiet is finished, even in this window.
+        sources = set(spool.iter_spool_sources(self.spool_dir, 3600, now=now + 120,
+                                               exclude=[os.path.join(self.spool_dir,
+                                                                     'archive')]))
+        self.assertEqual(len(sources), 4)
+
+    def test_13_read_records(self):
+        """ Records come back with the offsets to resume from """
+        path = os.path.join(self.spool_dir, 'segment.20200603140000.0000.jsonl')
+        with open(path, 'wb') as filepointer:
+            filepointer.write(b'{"a":"1"}\nnot json\n{"a":"2"}\n{"a":')
+        records = list(spool.read_records(path))
+        self.assertEqual(records, [(0, 10, {'a': '1'}), (19, 29, {'a': '2'})])
+        self.assertEqual(list(spool.read_records(path, 19)), [(19, 29, {'a': '2'})])
+        written = spool.FileSpool(self.spool_dir).write('bob', {'time_unix': '1'})
+        self.assertEqual([x[2] for x in spool.read_records(written)], [{'time_unix': '1'}])
+        self.assertEqual(list(spool.read_records(written, 5)), [])
+
+    def test_10_log_metrics_segments(self):
+        """ log_metrics_to_disk appends to a segment when asked to """
+        environ = {'common_name': 'bob-device', 'time_unix': '1591193143',
+                   'something1': 'foo', 'password': 'hunter2'}  # nosec
+        for _ in range(2):
+            openvpn_client_disconnect.log_metrics_to_disk(
+                'bob', self.spool_dir, set(['something1', 'password']), environ,
+                spool_options={'format': 'segments'})
+        self.assertEqual(self._records(), [{'common_name': 'bob-device',
+                                            'something1': 'foo',
+                                            'time_unix': '1591193143'}] * 2)
+
+    def test_11_settings(self):
+        """ The spool options come from the config file """
+        config = configparser.ConfigParser()
+        config.read_string('[client-disconnect]\n'
+                           'metrics-spool-format = segments\n'
+                           'metrics-segment-max-bytes = 1000\n'
+                           'metrics-segment-max-age = 60\n')
+        settings = openvpn_client_disconnect.settings_from_config(config)
+        self.assertEqual(settings['spool_options'], {'format': 'segments',
+                                                     'segment_max_bytes': 1000,
+                                                     'segment_max_age': 60})
+        config = configparser.ConfigParser()
+        config.read_string('[client-disconnect]\nmetrics-log-layout = date\n')
+        settings = openvpn_client_disconnect.settings_from_config(config)
+        self.assertEqual(settings['spool_options'], {'format': 'files', 'layout': 'date'})
+        config = configparser.ConfigParser()
+        settings = openvpn_client_disconnect.settings_from_config(config)
+        self.assertIsNone(settings['spool_options'])
+
+    def test_14_binary_records(self):
+        """ Binary records decode back to the same dicts """
+        names = ['common_name', 'time_unix', 'IV_VER']
+        ids = {name: num for num, name in enumerate(names, 1)}
+        records = [
+            {'common_name': 'bob', 'time_unix': '1591193143', 'IV_VER': '2.5.8'},
+            {},
+            # Not in the header, so named inline.
+            {'common_name': 'bob', 'extra': 'x', 'IV_VER': ''},
+            {'common_name': 'b\u00f6b', 'time_unix': 'caf\udcc3'},
+            {'common_name': 'bob', 'padding': 'x' * 70000},
+        ]
+        for record in records:
+            encoded = spool.encode_binary_record(record, ids)
+            self.assertEqual(int.from_bytes(encoded[:4], 'little'), len(encoded) - 4)
+            self.assertEqual(spool.decode_binary_record(encoded[4:], names), record)
+        self.assertLess(len(spool.encode_binary_record(records[0], ids)),
+                        len(spool.encode_json_record(records[0])))
+        for garbled in [b'', b'\x01\x00B\x09\x00\x01', b'\x01\x00B\x01\x00\x05ab',
+                        b'\x01\x00B\x01\x00\x01ab']:
+            with self.assertRaises(ValueError):
+                spool.decode_binary_record(garbled, names)
+
+    def test_15_binary_segments(self):
+        """ Binary segments have a header, and read back like JSON ones """
+        writer = spool.writer_for(self.spool_dir, {'format': 'segments',
+                                                   'segment_encoding': 'binary'})
+        self.assertIsInstance(writer, spool.BinarySegmentSpool)
+        first = {'common_name': 'bob', 'time_unix': '1591193143', 'IV_VER': '2.5.8'}
+        second = {'common_name': 'amy', 'time_unix': '1591193144', 'IV_PLAT': 'mac'}
+        writer.write('bob', first)
+        spool.BinarySegmentSpool(self.spool_dir).write('amy', second)
+        segments = self._segments()
+        self.assertEqual(len(segments), 1)
+        self.assertTrue(segments[0].endswith('.bin'))
+        self.assertEqual(set(os.listdir(self.spool_dir)), set(['.segment-hint', segments[0]]))
+        path = os.path.join(self.spool_dir, segments[0])
+        with open(path, 'rb') as filepointer:
+            self.assertEqual(spool.read_binary_header(filepointer),
+                             ['IV_VER', 'common_name', 'time_unix'])
+        records = list(spool.read_records(path))
+        self.assertEqual([x[2] for x in records], [first, second])
+        self.assertEqual(records[1][0], records[0][1])
+        self.assertEqual(list(spool.read_records(path, records[1][0])), records[1:])
+        self.assertEqual(spool.read_record_at(path, records[1][0],
+                                              records[1][1] - records[1][0]), second)
+        # Half a record is left for later; a garbled one is skipped.
+        with open(path, 'ab') as filepointer:
+            filepointer.write(b'\x03\x00\x00\x00\xff\xff\xff')
+            filepointer.write(spool.encode_binary_record(first, {})[:-1])
+        self.assertEqual([x[2] for x in spool.read_records(path)], [first, second])
+        with open(path, 'ab') as filepointer:
+            filepointer.write(b'8')
+        self.assertEqual([x[2] for x in spool.read_records(path)], [first, second, first])
+        with open(path, 'r+b') as filepointer:
+            filepointer.write(b'JUNK')
+        self.assertEqual(list(spool.read_records(path)), [])
+        self.assertIsNone(spool.read_record_at(path, records[1][0], 10))
+
+    def test_16_binary_concurrent_appends(self):
+        """ Processes sharing a binary segment don't interleave records """
+        workers = [multiprocessing.Process(target=_append_many,
+                                           args=(self.spool_dir, x, 100,
+                                                 spool.BinarySegmentSpool))
+                   for x in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        records = [record for name in self._segments()
+                   for _start, _end, record in spool.read_records(
+                       os.path.join(self.spool_dir, name))]
+        self.assertEqual(len(records), 400)
+        self.assertEqual(len({(x['worker'], x['index']) for x in records}), 400)
+        self.assertEqual([x for x in os.listdir(self.spool_dir) if x.startswith('.tmp')], [])
+
+    def test_17_binary_settings(self):
+        """ metrics-segment-encoding picks the binary encoding """
+        config = configparser.ConfigParser()
+        config.read_string('[client-disconnect]\n'
+                           'metrics-spool-format = segments\n'
+                           'metrics-segment-encoding = binary\n')
+        settings = openvpn_client_disconnect.settings_from_config(config)
+        self.assertEqual(settings['spool_options'], {'format': 'segments',
+                                                     'segment_encoding': 'binary'})
+
+    def test_18_binary_reused_inode(self):
+        """ A long-lived writer notices its segment's header has changed under it """
+        writer = spool.BinarySegmentSpool(self.spool_dir)
+        writer.write('bob', {'common_name': '1', 'time_unix': '1591193143'})
+        path = os.path.join(self.spool_dir, self._segments()[0])
+        # As if compaction removed it and a new segment got its inode,
+        # started by another writer with other names.
+        with open(path, 'r+b') as filepointer:
+            filepointer.truncate(0)
+            filepointer.write(spool.encode_binary_header(['bytes_sent', 'common_name']))
+        record = {'common_name': '2', 'time_unix': '1591193144', 'bytes_sent': 'b'}
+        writer.write('bob', record)
+        self.assertEqual([x[2] for x in spool.read_records(path)], [record])
+
+    def test_19_shard_removed_while_writing(self):
+        """ A shard directory compaction removes under a write is made again """
+        real_makedirs = os.makedirs
+        shard = os.path.join(self.spool_dir, spool.shard_path('date', 'bob', 1591193143))
+        removed = []
+
+        def _makedirs_then_compact(path, *args, **kwargs):
+            real_makedirs(path, *args, **kwargs)
+            if path == shard and not removed:
+                os.rmdir(path)
+                removed.append(path)
+
+        record = {'common_name': 'bob', 'time_unix': '1591193143'}
+        with mock.patch('os.makedirs', side_effect=_makedirs_then_compact):
+            written = spool.FileSpool(self.spool_dir, 'date').write('bob', record)
+        self.assertEqual(removed, [shard])
+        self.assertEqual(os.path.dirname(written), shard)
+        with open(written, 'r', encoding='utf-8') as filepointer:
+            self.assertEqual(json.load(filepointer), record)
+
+    def test_20_threads_starting_one_segment(self):
+        """ Threads in one process racing to start a segment don't trip each other up """
+        first = spool.BinarySegmentSpool(self.spool_dir)
+        second = spool.BinarySegmentSpool(self.spool_dir)
+        real_link = os.link
+        raced = []
+
+        def _link_after_another_thread(src, dst):
+            if not raced:
+                raced.append(dst)
+                second.write('amy', {'common_name': 'amy', 'time_unix': '1591193143'})
+            return real_link(src, dst)
+
+        with mock.patch('time.time', return_value=1591193143), \
+                mock.patch('os.link', side_effect=_link_after_another_thread):
+            first.write('bob', {'common_name': 'bob', 'time_unix': '1591193144'})
+        self.assertEqual(len(raced), 1)
+        records = [record for name in self._segments()
+                   for _start, _end, record in spool.read_records(
+                       os.path.join(self.spool_dir, name))]
+        self.assertEqual(sorted(x['common_name'] for x in records), ['amy', 'bob'])
+        self.assertEqual([x for x in os.listdir(self.spool_dir) if x.startswith('.tmp')], [])
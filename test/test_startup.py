@@ -0,0 +1,160 @@
+""" openvpn-disconnect hook startup cost tests """
+
+import unittest
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import tempfile
+import subprocess
+import test.context  # pylint: disable=unused-import
+
+# Cumulative microseconds `import openvpn_client_disconnect` may take,
+# as reported by -X importtime.  Slow or busy machines can raise it.
+IMPORT_BUDGET_US = int(os.environ.get('OCD_IMPORT_BUDGET_US', '5000'))
+# None of these should be imported just to import the package.
+HEAVY_MODULES = ['argparse', 'ast', 'configparser', 'datetime', 'json', 'socket',
+                 'syslog', 'openvpn_client_disconnect.spool']
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestStartup(unittest.TestCase):
+    """
+        The hook runs once per disconnect; keep what it imports down.
+    """
+
+    def setUp(self):
+        """ A pycache of our own, so imports are measured warm """
+        self.workdir = tempfile.mkdtemp()
+        self.env = dict(os.environ)
+        self.env.pop('PYTHONDONTWRITEBYTECODE', None)
+        self.env['PYTHONPYCACHEPREFIX'] = os.path.join(self.workdir, 'pycache')
+        self.env['PYTHONPATH'] = REPO_ROOT
+
+    def tearDown(self):
+        """ Clean up """
+        shutil.rmtree(self.workdir)
+
+    def _python(self, code, *flags):
+        """ Run code in a fresh python; return its (stdout, stderr) """
+        result = subprocess.run([sys.executable, *flags, '-c', code], env=self.env,
+                                capture_output=True, text=True, check=True)
+        return result.stdout, result.stderr
+
+    def _imported_after(self, code):
+        """ The modules a fresh python has imported after running code """
+        stdout, _stderr = self._python(f'{code}\nimport sys\nprint(" ".join(sys.modules))')
+        return set(stdout.splitlines()[-1].split())
+
+    def test_01_import_budget(self):
+        """ Importing the package is quick """
+        # Warm the pycache first; bytecode compilation isn't what we're after.
+        self._python('import openvpn_client_disconnect')
+        timings = []
+        for _ in range(3):
+            _stdout, stderr = self._python('import openvpn_client_disconnect',
+                                           '-X', 'importtime')
+            for line in stderr.splitlines():
+                parts = [x.strip() for x in line.split('|')]
+                if len(parts) == 3 and parts[2] == 'openvpn_client_disconnect':
+                    timings.append(int(parts[1]))
+        self.assertEqual(len(timings), 3)
+        self.assertLessEqual(min(timings), IMPORT_BUDGET_US,
+                             f'import took {min(timings)}us; budget is {IMPORT_BUDGET_US}us')
+
+    def test_02_import_is_minimal(self):
+        """ Importing the package doesn't import what only some outputs need """
+        imported = self._imported_after('import openvpn_client_disconnect')
+        self.assertEqual(imported & set(HEAVY_MODULES), set())
+
+    def test_03_hook_imports_only_what_it_uses(self):
+        """ A hook run with nothing to report imports nothing for reporting """
+        conffile = os.path.join(self.workdir, 'ocd.conf')
+        cache = os.path.join(self.workdir, 'settings.cache')
+        with open(conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write('[client-disconnect]\nsyslog-events-send = false\n')
+        code = ('import os\n'
+                'os.environ.update(common_name="bob", trusted_ip="1.2.3.4")\n'
+                'import openvpn_client_disconnect\n'
+                f'assert openvpn_client_disconnect.main_work(["hook", "--conf", {conffile!r}, '
+                f'"--settings-cache={cache}"])\n')
+        first = self._imported_after(code)
+        self.assertEqual(first & set(['argparse', 'datetime', 'socket', 'syslog']), set())
+        self.assertIn('configparser', first)
+        # Now that the settings are cached, there's no config to parse.
+        second = self._imported_after(code)
+        self.assertEqual(second & set(['argparse', 'ast', 'configparser', 'datetime',
+                                       'socket', 'syslog']), set())
+
+    def _hook_conf(self, extra='', send=False):
+        """ A config file for a hook run, that sends events if send, plus extra """
+        conffile = os.path.join(self.workdir, 'ocd.conf')
+        with open(conffile, 'w', encoding='utf-8') as filepointer:
+            filepointer.write(f'[client-disconnect]\nsyslog-events-send = {str(send).lower()}\n'
+                              f'{extra}')
+        return conffile
+
+    def _hook_imports(self, *args):
+        """ The modules a hook run with args imports """
+        code = ('import os\n'
+                'os.environ.update(common_name="bob", trusted_ip="1.2.3.4")\n'
+                'import openvpn_client_disconnect\n'
+                f'assert openvpn_client_disconnect.main_work(["hook", *{list(args)!r}])\n')
+        return self._imported_after(code)
+
+    def test_04_isolated_script(self):
+        """ The isolated script runs from its installed shebang """
+        venv_dir = os.path.join(self.workdir, 'venv')
+        subprocess.run([sys.executable, '-m', 'venv', '--without-pip', venv_dir], check=True)
+        python = os.path.join(venv_dir, 'bin', 'python')
+        purelib = subprocess.run([python, '-c', 'import sysconfig; '
+                                  'print(sysconfig.get_paths()["purelib"])'],
+                                 capture_output=True, text=True, check=True).stdout.strip()
+        os.symlink(os.path.join(REPO_ROOT, 'openvpn_client_disconnect'),
+                   os.path.join(purelib, 'openvpn_client_disconnect'))
+        # What setuptools does to a '#!python' line when it installs a script.
+        with open(os.path.join(REPO_ROOT, 'scripts', 'openvpn-client-disconnect-isolated'),
+                  'r', encoding='utf-8') as filepointer:
+            shebang, rest = filepointer.read().split('\n', 1)
+        self.assertTrue(shebang.startswith('#!python'))
+        script = os.path.join(venv_dir, 'bin', 'openvpn-client-disconnect-isolated')
+        with open(script, 'w', encoding='utf-8') as filepointer:
+            filepointer.write(f'#!{python}{shebang[len("#!python"):]}\n{rest}')
+        os.chmod(script, 0o755)
+        env = dict(self.env, common_name='bob', trusted_ip='1.2.3.4')
+        result = subprocess.run([script, '--conf', self._hook_conf()], env=env,
+                                capture_output=True, text=True, check=False)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    def test_05_daemon_socket_imports(self):
+        """ Forwarding to a daemon doesn't import the daemon's server """
+        imported = self._hook_imports('--conf', self._hook_conf(), '--daemon-socket',
+                                      os.path.join(self.workdir, 'nobody.sock'))
+        self.assertIn('openvpn_client_disconnect.daemon', imported)
+        self.assertEqual(imported & set(['argparse', 'socketserver', 'threading', 'subprocess',
+                                         'openvpn_client_disconnect.server']), set())
+
+    def test_06_detach_queue_imports(self):
+        """ Queueing an event for a running worker imports nothing to start one """
+        queue_dir = os.path.join(self.workdir, 'queue')
+        os.mkdir(queue_dir)
+        conffile = self._hook_conf(f'detach-queue-dir = {queue_dir}\n')
+        # Stand in for a worker that's already draining the queue.
+        with open(os.path.join(queue_dir, 'worker.lock'), 'w', encoding='utf-8') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            imported = self._hook_imports('--conf', conffile)
+        self.assertIn('openvpn_client_disconnect.eventqueue', imported)
+        self.assertEqual(imported & set(['argparse', 'selectors', 'threading', 'subprocess']),
+                         set())
+
+    def test_07_hostname_cache_imports(self):
+        """ A fresh hostname cache costs no thread and no subprocess """
+        cache_file = os.path.join(self.workdir, 'fqdn.json')
+        with open(cache_file, 'w', encoding='utf-8') as filepointer:
+            json.dump({'fqdn': 'vpn.example.com', 'resolved_at': time.time()}, filepointer)
+        conffile = self._hook_conf(f'hostname-cache-file = {cache_file}\n', send=True)
+        imported = self._hook_imports('--conf', conffile)
+        self.assertIn('openvpn_client_disconnect.hostname', imported)
+        self.assertEqual(imported & set(['argparse', 'threading', 'subprocess']), set())
@@ -0,0 +1,38 @@
+""" openvpn-disconnect synthetic environment tests """
+
+import unittest
+import test.context  # pylint: disable=unused-import
+import openvpn_client_disconnect
+from openvpn_client_disconnect import synthetic
+
+
+class TestSynthetic(unittest.TestCase):
+    """
+        Tests for the made-up disconnect environments.
+    """
+
+    def test_01_environment(self):
+        """ An environment looks like the one in the docs """
+        environ = synthetic.environment(7, now=1573147624)
+        self.assertEqual(environ['common_name'], 'user00007@work.net')
+        self.assertEqual(environ['script_type'], 'client-disconnect')
+        self.assertEqual(environ['X509_0_CN'], 'user00007@work.net')
+        self.assertEqual(environ['tls_serial_hex_0'], '03:ef')
+        self.assertEqual(int(environ['time_unix']) + int(environ['time_duration']), 1573147624)
+        self.assertEqual(len(environ['tls_digest_sha256_1'].split(':')), 32)
+        self.assertTrue(all(isinstance(x, str) for x in environ.values()))
+        self.assertEqual(synthetic.environment(7, now=1573147624), environ)
+
+    def test_02_environments(self):
+        """ A run of environments is varied, and repeatable """
+        environs = list(synthetic.environments(20, seed=3, now=1573147624))
+        self.assertEqual(len(set(x['common_name'] for x in environs)), 20)
+        self.assertGreater(len(set(x['IV_VER'] for x in environs)), 3)
+        self.assertEqual(list(synthetic.environments(20, seed=3, now=1573147624)), environs)
+
+    def test_03_selectors_match_metrics(self):
+        """ The example patterns pick out (at least) the example names """
+        environ = synthetic.environment(1)
+        by_name = openvpn_client_disconnect.MetricSelector(synthetic.EXAMPLE_METRICS)
+        by_pattern = openvpn_client_disconnect.MetricSelector(synthetic.EXAMPLE_SELECTORS)
+        self.assertLessEqual(set(by_name.select(environ)), set(by_pattern.select(environ)))
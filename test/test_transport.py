@@ -0,0 +1,168 @@
+""" openvpn-disconnect syslog transport tests """
+
+import unittest
+import os
+import json
+import shutil
+import syslog
+import tempfile
+import test.context  # pylint: disable=unused-import
+import mock
+import openvpn_client_disconnect
+from openvpn_client_disconnect import transport
+from openvpn_client_disconnect.standins import SyslogCollector
+
+
+class TestTransport(unittest.TestCase):
+    """
+        Tests for sending events over our own syslog connections.
+    """
+
+    def setUp(self):
+        """ Somewhere to put unix sockets """
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """ Clean up """
+        shutil.rmtree(self.workdir)
+
+    def test_01_parse_target(self):
+        """ Targets parse, and junk doesn't """
+        self.assertEqual(transport.parse_target('syslog'), ('syslog', None))
+        self.assertEqual(transport.parse_target(None), ('syslog', None))
+        self.assertEqual(transport.parse_target('unix:/dev/log'), ('unix', '/dev/log'))
+        self.assertEqual(transport.parse_target('udp://10.1.2.3:514'),
+                         ('udp', ('10.1.2.3', 514)))
+        self.assertEqual(transport.parse_target('tcp://[::1]:601'), ('tcp', ('::1', 601)))
+        for junk in ['tcp://nohost', 'http://x:1', 'udp://:514']:
+            with self.assertRaises(ValueError):
+                transport.parse_target(junk)
+
+    def test_02_formats(self):
+        """ Local and remote formats, and octet counting """
+        local = transport.format_rfc3164(syslog.LOG_LOCAL5, 'hi')
+        self.assertEqual(local, f'<174>{transport.APP_NAME}[{os.getpid()}]: hi'.encode())
+        remote = transport.format_rfc5424(syslog.LOG_AUTH, 'hi', 'host', now=1591190000.5)
+        self.assertEqual(remote, f'<38>1 2020-06-03T13:13:20.500000Z host '
+                                 f'{transport.APP_NAME} {os.getpid()} - - hi'.encode())
+        self.assertEqual(transport.frame_octet_counted(b'abc'), b'3 abc')
+
+    def test_03_udp(self):
+        """ UDP sends one datagram per event """
+        with SyslogCollector('udp') as collector:
+            sender = transport.SocketTransport(collector.target, syslog.LOG_AUTH, 'host')
+            for num in range(3):
+                sender.send(f'event {num}')
+            self.assertTrue(sender.flush())
+            messages = collector.wait_for(3)
+            sender.close()
+        self.assertEqual(len(messages), 3)
+        self.assertTrue(messages[0].startswith(b'<38>1 '))
+        self.assertTrue(messages[2].endswith(b' - - event 2'))
+
+    def test_04_tcp_batching(self):
+        """ TCP reuses one connection and coalesces a batch into one write """
+        with SyslogCollector('tcp') as collector:
+            sender = transport.SocketTransport(collector.target, syslog.LOG_AUTH, 'host',
+                                               batch_size=50)
+            for num in range(49):
+                sender.send(f'event {num}')
+            # Nothing goes until there's a batch, or a flush.
+            self.assertEqual(len(sender.queue), 49)
+            sender.send('event 49')
+            self.assertEqual(len(sender.queue), 0)
+            sender.send('event 50')
+            sender.flush()
+            messages = collector.wait_for(51)
+            sender.close()
+        self.assertEqual(len(messages), 51)
+        self.assertEqual(collector.connections, 1)
+        self.assertLess(collector.reads, 10)
+        self.assertTrue(messages[50].endswith(b' - - event 50'))
+
+    def test_05_unix(self):
+        """ A local datagram socket gets the traditional format """
+        path = os.path.join(self.workdir, 'log')
+        with SyslogCollector('unix', path) as collector:
+            sender = transport.SocketTransport(collector.target, syslog.LOG_LOCAL5)
+            sender.send('hello')
+            sender.flush()
+            messages = collector.wait_for(1)
+            sender.close()
+        self.assertEqual(messages, [f'<174>{transport.APP_NAME}[{os.getpid()}]: hello'.encode()])
+
+    def test_06_unreachable(self):
+        """ Nobody listening: events stay queued, and the oldest are dropped when full """
+        sender = transport.SocketTransport(f'unix:{os.path.join(self.workdir, "nope")}',
+                                           syslog.LOG_AUTH, queue_size=3, batch_size=100)
+        for num in range(5):
+            sender.send(f'event {num}')
+        self.assertFalse(sender.flush())
+        self.assertEqual(sender.dropped, 2)
+        self.assertEqual([x[1] for x in sender.queue], ['event 2', 'event 3', 'event 4'])
+
+    def test_07_reconnect(self):
+        """ A collector that goes away and comes back gets the queued events """
+        path = os.path.join(self.workdir, 'log')
+        collector = SyslogCollector('unix', path)
+        sender = transport.SocketTransport(collector.target, syslog.LOG_AUTH)
+        sender.send('one')
+        sender.flush()
+        collector.wait_for(1)
+        collector.close()
+        sender.send('two')
+        self.assertFalse(sender.flush())
+        with SyslogCollector('unix', path) as collector:
+            sender.send('three')
+            self.assertTrue(sender.flush())
+            messages = collector.wait_for(2)
+        sender.close()
+        self.assertEqual([x.rsplit(b': ', 1)[1] for x in messages], [b'two', b'three'])
+
+    def test_08_get_transport(self):
+        """ Transports are shared, and the default is the syslog module """
+        with mock.patch.dict(transport._TRANSPORTS, clear=True), \
+                mock.patch('atexit.register') as mock_atexit, \
+                mock.patch('syslog.openlog') as mock_openlog:
+            first = transport.get_transport('syslog', syslog.LOG_AUTH)
+            self.assertIsInstance(first, transport.ModuleSyslogTransport)
+            self.assertIs(transport.get_transport('syslog', syslog.LOG_AUTH), first)
+            udp = transport.get_transport('udp://127.0.0.1:514', syslog.LOG_AUTH)
+            self.assertIsInstance(udp, transport.SocketTransport)
+        mock_openlog.assert_called_once_with(facility=syslog.LOG_AUTH)
+        mock_atexit.assert_called_once_with(transport.flush_all, final=True)
+
+    def test_10_flush_at_exit(self):
+        """ At exit, a collector that doesn't answer gets one short try """
+        sender = transport.SocketTransport('tcp://192.0.2.1:601', syslog.LOG_AUTH)
+        sender.send('hello')
+        with mock.patch('socket.create_connection',
+                        side_effect=OSError('timed out')) as mock_connect:
+            self.assertFalse(sender.flush())
+            self.assertEqual(mock_connect.call_args_list,
+                             [mock.call(('192.0.2.1', 601),
+                                        timeout=transport.CONNECT_TIMEOUT)] * 2)
+            mock_connect.reset_mock()
+            with mock.patch.dict(transport._TRANSPORTS, {('tcp', 0): sender}, clear=True):
+                transport.flush_all(final=True)
+            mock_connect.assert_called_once_with(('192.0.2.1', 601),
+                                                 timeout=transport.EXIT_CONNECT_TIMEOUT)
+        self.assertEqual(len(sender.queue), 1)
+
+    def test_09_log_event(self):
+        """ log_event sends through a transport when it's given one """
+        with SyslogCollector('udp') as collector:
+            sender = transport.SocketTransport(collector.target, syslog.LOG_AUTH, 'host')
+            with mock.patch('syslog.syslog') as mock_syslog:
+                openvpn_client_disconnect.log_event('bob-device', syslog.LOG_AUTH,
+                                                    {'bytes_sent': '10'},
+                                                    hostname='vpn.example.com',
+                                                    transport=sender)
+            mock_syslog.assert_not_called()
+            sender.flush()
+            messages = collector.wait_for(1)
+            sender.close()
+        event = json.loads(messages[0].split(b' - - ', 1)[1])
+        self.assertEqual(event['hostname'], 'vpn.example.com')
+        self.assertEqual(event['details']['username'], 'bob-device')
+        self.assertEqual(event['details']['bytessent'], '10')